@@ -11,10 +11,18 @@ import prisma.errors
 
 from foxfeed.bsky import AsyncClient, get_specific_posts
 from foxfeed.database import Database
-from foxfeed.store import store_post2
+from foxfeed.store import scraped_post_row
+from foxfeed.bulk import ingest_scraped_posts
 from foxfeed.algos.feeds import algo_details
 from foxfeed.algos.generators import RunDetails
 from foxfeed.util import sleep_on
+from foxfeed.instrumentation import REGISTRY
+
+
+scoring_round_duration = REGISTRY.gauge(
+    'foxfeed_scoring_round_seconds',
+    'How long the last scoring round took',
+)
 
 
 async def refresh_posts(
@@ -37,8 +45,8 @@ async def refresh_posts(
     )
     if posts_to_refresh:
         print(f'Refreshing {len(posts_to_refresh)} posts')
-        async for i in get_specific_posts(client, [i.uri for i in posts_to_refresh]):
-            await store_post2(db, i, None, None, now=run_endtime)
+        rows = [scraped_post_row(i, None, None) async for i in get_specific_posts(client, [i.uri for i in posts_to_refresh])]
+        await ingest_scraped_posts(db, rows)
         print('Refresh done')
 
 
@@ -63,6 +71,7 @@ async def score_posts(shutdown_event: asyncio.Event, db: Database, client: Async
             break
 
     run_endtime = datetime.now(tz=timezone.utc)
+    scoring_round_duration.set((run_endtime - run_starttime).total_seconds())
 
     cprint(
         f"Scoring round {run_version} took {(run_endtime - run_starttime).seconds // 60} minutes",
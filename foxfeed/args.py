@@ -17,6 +17,9 @@ Services:
     --firehose --no-firehose  Enable or disable the firehose
     --scores --no-scores      Enable or disable post scoring (feed generation)
     --post --no-post          Enable or disable post scheduler
+    --rollups --no-rollups    Enable or disable the hourly feed metrics rollups (used by the stats pages)
+    --cleanup --no-cleanup    Enable or disable deleting old data, backs off when the firehose or scoring is struggling
+    --relabel --no-relabel    Enable or disable relabelling actors after the gender word lists change
 
 Settings:
 
@@ -40,6 +43,9 @@ class Args:
     firehose: bool
     scores: bool
     post_scheduler: bool
+    rollups: bool
+    cleanup: bool
+    relabel: bool
     
     log_db_queries: bool
     admin_panel: bool
@@ -91,6 +97,9 @@ def parse_args(args_original: List[str]) -> Union[int, Args]:
     firehose_flag = take(args, '--firehose', '--no-firehose')
     scores_flag = take(args, '--scores', '--no-scores')
     scheduler_flag = take(args, '--post', '--no-post')
+    rollups_flag = take(args, '--rollups', '--no-rollups')
+    cleanup_flag = take(args, '--cleanup', '--no-cleanup')
+    relabel_flag = take(args, '--relabel', '--no-relabel')
 
     dral_flag = take(args, '--admin-without-login', default=False)
 
@@ -101,6 +110,9 @@ def parse_args(args_original: List[str]) -> Union[int, Args]:
         and firehose_flag is not True
         and scores_flag is not True
         and scheduler_flag is not True
+        and rollups_flag is not True
+        and cleanup_flag is not True
+        and relabel_flag is not True
     )
 
     webserver = defaulting(webserver_flag, service_default)
@@ -108,6 +120,9 @@ def parse_args(args_original: List[str]) -> Union[int, Args]:
     firehose = defaulting(firehose_flag, service_default)
     scores = defaulting(scores_flag, service_default)
     scheduler = defaulting(scheduler_flag, service_default)
+    rollups = defaulting(rollups_flag, service_default)
+    cleanup = defaulting(cleanup_flag, service_default)
+    relabel = defaulting(relabel_flag, service_default)
 
     forever = (
         forever_flag
@@ -125,6 +140,9 @@ def parse_args(args_original: List[str]) -> Union[int, Args]:
         firehose=firehose,
         scores=scores,
         post_scheduler=scheduler,
+        rollups=rollups,
+        cleanup=cleanup,
+        relabel=relabel,
         log_db_queries=log_db_queries,
         admin_panel=admin_panel,
         forever=forever,
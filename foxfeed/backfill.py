@@ -0,0 +1,131 @@
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from atproto import CAR, AtUri, models
+from atproto_core.cid import CID
+
+from foxfeed.bsky import PolicyType, pds_client, request_and_retry_on_ratelimit
+from foxfeed.bulk import BackfillPostRow, LikeRow, ingest_backfill_posts, ingest_firehose_likes
+from foxfeed.data_filter import created_post_row
+from foxfeed.database import Database
+from foxfeed.firehose.data_stream import OpsByType, empty_ops, add_created_op, decode_record
+from foxfeed.instrumentation import REGISTRY
+from foxfeed.util import parse_datetime
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+backfill_records = REGISTRY.counter(
+    "foxfeed_backfill_records_total",
+    "Records found in downloaded repos, by kind and whether they were recent enough to keep",
+)
+backfill_bytes = REGISTRY.counter(
+    "foxfeed_backfill_bytes_total",
+    "Size of the repos downloaded for backfills",
+)
+
+
+async def get_repo(did: str, policy: PolicyType) -> Optional[bytes]:
+    """The whole repo as a CAR file, one request no matter how much is in it"""
+    client = await pds_client(did)
+    if client is None:
+        return None
+    return await request_and_retry_on_ratelimit(
+        client.com.atproto.sync.get_repo,
+        models.ComAtprotoSyncGetRepo.Params(did=did),
+        max_attempts=3,
+        policy=policy,
+    )
+
+
+def _walk_mst(blocks: Dict[CID, Any], link: Any) -> Iterator[Tuple[str, CID]]:
+    # https://atproto.com/specs/repository#mst-structure
+    # Each entry stores how much of the previous key it shares, and the rest of the key
+    node = blocks.get(CID.decode(link))
+    if node is None:
+        # Partial export, nothing we can do about the missing bits
+        return
+    if node.get("l") is not None:
+        yield from _walk_mst(blocks, node["l"])
+    key = b""
+    for entry in node["e"]:
+        key = key[:entry["p"]] + entry["k"]
+        yield key.decode("utf-8"), CID.decode(entry["v"])
+        if entry.get("t") is not None:
+            yield from _walk_mst(blocks, entry["t"])
+
+
+def repo_ops(did: str, data: bytes) -> OpsByType:
+    """Decodes every record in a repo as if they'd all just been created on the firehose"""
+    car = CAR.from_bytes(data)
+    ops = empty_ops()
+    commit = car.blocks.get(car.root)
+    if commit is None:
+        return ops
+    for path, cid in _walk_mst(car.blocks, commit["data"]):
+        record = decode_record(car.blocks.get(cid))
+        if record is not None:
+            add_created_op(ops, AtUri.from_str(f"at://{did}/{path}"), str(cid), did, record)
+    return ops
+
+
+@dataclass
+class Backfill:
+    did: str
+    posts: List[BackfillPostRow] = field(default_factory=list)
+    likes: List[LikeRow] = field(default_factory=list)
+    # Nowhere to put these yet, but it's good to know how much we're skipping
+    follows: int = 0
+    newest_post_at: Optional[datetime] = None
+
+
+def backfill_rows(did: str, ops: OpsByType, after: datetime) -> Backfill:
+    b = Backfill(did, follows=len(ops["follows"]["created"]))
+    # createdAt is whatever the client said, so anything from the future gets pulled back to now. Otherwise it would
+    # sit at the top of the feeds, and the high-water mark could never come back down past it.
+    now = datetime.now(timezone.utc)
+    for created_post in ops["posts"]["created"]:
+        created_at = min(parse_datetime(created_post["record"].created_at), now)
+        if created_at < after:
+            backfill_records.inc(kind="post", result="too old")
+            continue
+        row = created_post_row(created_post)
+        if row is None:
+            continue
+        backfill_records.inc(kind="post", result="kept")
+        b.posts.append({**row, "indexed_at": created_at})
+        if b.newest_post_at is None or created_at > b.newest_post_at:
+            b.newest_post_at = created_at
+    for like in ops["likes"]["created"]:
+        created_at = min(parse_datetime(like["record"].created_at), now)
+        if created_at < after:
+            backfill_records.inc(kind="like", result="too old")
+            continue
+        backfill_records.inc(kind="like", result="kept")
+        b.likes.append({
+            "uri": like["uri"],
+            "cid": like["cid"],
+            "liker_id": like["author"],
+            "post_uri": like["record"].subject.uri,
+            "post_cid": like["record"].subject.cid,
+            "created_at": created_at,
+            "attributed_feed": None,
+        })
+    backfill_records.inc(b.follows, kind="follow", result="skipped")
+    return b
+
+
+async def fetch_backfill(did: str, policy: PolicyType, after: datetime) -> Optional[Backfill]:
+    data = await get_repo(did, policy)
+    if data is None:
+        return None
+    backfill_bytes.inc(len(data))
+    # Big repos take a while to decode, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: backfill_rows(did, repo_ops(did, data), after))
+
+
+async def store_backfills(db: Database, backfills: List[Backfill]) -> None:
+    # The actors need to be in already, and likes only get kept for posts we have
+    await ingest_backfill_posts(db, [i for b in backfills for i in b.posts])
+    await ingest_firehose_likes(db, [i for b in backfills for i in b.likes])
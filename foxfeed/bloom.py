@@ -0,0 +1,69 @@
+import hashlib
+import math
+
+from typing import Iterable, Optional, Tuple
+
+
+# The whole graph is a few hundred thousand accounts. Sized for that, the filter is about 450KB, and a false
+# positive means an account gets skipped for one pass, so keep those rare.
+BLOOM_CAPACITY = 250_000
+BLOOM_ERROR_RATE = 0.001
+
+
+def bloom_size(capacity: int, error_rate: float) -> Tuple[int, int]:
+    """(bits, hashes) for a filter that holds capacity items with about error_rate false positives"""
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    # Whole bytes, so the bit array can be stored as-is
+    bits = (bits + 7) // 8 * 8
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class BloomFilter:
+    """
+    Set of strings that never forgets and never grows, but sometimes thinks it's seen something it hasn't.
+    Stored as raw bytes so it can live in a DB column, same as HyperLogLog.
+    """
+
+    def __init__(
+        self,
+        bits: Optional[bytes] = None,
+        capacity: int = BLOOM_CAPACITY,
+        error_rate: float = BLOOM_ERROR_RATE,
+    ):
+        self.m, self.k = bloom_size(capacity, error_rate)
+        if bits is None:
+            self.bits = bytearray(self.m // 8)
+        else:
+            if len(bits) != self.m // 8:
+                raise ValueError(f"expected {self.m // 8} bytes, got {len(bits)}")
+            self.bits = bytearray(bits)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # Double hashing, two halves of one digest stand in for k independent hashes
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.m for i in range(self.k))
+
+    def add(self, item: str) -> bool:
+        """Returns True if the item (probably) wasn't in there before"""
+        new = False
+        for p in self._positions(item):
+            byte, bit = divmod(p, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                new = True
+        return new
+
+    def __contains__(self, item: object) -> bool:
+        if not isinstance(item, str):
+            return False
+        for p in self._positions(item):
+            byte, bit = divmod(p, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
@@ -1,14 +1,21 @@
 import asyncio
-from datetime import datetime, timedelta
+import weakref
+from contextvars import ContextVar
+from datetime import timedelta
 from dataclasses import dataclass
 
 import atproto
 from atproto import AtUri
 import atproto.exceptions
+import httpx
 from foxfeed.database import Database
+from foxfeed.instrumentation import REGISTRY
 from typing import (
+    Awaitable,
     Callable,
+    Container,
     Coroutine,
+    Generic,
     TypeVar,
     Any,
     List,
@@ -17,6 +24,8 @@ from typing import (
     AsyncIterable,
     Union,
     Dict,
+    Set,
+    Tuple,
 )
 import time
 from foxfeed.util import sleep_on, chunkify, achunkify, groupby, alist, previous_rkey
@@ -34,6 +43,71 @@ from atproto_client.models.app.bsky.graph.defs import ListView, ListItemView
 from atproto_client.models.app.bsky.feed.get_likes import Like
 from atproto_client.models.app.bsky.feed.defs import PostView
 from atproto import models
+from atproto_client.client.base import InvokeType
+from atproto_client.request import Response
+
+
+bsky_ratelimit_tokens = REGISTRY.gauge(
+    "foxfeed_bsky_ratelimit_tokens",
+    "Requests that can go out right now without waiting, negative when callers are queued up",
+)
+bsky_ratelimit_remaining = REGISTRY.gauge(
+    "foxfeed_bsky_ratelimit_remaining",
+    "What the last response said was left of the server's ratelimit",
+)
+bsky_ratelimit_wait = REGISTRY.counter(
+    "foxfeed_bsky_ratelimit_wait_seconds_total",
+    "Time spent waiting on the ratelimiter before sending requests",
+)
+bsky_ratelimited = REGISTRY.counter(
+    "foxfeed_bsky_ratelimited_total",
+    "Requests that came back with a 429 anyway",
+)
+
+
+# Bluesky counts requests to the AppView and to people's PDSes separately
+REPO_ENDPOINTS = {"list_records", "get_record", "get_repo", "get_latest_commit"}
+# Fraction of the limit that can be used in one go
+RATELIMIT_BURST = 0.1
+# Requests to leave unused in the server's budget, since other things might be using the same account
+RATELIMIT_RESERVE = 10
+
+
+def endpoint_class(function: Callable[..., Any]) -> str:
+    return "repo" if getattr(function, "__name__", "") in REPO_ENDPOINTS else "appview"
+
+
+class TokenBucket:
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # Nothing goes out before this, set when the server says we're out
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Reserves a token and returns how long to wait before using it"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, self.blocked_until - now, 0)
+
+    def observe(self, remaining: int, reset_in: float) -> None:
+        """Never lets us think there's more budget than the server says there is"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = min(self.tokens, remaining - RATELIMIT_RESERVE)
+        if remaining <= RATELIMIT_RESERVE:
+            self.block(reset_in)
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
 
 
 class Policy:
@@ -42,27 +116,41 @@ class Policy:
         self.stop_event = stop_event
         self.ratelimit_timespan = ratelimit_timespan
         self.ratelimit_limit = ratelimit_limit
-        self.reset_at = datetime.now() - ratelimit_timespan
-        self.counter = 0
-        self.lock = asyncio.Lock()
+        self.buckets: Dict[str, TokenBucket] = {}
 
-    async def count_and_wait(self):
-        async with self.lock:
-            now = datetime.now()
-            if now > self.reset_at:
-                self.reset_at = now + self.ratelimit_timespan
-                self.counter = 0
-            self.counter += 1
-            if self.counter > self.ratelimit_limit:
-                await sleep_on(self.stop_event, (self.reset_at - now).total_seconds() + 2)
+    def bucket(self, endpoint: str) -> TokenBucket:
+        if endpoint not in self.buckets:
+            self.buckets[endpoint] = TokenBucket(
+                max(self.ratelimit_limit * RATELIMIT_BURST, 1),
+                self.ratelimit_limit / self.ratelimit_timespan.total_seconds(),
+            )
+        return self.buckets[endpoint]
+
+    async def count_and_wait(self, endpoint: str = "appview"):
+        # Callers each reserve a token and sleep on their own, so nobody queues up behind someone else's sleep
+        bucket = self.bucket(endpoint)
+        wait = bucket.take()
+        bsky_ratelimit_tokens.set(bucket.tokens, endpoint=endpoint)
+        if wait > 0:
+            bsky_ratelimit_wait.inc(wait, endpoint=endpoint)
+            await sleep_on(self.stop_event, wait)
+
+    def observe(self, endpoint: str, headers: Dict[str, str]) -> None:
+        try:
+            remaining = int(headers["ratelimit-remaining"])
+            reset_in = int(headers["ratelimit-reset"]) - time.time()
+        except (KeyError, ValueError):
+            return
+        bsky_ratelimit_remaining.set(remaining, endpoint=endpoint)
+        self.bucket(endpoint).observe(remaining, max(reset_in, 0) + 1)
 
 
 PolicyType = Optional[Union[asyncio.Event, Policy]]
 
 
-async def count_and_wait_if_policy(policy: PolicyType) -> None:
+async def count_and_wait_if_policy(policy: PolicyType, endpoint: str = "appview") -> None:
     if isinstance(policy, Policy):
-        await policy.count_and_wait()
+        await policy.count_and_wait(endpoint)
 
 
 async def sleep_on_stop_event(policy_or_stop_event: PolicyType, timeout: float) -> None:
@@ -84,7 +172,16 @@ T = TypeVar("T")
 U = TypeVar("U")
 
 
-AsyncClient = atproto.AsyncClient
+# Headers of the most recent response in the current task, so the ratelimiter can see them
+_last_response_headers: ContextVar[Optional[Dict[str, str]]] = ContextVar("_last_response_headers", default=None)
+
+
+class AsyncClient(atproto.AsyncClient):
+
+    async def _invoke(self, invoke_type: InvokeType, **kwargs: Any) -> Response:
+        response = await super()._invoke(invoke_type, **kwargs)
+        _last_response_headers.set(response.headers)
+        return response
 
 
 async def _login_from_handle_and_password(handle: str, password: str) -> AsyncClient:
@@ -131,34 +228,56 @@ async def request_and_retry_on_ratelimit(
 ) -> Optional[T]:
     if max_attempts < 1:
         raise ValueError("max_attempts must be at least 1")
-    for _ in range(max_attempts - 1):
+    endpoint = endpoint_class(function)
+    for attempt in range(max_attempts - 1):
         if ev_set(policy):
             return None
         try:
-            await count_and_wait_if_policy(policy)
-            return await function(argument)
+            return await _call_and_observe(function, argument, policy, endpoint)
         except atproto.exceptions.RequestException as e:
             if e.response and e.response.status_code in (500, 502):
                 await sleep_on_stop_event(policy, 5)
             elif e.response and e.response.status_code == 429:
                 print('Got ratelimited:')
                 print(e)
+                bsky_ratelimited.inc(endpoint=endpoint)
                 if "ratelimit-reset" in e.response.headers:
                     time_to_wait = int(e.response.headers["ratelimit-reset"]) - time.time() + 1
                 else:
-                    time_to_wait = 60 * 5
+                    time_to_wait = min(10 * 2 ** attempt, 60 * 5)
+                if isinstance(policy, Policy):
+                    # Everyone else using this endpoint should back off too
+                    policy.bucket(endpoint).block(time_to_wait)
                 await sleep_on_stop_event(policy, time_to_wait)
             else:
                 raise
     if ev_set(policy):
         return None
-    await count_and_wait_if_policy(policy)
-    return await function(argument)
+    return await _call_and_observe(function, argument, policy, endpoint)
+
+
+async def _call_and_observe(
+    function: Callable[[U], Coroutine[Any, Any, T]],
+    argument: U,
+    policy: PolicyType,
+    endpoint: str,
+) -> T:
+    await count_and_wait_if_policy(policy, endpoint)
+    _last_response_headers.set(None)
+    result = await function(argument)
+    headers = _last_response_headers.get()
+    if isinstance(policy, Policy) and headers is not None:
+        policy.observe(endpoint, headers)
+    return result
+
+
+M = TypeVar("M", bound="ModelWithCursor")
 
 
 class ModelWithCursor(Protocol):
     cursor: Optional[str]
-    def model_copy(self, *, update: Dict[str, Any]) -> 'ModelWithCursor': ...
+    # Returns the same model type, so a copy of the query params can be passed back to the query
+    def model_copy(self: M, *, update: Dict[str, Any]) -> M: ...
 
 
 QueryParams = TypeVar("QueryParams", bound=ModelWithCursor)
@@ -171,16 +290,29 @@ async def paginate(
     getval: Callable[[QueryResult], List[U]],
     *,
     policy: PolicyType,
+    cursor: Optional[str] = None,
+    on_cursor: Optional[Callable[[str], Awaitable[None]]] = None,
 ) -> AsyncIterable[U]:
+    """
+    on_cursor gets cursors that are safe to resume from. They lag a page behind, so that whatever the consumer
+    has buffered (as long as it's less than a page) gets fetched again rather than lost.
+    """
     if ev_set(policy):
         return
+    if cursor is not None:
+        params = params.model_copy(update={"cursor": cursor})
     r = await request_and_retry_on_ratelimit(
         query, params, max_attempts=3, policy=policy
     )
     if r is not None:
         for i in getval(r):
             yield i
+    # The cursor that fetched the previous page
+    previous = cursor
     while r is not None and r.cursor is not None and not ev_set(policy):
+        if on_cursor is not None and previous is not None:
+            await on_cursor(previous)
+        previous = r.cursor
         r = await request_and_retry_on_ratelimit(
             query,
             params.model_copy(update={"cursor": r.cursor}),
@@ -204,13 +336,20 @@ def get_followers(
 
 
 def get_follows(
-    client: AsyncClient, did: str, policy: PolicyType = None
+    client: AsyncClient,
+    did: str,
+    policy: PolicyType = None,
+    *,
+    cursor: Optional[str] = None,
+    on_cursor: Optional[Callable[[str], Awaitable[None]]] = None,
 ) -> AsyncIterable[ProfileView]:
     return paginate(
         models.AppBskyGraphGetFollows.Params(actor=did),
         client.app.bsky.graph.get_follows,
         lambda r: r.follows,
         policy=policy,
+        cursor=cursor,
+        on_cursor=on_cursor,
     )
 
 
@@ -236,38 +375,195 @@ def get_posts(
     )
 
 
+# getPosts and getProfiles both take at most 25 at a time
+LOOKUP_BATCH_SIZE = 25
+# How long a lookup waits for others to fill up its batch before the request goes out anyway
+LOOKUP_BATCH_WINDOW = 0.02
+LOOKUP_CACHE_TTL = 30
+LOOKUP_CACHE_SIZE = 10_000
+
+
+bsky_lookups = REGISTRY.counter(
+    "foxfeed_bsky_lookups_total",
+    "Keys asked for through the batched lookups, by whether they were cached, already in flight, or fetched",
+)
+bsky_lookup_requests = REGISTRY.counter(
+    "foxfeed_bsky_lookup_requests_total",
+    "API requests made by the batched lookups",
+)
+
+
+class BatchLookup(Generic[T]):
+    """
+    Merges concurrent lookups into full size requests. Everyone asking for a key that's already being fetched
+    waits on the same request, and results (including things that turned out not to exist) get cached for a bit.
+    Requests only merge lookups that share a policy, so nobody gets ratelimited or stopped by someone else's.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fetch: Callable[[List[str], PolicyType], Awaitable[Optional[List[T]]]],
+        keys: Callable[[T], List[str]],
+    ):
+        self.name = name
+        self.fetch = fetch
+        self.keys = keys
+        self.cache: Dict[str, Tuple[float, Optional[T]]] = {}
+        self.in_flight: Dict[Tuple[str, PolicyType], "asyncio.Future[Optional[T]]"] = {}
+        self.pending: Dict[PolicyType, List[str]] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.tasks: Set["asyncio.Task[None]"] = set()
+
+    async def load_many(self, keys: List[str], policy: PolicyType) -> Dict[str, T]:
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        found: Dict[str, T] = {}
+        waiting: Dict[str, "asyncio.Future[Optional[T]]"] = {}
+        for key in dict.fromkeys(keys):
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > now:
+                bsky_lookups.inc(endpoint=self.name, result="cached")
+                if cached[1] is not None:
+                    found[key] = cached[1]
+            elif (key, policy) in self.in_flight:
+                bsky_lookups.inc(endpoint=self.name, result="coalesced")
+                waiting[key] = self.in_flight[key, policy]
+            else:
+                bsky_lookups.inc(endpoint=self.name, result="fetched")
+                waiting[key] = self.in_flight[key, policy] = loop.create_future()
+                pending = self.pending.setdefault(policy, [])
+                pending.append(key)
+                if len(pending) >= LOOKUP_BATCH_SIZE:
+                    self._flush(full_only=True)
+        if self.pending and self.flush_handle is None:
+            self.flush_handle = loop.call_later(LOOKUP_BATCH_WINDOW, self._flush)
+        for key, future in waiting.items():
+            # Shielded so one caller giving up doesn't cancel the request for everyone else
+            value = await asyncio.shield(future)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def _flush(self, full_only: bool = False) -> None:
+        if not full_only and self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for policy, pending in list(self.pending.items()):
+            while len(pending) >= (LOOKUP_BATCH_SIZE if full_only else 1):
+                batch, pending = pending[:LOOKUP_BATCH_SIZE], pending[LOOKUP_BATCH_SIZE:]
+                task = asyncio.create_task(self._run(batch, policy))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            if pending:
+                self.pending[policy] = pending
+            else:
+                del self.pending[policy]
+
+    async def _run(self, keys: List[str], policy: PolicyType) -> None:
+        try:
+            results = await self.fetch(keys, policy)
+        except BaseException as e:
+            if len(keys) > 1 and not isinstance(e, asyncio.CancelledError):
+                # Might just be one bad key, so split the batch and try again, everything else still gets its answer
+                half = len(keys) // 2
+                await asyncio.gather(self._run(keys[:half], policy), self._run(keys[half:], policy))
+                return
+            for key in keys:
+                future = self.in_flight.pop((key, policy))
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            return
+        bsky_lookup_requests.inc(endpoint=self.name)
+        by_key = {k: i for i in results or [] for k in self.keys(i)}
+        expires = time.monotonic() + LOOKUP_CACHE_TTL
+        for key in keys:
+            value = by_key.get(key)
+            # No results means the request never happened (shutting down), which says nothing about the keys
+            if results is not None:
+                self.cache.pop(key, None)
+                self.cache[key] = (expires, value)
+            self.in_flight.pop((key, policy)).set_result(value)
+        self._prune()
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        # Entries all live for the same amount of time, so insertion order is expiry order
+        while self.cache and (
+            len(self.cache) > LOOKUP_CACHE_SIZE or next(iter(self.cache.values()))[0] <= now
+        ):
+            del self.cache[next(iter(self.cache))]
+
+
+class Lookups:
+
+    def __init__(self, client: AsyncClient):
+        self.posts = BatchLookup[PostView](
+            "getPosts",
+            lambda uris, policy: _fetch_posts(client, uris, policy),
+            lambda p: [p.uri],
+        )
+        self.profiles = BatchLookup[ProfileViewDetailed](
+            "getProfiles",
+            lambda actors, policy: _fetch_profiles(client, actors, policy),
+            # getProfiles takes handles as well as DIDs
+            lambda p: [p.did, p.handle],
+        )
+
+
+_lookups: "weakref.WeakKeyDictionary[AsyncClient, Lookups]" = weakref.WeakKeyDictionary()
+
+
+def lookups(client: AsyncClient) -> Lookups:
+    if client not in _lookups:
+        _lookups[client] = Lookups(client)
+    return _lookups[client]
+
+
+async def _fetch_posts(client: AsyncClient, uris: List[str], policy: PolicyType) -> Optional[List[PostView]]:
+    posts = await request_and_retry_on_ratelimit(
+        client.app.bsky.feed.get_posts,
+        models.AppBskyFeedGetPosts.Params(uris=uris),
+        max_attempts=3,
+        policy=policy
+    )
+    return None if posts is None else posts.posts
+
+
+async def _fetch_profiles(client: AsyncClient, actors: List[str], policy: PolicyType) -> Optional[List[ProfileViewDetailed]]:
+    users = await request_and_retry_on_ratelimit(
+        client.app.bsky.actor.get_profiles,
+        models.AppBskyActorGetProfiles.Params(actors=actors),
+        max_attempts=3,
+        policy=policy
+    )
+    return None if users is None else users.profiles
+
+
 async def get_specific_posts(
     client: AsyncClient, uris: List[str], policy: PolicyType = None
 ) -> AsyncIterable[PostView]:
-    for block in chunkify(uris, 25):
+    for block in chunkify(dict.fromkeys(uris), LOOKUP_BATCH_SIZE):
         if ev_set(policy):
             return
-        posts = await request_and_retry_on_ratelimit(
-            client.app.bsky.feed.get_posts,
-            models.AppBskyFeedGetPosts.Params(uris=block),
-            max_attempts=3,
-            policy=policy
-        )
-        if posts is not None:
-            for i in posts.posts:
-                yield i
+        posts = await lookups(client).posts.load_many(block, policy)
+        for i in block:
+            if i in posts:
+                yield posts[i]
 
 
 async def get_specific_profiles(
     client: AsyncClient, dids: List[str], policy: PolicyType = None
 ) -> AsyncIterable[ProfileViewDetailed]:
-    for block in chunkify(dids, 25):
+    for block in chunkify(dict.fromkeys(dids), LOOKUP_BATCH_SIZE):
         if ev_set(policy):
             return
-        users = await request_and_retry_on_ratelimit(
-            client.app.bsky.actor.get_profiles,
-            models.AppBskyActorGetProfiles.Params(actors=block),
-            max_attempts=3,
-            policy=policy
-        )
-        if users is not None:
-            for i in users.profiles:
-                yield i
+        users = await lookups(client).profiles.load_many(block, policy)
+        for i in block:
+            if i in users:
+                yield users[i]
 
 
 @dataclass
@@ -378,10 +674,10 @@ async def get_specific_likes(
 
 
 def get_likes(
-    client: AsyncClient, uri: str, policy: PolicyType = None
+    client: AsyncClient, uri: str, policy: PolicyType = None, limit: int = 50
 ) -> AsyncIterable[Like]:
     return paginate(
-        models.AppBskyFeedGetLikes.Params(uri=uri),
+        models.AppBskyFeedGetLikes.Params(uri=uri, limit=limit),
         client.app.bsky.feed.get_likes,
         lambda r: r.likes,
         policy=policy,
@@ -432,6 +728,42 @@ def get_list(
     )
 
 
+# DID documents hardly ever change, so this is mostly cache hits after the first scan
+_id_resolver: Optional[atproto.AsyncIdResolver] = None
+# A logged in client only talks to our own PDS, and sync.* requests only work against the PDS that hosts the repo
+_pds_clients: Dict[str, AsyncClient] = {}
+
+
+async def pds_client(did: str) -> Optional[AsyncClient]:
+    """Unauthenticated client for the PDS hosting did's repo, None if their DID document can't be resolved"""
+    global _id_resolver
+    if _id_resolver is None:
+        _id_resolver = atproto.AsyncIdResolver(cache=atproto.AsyncDidInMemoryCache())
+    try:
+        data = await _id_resolver.did.resolve_atproto_data(did)
+    except (atproto.exceptions.AtProtocolError, httpx.HTTPError):
+        return None
+    if data.pds is None:
+        return None
+    if data.pds not in _pds_clients:
+        _pds_clients[data.pds] = AsyncClient(data.pds)
+    return _pds_clients[data.pds]
+
+
+async def get_latest_rev(did: str, policy: PolicyType = None) -> Optional[str]:
+    """Changes whenever anything in the repo does, so it's a cheap way to tell if a list might have changed"""
+    client = await pds_client(did)
+    if client is None:
+        return None
+    r = await request_and_retry_on_ratelimit(
+        client.com.atproto.sync.get_latest_commit,
+        models.ComAtprotoSyncGetLatestCommit.Params(did=did),
+        max_attempts=3,
+        policy=policy,
+    )
+    return None if r is None else r.rev
+
+
 async def as_detailed_profiles(
     client: AsyncClient,
     func: Callable[
@@ -439,9 +771,12 @@ async def as_detailed_profiles(
         AsyncIterable[ProfileView],
     ],
     arg: str,
-    policy: PolicyType = None
+    policy: PolicyType = None,
+    skip: Container[str] = (),
 ) -> AsyncIterable[ProfileViewDetailed]:
-    async for chunk in achunkify(func(client, arg, policy), 25):
+    # Skipped ones never get their details looked up
+    fresh = (i async for i in func(client, arg, policy) if i.did not in skip)
+    async for chunk in achunkify(fresh, 25):
         if ev_set(policy):
             return
         async for i in get_specific_profiles(client, [i.did for i in chunk], policy):
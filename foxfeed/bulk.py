@@ -0,0 +1,338 @@
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from psycopg import sql
+
+from foxfeed.database import Database
+from foxfeed.gen.db import InsertUnknownThingsRow
+from foxfeed.instrumentation import REGISTRY
+
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, TypedDict
+
+
+bulk_rows = REGISTRY.counter(
+    "foxfeed_bulk_rows_total",
+    "Rows sent to the database through COPY, and how many of them were actually written",
+)
+bulk_seconds = REGISTRY.counter(
+    "foxfeed_bulk_seconds_total",
+    "Time spent copying and merging bulk batches",
+)
+
+
+@dataclass(frozen=True)
+class BulkTable:
+    """How to get a batch of rows into a table: COPY into a staging table, then merge with INSERT ... ON CONFLICT"""
+
+    # Used to name the staging table, different column sets for the same table need different names
+    name: str
+    table: str
+    columns: Sequence[str]
+    # Empty means ON CONFLICT DO NOTHING for any unique constraint
+    conflict: Sequence[str] = ()
+    # column -> expression to use on conflict, EXCLUDED is the incoming row
+    update: Dict[str, str] = field(default_factory=dict)
+    # (column, table, column) foreign keys to check, rows that would violate them get dropped instead of failing the batch
+    references: Sequence[Tuple[str, str, str]] = ()
+
+    @property
+    def staging(self) -> str:
+        return f"bulk_{self.name}"
+
+
+def excluded(*columns: str) -> Dict[str, str]:
+    return {i: f'EXCLUDED."{i}"' for i in columns}
+
+
+_POST_COLUMNS = [
+    "uri",
+    "cid",
+    "reply_parent",
+    "reply_root",
+    "authorId",
+    "text",
+    "mentions_fursuit",
+    "media_count",
+    "media_with_alt_text_count",
+    "m0",
+    "m1",
+    "m2",
+    "m3",
+    "labels",
+    "embed_uri",
+    "embed_cid",
+]
+
+_LIKE_COLUMNS = ["uri", "cid", "liker_id", "post_uri", "post_cid", "created_at", "attributed_feed"]
+
+
+FIREHOSE_POSTS = BulkTable(
+    name="firehose_posts",
+    table="Post",
+    columns=_POST_COLUMNS,
+    references=[("authorId", "Actor", "did")],
+)
+
+FIREHOSE_LIKES = BulkTable(
+    name="firehose_likes",
+    table="Like",
+    columns=_LIKE_COLUMNS,
+    references=[("liker_id", "Actor", "did"), ("post_uri", "Post", "uri")],
+)
+
+UNKNOWN_THINGS = BulkTable(
+    name="unknown_things",
+    table="UnknownThing",
+    columns=["kind", "identifier"],
+)
+
+SCRAPED_ACTORS = BulkTable(
+    name="scraped_actors",
+    table="Actor",
+    columns=[
+        "did",
+        "handle",
+        "description",
+        "displayName",
+        "avatar",
+        "flagged_for_manual_review",
+        "autolabel_fem_vibes",
+        "autolabel_nb_vibes",
+        "autolabel_masc_vibes",
+        "autolabel_ruleset",
+        "is_furrylist_verified",
+        "was_ever_furrylist_verified",
+        "is_muted",
+        "is_external_to_network",
+        "follower_count",
+        "following_count",
+    ],
+    conflict=["did"],
+    # Same as foxfeed.store.store_user, flagged_for_manual_review only gets set for new users
+    update={
+        **excluded(
+            "handle",
+            "description",
+            "displayName",
+            "avatar",
+            "autolabel_fem_vibes",
+            "autolabel_nb_vibes",
+            "autolabel_masc_vibes",
+            "autolabel_ruleset",
+            "is_muted",
+            "is_external_to_network",
+            "is_furrylist_verified",
+            "follower_count",
+            "following_count",
+        ),
+        # Once this flag turns on, we don't turn it off
+        "was_ever_furrylist_verified": '"Actor".was_ever_furrylist_verified OR EXCLUDED.was_ever_furrylist_verified',
+    },
+)
+
+# Posts found by the scraper come with like counts and get refreshed if we've already seen them
+SCRAPED_POSTS = BulkTable(
+    name="scraped_posts",
+    table="Post",
+    columns=_POST_COLUMNS + ["indexed_at", "like_count"],
+    conflict=["uri"],
+    update={
+        **excluded(
+            "like_count",
+            "media_count",
+            "media_with_alt_text_count",
+            "mentions_fursuit",
+            "text",
+            "labels",
+            "m0",
+            "m1",
+            "m2",
+            "m3",
+            "embed_uri",
+            "embed_cid",
+        ),
+        # New posts are left as never rescanned so the score task picks them up
+        "last_rescan": "now() AT TIME ZONE 'UTC'",
+    },
+    references=[("authorId", "Actor", "did")],
+)
+
+# Posts read straight out of someone's repo, indexed_at is when they were made rather than when we saw them.
+# Repos don't know about likes, so anything we already have is left alone.
+BACKFILL_POSTS = BulkTable(
+    name="backfill_posts",
+    table="Post",
+    columns=_POST_COLUMNS + ["indexed_at"],
+    references=[("authorId", "Actor", "did")],
+)
+
+SCRAPED_LIKES = BulkTable(
+    name="scraped_likes",
+    table="Like",
+    columns=_LIKE_COLUMNS,
+    references=[("liker_id", "Actor", "did"), ("post_uri", "Post", "uri")],
+)
+
+
+class PostRow(TypedDict):
+    uri: str
+    cid: str
+    reply_parent: Optional[str]
+    reply_root: Optional[str]
+    authorId: str
+    text: str
+    mentions_fursuit: bool
+    media_count: int
+    media_with_alt_text_count: int
+    m0: Optional[str]
+    m1: Optional[str]
+    m2: Optional[str]
+    m3: Optional[str]
+    labels: List[str]
+    embed_uri: Optional[str]
+    embed_cid: Optional[str]
+
+
+class LikeRow(TypedDict):
+    uri: str
+    cid: str
+    liker_id: str
+    post_uri: str
+    post_cid: str
+    created_at: datetime
+    attributed_feed: Optional[str]
+
+
+class ScrapedActorRow(TypedDict):
+    did: str
+    handle: str
+    description: Optional[str]
+    displayName: Optional[str]
+    avatar: Optional[str]
+    flagged_for_manual_review: bool
+    autolabel_fem_vibes: bool
+    autolabel_nb_vibes: bool
+    autolabel_masc_vibes: bool
+    autolabel_ruleset: str
+    is_furrylist_verified: bool
+    was_ever_furrylist_verified: bool
+    is_muted: bool
+    is_external_to_network: bool
+    follower_count: int
+    following_count: int
+
+
+class ScrapedPostRow(PostRow):
+    indexed_at: datetime
+    like_count: int
+
+
+class BackfillPostRow(PostRow):
+    indexed_at: datetime
+
+
+def _identifiers(columns: Sequence[str]) -> sql.Composable:
+    return sql.SQL(", ").join(sql.Identifier(i) for i in columns)
+
+
+def _create_staging(t: BulkTable) -> sql.Composable:
+    # Temporary tables belong to the connection, and pooled connections stick around, so this only does
+    # anything the first time. Rows get cleared out when the transaction commits.
+    return sql.SQL(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS AS SELECT {columns} FROM {table} WITH NO DATA"
+    ).format(
+        staging=sql.Identifier(t.staging),
+        columns=_identifiers(t.columns),
+        table=sql.Identifier(t.table),
+    )
+
+
+def _copy(t: BulkTable) -> sql.Composable:
+    return sql.SQL("COPY {staging} ({columns}) FROM STDIN").format(
+        staging=sql.Identifier(t.staging),
+        columns=_identifiers(t.columns),
+    )
+
+
+def _merge(t: BulkTable) -> sql.Composable:
+    distinct = sql.SQL("")
+    if t.update:
+        # ON CONFLICT DO UPDATE can't touch the same row twice in one statement
+        distinct = sql.SQL("DISTINCT ON ({}) ").format(_identifiers(t.conflict))
+    where = sql.SQL("")
+    if t.references:
+        where = sql.SQL(" WHERE ") + sql.SQL(" AND ").join(
+            sql.SQL("EXISTS (SELECT 1 FROM {table} AS r WHERE r.{target} = s.{column})").format(
+                table=sql.Identifier(table),
+                target=sql.Identifier(target),
+                column=sql.Identifier(column),
+            )
+            for column, table, target in t.references
+        )
+    if not t.update:
+        on_conflict = sql.SQL("DO NOTHING")
+    else:
+        on_conflict = sql.SQL("({}) DO UPDATE SET {}").format(
+            _identifiers(t.conflict),
+            sql.SQL(", ").join(
+                sql.SQL("{} = {}").format(sql.Identifier(column), sql.SQL(expression))  # type: ignore
+                for column, expression in t.update.items()
+            ),
+        )
+    return sql.SQL(
+        "INSERT INTO {table} ({columns}) SELECT {distinct}{columns} FROM {staging} AS s{where} ON CONFLICT {on_conflict}"
+    ).format(
+        table=sql.Identifier(t.table),
+        columns=_identifiers(t.columns),
+        distinct=distinct,
+        staging=sql.Identifier(t.staging),
+        where=where,
+        on_conflict=on_conflict,
+    )
+
+
+async def ingest(db: Database, t: BulkTable, rows: Sequence[Mapping[str, Any]]) -> int:
+    """Writes a batch of rows in a single transaction, returns how many rows were inserted or updated"""
+    if not rows:
+        return 0
+    start = time.perf_counter()
+    async with db.pg.connection() as conn:
+        cur = conn.cursor()
+        await cur.execute(_create_staging(t))
+        async with cur.copy(_copy(t)) as copy:
+            for row in rows:
+                await copy.write_row([row[i] for i in t.columns])
+        await cur.execute(_merge(t))
+        written = max(cur.rowcount, 0)
+    bulk_seconds.inc(time.perf_counter() - start, table=t.name)
+    bulk_rows.inc(len(rows), table=t.name, result="sent")
+    bulk_rows.inc(written, table=t.name, result="written")
+    return written
+
+
+async def ingest_firehose_posts(db: Database, rows: Sequence[PostRow]) -> int:
+    return await ingest(db, FIREHOSE_POSTS, rows)
+
+
+async def ingest_firehose_likes(db: Database, rows: Sequence[LikeRow]) -> int:
+    return await ingest(db, FIREHOSE_LIKES, rows)
+
+
+async def ingest_unknown_things(db: Database, rows: Sequence[InsertUnknownThingsRow]) -> int:
+    return await ingest(db, UNKNOWN_THINGS, rows)
+
+
+async def ingest_scraped_actors(db: Database, rows: Sequence[ScrapedActorRow]) -> int:
+    return await ingest(db, SCRAPED_ACTORS, rows)
+
+
+async def ingest_scraped_posts(db: Database, rows: Sequence[ScrapedPostRow]) -> int:
+    return await ingest(db, SCRAPED_POSTS, rows)
+
+
+async def ingest_backfill_posts(db: Database, rows: Sequence[BackfillPostRow]) -> int:
+    return await ingest(db, BACKFILL_POSTS, rows)
+
+
+async def ingest_scraped_likes(db: Database, rows: Sequence[LikeRow]) -> int:
+    return await ingest(db, SCRAPED_LIKES, rows)
@@ -0,0 +1,142 @@
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from termcolor import cprint
+
+from foxfeed.algos.generators import LOOKBACK_HARD_LIMIT
+from foxfeed.bloom import BloomFilter
+from foxfeed.database import Database
+
+from typing import List, Optional, Tuple
+
+
+# The seen filter is a few hundred KB, so it gets written less often than the cursor. If it's behind after a
+# restart a few accounts get scraped twice, which is harmless.
+SEEN_FILTER_SAVE_INTERVAL = 60
+
+# Found accounts get written this many at a time, and always before a cursor or seen filter that covers them
+FOUND_BATCH_SIZE = 100
+
+# Anything scraped before then has aged out of the feeds, so there's nothing to be saved by carrying on
+CHECKPOINT_MAX_AGE = LOOKBACK_HARD_LIMIT
+
+
+@dataclass
+class Checkpoint:
+    """
+    How far the full scrape got, so a restart can carry on instead of starting again.
+    Sources are the places find_furries_raw gets accounts from, in order. Accounts are remembered once they've
+    been handed to the scraper, and marked done once their posts have been stored.
+    The accounts seen so far are kept in a bloom filter rather than a set, so memory doesn't grow with the graph.
+    """
+
+    db: Database
+    name: str
+    source: int = 0
+    cursor: Optional[str] = None
+    seen: BloomFilter = field(default_factory=BloomFilter)
+    seen_saved_at: float = field(default_factory=time.monotonic)
+    found_pending: List[Tuple[str, str, bool, bool]] = field(default_factory=list)
+
+    @staticmethod
+    async def load(db: Database, name: str) -> 'Checkpoint':
+        c = Checkpoint(db, name)
+        row = await db.pg.fetchone(
+            'SELECT source, cursor, seen_filter, updated_at FROM "ScrapeCheckpoint" WHERE name = %s',
+            (name,),
+        )
+        if row is None:
+            await db.pg.execute('INSERT INTO "ScrapeCheckpoint" (name, source) VALUES (%s, 0)', (name,))
+            return c
+        if row[3] < datetime.now(timezone.utc).replace(tzinfo=None) - CHECKPOINT_MAX_AGE:
+            cprint(f'Checkpoint for scrape {name} is from {row[3]}, starting again', 'yellow', force_color=True)
+            async with db.pg.connection() as conn:
+                await conn.execute('DELETE FROM "ScrapeActor" WHERE scrape = %s', (name,))
+                await conn.execute(
+                    '''
+                    UPDATE "ScrapeCheckpoint" SET source = 0, cursor = NULL, seen_filter = NULL, updated_at = now() AT TIME ZONE 'UTC'
+                    WHERE name = %s
+                    ''',
+                    (name,),
+                )
+            return c
+        c.source, c.cursor, seen_filter, _ = row
+        if seen_filter is not None:
+            try:
+                c.seen = BloomFilter(seen_filter)
+            except ValueError:
+                # Filter was sized differently, accounts from before the restart get looked up again
+                cprint(f'Seen filter for scrape {name} is the wrong size, starting a new one', 'yellow', force_color=True)
+        cprint(f'Resuming scrape {name} from source {c.source}', 'blue', force_color=True)
+        return c
+
+    async def start_source(self, source: int) -> None:
+        self.source = source
+        self.cursor = None
+        await self._save()
+        # Sources that can't resume from a cursor rely on this to not look everything up again
+        await self.save_seen()
+
+    async def save_cursor(self, cursor: str) -> None:
+        self.cursor = cursor
+        await self._save()
+
+    async def _save(self) -> None:
+        await self.flush_found()
+        await self.db.pg.execute(
+            'UPDATE "ScrapeCheckpoint" SET source = %s, cursor = %s, updated_at = now() AT TIME ZONE \'UTC\' WHERE name = %s',
+            (self.source, self.cursor, self.name),
+        )
+        if time.monotonic() - self.seen_saved_at > SEEN_FILTER_SAVE_INTERVAL:
+            await self.save_seen()
+
+    async def save_seen(self) -> None:
+        await self.flush_found()
+        self.seen_saved_at = time.monotonic()
+        await self.db.pg.execute(
+            'UPDATE "ScrapeCheckpoint" SET seen_filter = %s WHERE name = %s',
+            (self.seen.to_bytes(), self.name),
+        )
+
+    async def found(self, did: str, is_furrylist_verified: bool, done: bool) -> None:
+        self.seen.add(did)
+        self.found_pending.append((self.name, did, is_furrylist_verified, done))
+        if len(self.found_pending) >= FOUND_BATCH_SIZE:
+            await self.flush_found()
+
+    async def flush_found(self) -> None:
+        rows, self.found_pending = self.found_pending, []
+        if rows:
+            await self.db.pg.executemany(
+                '''
+                INSERT INTO "ScrapeActor" (scrape, did, is_furrylist_verified, done) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (scrape, did) DO NOTHING
+                ''',
+                rows,
+            )
+
+    async def unfinished(self) -> List[Tuple[str, bool]]:
+        """Accounts that were handed out before the restart but never got their posts stored"""
+        rows = await self.db.pg.fetchall(
+            'SELECT did, is_furrylist_verified FROM "ScrapeActor" WHERE scrape = %s AND NOT done',
+            (self.name,),
+        )
+        return [(did, verified) for did, verified in rows]
+
+    async def finish(self) -> None:
+        async with self.db.pg.connection() as conn:
+            await conn.execute('DELETE FROM "ScrapeActor" WHERE scrape = %s', (self.name,))
+            await conn.execute('DELETE FROM "ScrapeCheckpoint" WHERE name = %s', (self.name,))
+
+
+async def mark_done(db: Database, scrape: str, dids: List[str]) -> None:
+    # Found accounts are written in batches, so an account can finish before its row is there. Whether it was
+    # furryli.st verified only matters for unfinished ones.
+    if dids:
+        await db.pg.execute(
+            '''
+            INSERT INTO "ScrapeActor" (scrape, did, is_furrylist_verified, done) SELECT %s, unnest(%s::text[]), FALSE, TRUE
+            ON CONFLICT (scrape, did) DO UPDATE SET done = TRUE
+            ''',
+            (scrape, dids),
+        )
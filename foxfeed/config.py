@@ -24,4 +24,14 @@ PERSONAL_HANDLE = value('PERSONAL_HANDLE')
 PERSONAL_PASSWORD = value('PERSONAL_PASSWORD')
 
 ADMIN_PANEL_PASSWORD: Optional[str] = os.environ.get('ADMIN_PANEL_PASSWORD')
+# Lets prometheus read /metrics by sending "Authorization: Bearer <token>", admins can read it without one
+METRICS_TOKEN: Optional[str] = os.environ.get('METRICS_TOKEN')
 
+
+# How many of each scraper stage to run at once, they all share the same ratelimiter
+SCRAPER_POST_WORKERS = int(value('SCRAPER_POST_WORKERS', '4'))
+SCRAPER_LIKE_WORKERS = int(value('SCRAPER_LIKE_WORKERS', '4'))
+# "index/count", lets several scrapers split the accounts between them, e.g. "0/2" and "1/2"
+SCRAPER_SHARD: str = value('SCRAPER_SHARD', '0/1')
+# Accounts the scraper hasn't seen before get their whole repo downloaded in one go, instead of paging through their feed
+SCRAPER_REPO_BACKFILL: bool = value('SCRAPER_REPO_BACKFILL', 'true').lower() == 'true'
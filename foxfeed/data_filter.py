@@ -4,12 +4,13 @@ from atproto import models
 from foxfeed.util import is_record_type
 
 from foxfeed.logger import logger
-from foxfeed.firehose.data_stream import OpsByType
+from foxfeed.firehose.data_stream import OpsByType, CreateOp
 
 from typing import Optional, List, Callable, Coroutine, Any, Union, Dict, Tuple, TypeVar, Generic, Literal
-from prisma.types import PostCreateWithoutRelationsInput, LikeCreateWithoutRelationsInput
+from foxfeed.bulk import PostRow, LikeRow, ingest_firehose_posts, ingest_firehose_likes, ingest_unknown_things
 
 from foxfeed.database import Database, care_about_storing_user_data_preemptively
+from foxfeed.mutes import MUTES
 
 from foxfeed.util import mentions_fursuit, parse_datetime
 
@@ -73,17 +74,14 @@ T = TypeVar('T')
 
 
 async def get_actor(db: Database, did: str) -> Optional[Dict[str, Any]]:
-    cur = await db.pg.execute('SELECT * FROM "Actor" WHERE did = %s LIMIT 1', (did,))
-    r = await cur.fetchone()
-    if r is None or cur.description is None:
-        return None
-    return dict(zip([i.name for i in cur.description], r))
+    rows = await db.pg.fetchdicts('SELECT * FROM "Actor" WHERE did = %s LIMIT 1', (did,))
+    return rows[0] if rows else None
 
 
 async def get_actors(db: Database, dids: List[str]) -> List[Tuple[str, bool]]:
     if not dids:
         return []
-    cur = await db.pg.execute('SELECT did, is_muted, manual_include_in_fox_feed, is_external_to_network FROM "Actor" WHERE did = ANY(%s)', [dids])
+    rows = await db.pg.fetchall('SELECT did, is_muted, manual_include_in_fox_feed, is_external_to_network FROM "Actor" WHERE did = ANY(%s)', [dids])
     return [
         (
             did,
@@ -92,23 +90,19 @@ async def get_actors(db: Database, dids: List[str]) -> List[Tuple[str, bool]]:
             and is_external_to_network is False
         )
         for (did, is_muted, manual_include_in_fox_feed, is_external_to_network)
-        in await cur.fetchall()
+        in rows
     ]
 
 
 async def get_post(db: Database, uri: str) -> Optional[Dict[str, Any]]:
-    cur = await db.pg.execute('SELECT * FROM "Post" WHERE uri = %s LIMIT 1', (uri,))
-    r = await cur.fetchone()
-    if r is None or cur.description is None:
-        return None
-    return dict(zip([i.name for i in cur.description], r))
+    rows = await db.pg.fetchdicts('SELECT * FROM "Post" WHERE uri = %s LIMIT 1', (uri,))
+    return rows[0] if rows else None
 
 
 async def get_posts(db: Database, uris: List[str]) -> List[Tuple[str, str]]:
     if not uris:
         return []
-    cur = await db.pg.execute('SELECT uri, "authorId" FROM "Post" WHERE uri = ANY(%s)', [uris])
-    return await cur.fetchall()
+    return await db.pg.fetchall('SELECT uri, "authorId" FROM "Post" WHERE uri = ANY(%s)', [uris])
 
 
 # @CachedQuery
@@ -187,9 +181,46 @@ def get_associated_posts(record: models.AppBskyFeedPost.Record) -> List[str]:
         pass
     return [i for i in [embed_uri, reply_parent, reply_root] if i is not None]
 
+def get_labels(record: models.AppBskyFeedPost.Record) -> List[str]:
+    return (
+        []
+        if not isinstance(record.labels, models.ComAtprotoLabelDefs.SelfLabels)
+        else [i.val for i in record.labels.values]
+    )
+
+
+def created_post_row(created_post: CreateOp[models.AppBskyFeedPost.Record]) -> Optional[PostRow]:
+    record = created_post["record"]
+    embed_uri, embed_cid = get_quoted_skeet(record.embed)
+    try:
+        reply_parent = get_reply_parent(record)
+        reply_root = get_reply_root(record)
+    except AttributeError:
+        return None
+    num_with_alt_text, image_urls = get_images(created_post["author"], record.embed)
+    return {
+        "uri": created_post["uri"],
+        "cid": created_post["cid"],
+        "reply_parent": reply_parent,
+        "reply_root": reply_root,
+        "authorId": created_post["author"],
+        "text": record.text,
+        "mentions_fursuit": mentions_fursuit(record.text),
+        "media_count": len(image_urls),
+        "media_with_alt_text_count": num_with_alt_text,
+        "m0": image_urls.get(0, None),
+        "m1": image_urls.get(1, None),
+        "m2": image_urls.get(2, None),
+        "m3": image_urls.get(3, None),
+        "labels": get_labels(record),
+        "embed_uri": embed_uri,
+        "embed_cid": embed_cid,
+    }
+
+
 async def operations_callback(db: Database, ops: OpsByType) -> None:
 
-    posts_to_create: List[PostCreateWithoutRelationsInput] = []
+    posts_to_create: List[PostRow] = []
 
     unknown_things_to_queue: List[Tuple[str, Literal['post', 'actor', 'like']]] = []
 
@@ -217,6 +248,9 @@ async def operations_callback(db: Database, ops: OpsByType) -> None:
     }
 
     actors = dict(await get_actors(db, list(relevant_actors)))
+    # Catches new mutes before the scraper has flagged them in the DB
+    mutes = await MUTES.load_if_stale(db)
+    actors = {did: care and did not in mutes for did, care in actors.items()}
 
     def user_exists(did: str) -> Literal['do-care', 'dont-care', 'not-here']:
         r = actors.get(did)
@@ -246,11 +280,7 @@ async def operations_callback(db: Database, ops: OpsByType) -> None:
         except AttributeError:
             continue
 
-        labels = (
-            []
-            if not isinstance(record.labels, models.ComAtprotoLabelDefs.SelfLabels)
-            else [i.val for i in record.labels.values]
-        )
+        labels = get_labels(record)
 
         # we must care about SOMETHING going on
         care_about_something_here = (
@@ -294,33 +324,17 @@ async def operations_callback(db: Database, ops: OpsByType) -> None:
         if not can_store_immediately:
             unknown_things_to_queue.append((created_post['uri'], 'post'))
         else:
+            post_dict = created_post_row(created_post)
+            if post_dict is None:
+                continue
             inlined_text = record.text.replace("\n", " ")
-            num_with_alt_text, image_urls = get_images(author_did, record.embed)
             logger.info(
-                f"New furry post (is: {embed_uri is not None}, reply: {reply_root is not None}, images: {len(image_urls)}, labels: {labels}): {inlined_text}"
+                f"New furry post (is: {embed_uri is not None}, reply: {reply_root is not None}, images: {post_dict['media_count']}, labels: {labels}): {inlined_text}"
             )
-            post_dict: PostCreateWithoutRelationsInput = {
-                "uri": created_post["uri"],
-                "cid": created_post["cid"],
-                "reply_parent": reply_parent,
-                "reply_root": reply_root,
-                "authorId": created_post["author"],
-                "text": record.text,
-                "mentions_fursuit": mentions_fursuit(record.text),
-                "media_count": len(image_urls),
-                "media_with_alt_text_count": num_with_alt_text,
-                "m0": image_urls.get(0, None),
-                "m1": image_urls.get(1, None),
-                "m2": image_urls.get(2, None),
-                "m3": image_urls.get(3, None),
-                "labels": labels,
-                "embed_uri": embed_uri,
-                "embed_cid": embed_cid,
-            }
             posts_to_create.append(post_dict)
 
     if posts_to_create:
-        await db.post.create_many(posts_to_create, skip_duplicates=True)
+        await ingest_firehose_posts(db, posts_to_create)
 
     posts_to_delete = [p["uri"] for p in ops["posts"]["deleted"]]
     if posts_to_delete:
@@ -332,7 +346,7 @@ async def operations_callback(db: Database, ops: OpsByType) -> None:
         if deleted_rows:
             logger.info(f"Deleted from feed: {deleted_rows}")
 
-    likes_to_create: List[LikeCreateWithoutRelationsInput] = []
+    likes_to_create: List[LikeRow] = []
 
     for like in ops["likes"]["created"]:
         uri = like["record"]["subject"]["uri"]
@@ -391,16 +405,16 @@ async def operations_callback(db: Database, ops: OpsByType) -> None:
         # print('Unknown', len(unknown_things_to_queue))
         # cprint('Unknown things', 'red', force_color=True)
         # print(unknown_things_to_queue)
-        await db.unknownthing.create_many(
+        await ingest_unknown_things(
+            db,
             [
                 {'identifier': i, 'kind': k}
                 for i, k in unknown_things_to_queue
             ],
-            skip_duplicates=True
         )
 
     if likes_to_create:
         # print('Likes', len(likes_to_create))
-        await db.like.create_many(data=likes_to_create, skip_duplicates=True)
+        await ingest_firehose_likes(db, likes_to_create)
 
     # TODO: Handle deleted likes lmao
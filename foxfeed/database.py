@@ -1,12 +1,18 @@
+import asyncio
 import prisma
 import prisma.actions
 from prisma.types import HttpConfig, DatasourceOverride, ActorWhereInput
 import psycopg.conninfo
+from psycopg.abc import Query, Params
+from psycopg.rows import AsyncRowFactory
+from psycopg_pool import AsyncConnectionPool
 from pydantic import BaseModel
-from typing import Optional, List, Callable, Any
+from typing import Optional, List, Callable, Any, Dict, Tuple, Literal, AsyncContextManager, Iterable, TypeVar
+from contextvars import ContextVar
 from datetime import datetime
 import psycopg
 from dataclasses import dataclass
+from foxfeed.instrumentation import REGISTRY, with_db_timing, timed
 
 
 Post = prisma.models.Post
@@ -15,6 +21,122 @@ Actor = prisma.models.Actor
 PostScore = prisma.models.PostScore
 
 
+R = TypeVar('R')
+
+
+# Each part of the system gets its own set of raw connections so that one of them can't starve the others
+Subsystem = Literal['firehose', 'scoring', 'web', 'scraper', 'background']
+
+
+@dataclass
+class PoolLimits:
+    min_size: int
+    max_size: int
+
+
+POOL_LIMITS: Dict[Subsystem, PoolLimits] = {
+    'firehose': PoolLimits(min_size=1, max_size=4),
+    'scoring': PoolLimits(min_size=0, max_size=2),
+    'web': PoolLimits(min_size=1, max_size=4),
+    'scraper': PoolLimits(min_size=0, max_size=4),
+    'background': PoolLimits(min_size=0, max_size=2),
+}
+
+
+# Services set this when they start, anything that doesn't (i.e. web requests) uses the web pool
+current_subsystem: ContextVar[Subsystem] = ContextVar('current_subsystem', default='web')
+
+
+class PgPools:
+
+    def __init__(self, url: str, limits: Dict[Subsystem, PoolLimits] = POOL_LIMITS, timeout: float = 30):
+        self.pools: Dict[Subsystem, 'AsyncConnectionPool[psycopg.AsyncConnection[Tuple[Any, ...]]]'] = {
+            name: AsyncConnectionPool(
+                url,
+                min_size=limit.min_size,
+                max_size=limit.max_size,
+                name=f'foxfeed-{name}',
+                timeout=timeout,
+                # Make sure a connection still works before handing it out
+                check=AsyncConnectionPool.check_connection,
+                # Prisma stores everything as UTC, so make sure timestamps get compared the same way
+                kwargs={'options': '-c TimeZone=UTC'},
+                open=False,
+            )
+            for name, limit in limits.items()
+        }
+
+    async def open(self) -> None:
+        await asyncio.gather(*[i.open() for i in self.pools.values()])
+
+    async def close(self) -> None:
+        await asyncio.gather(*[i.close() for i in self.pools.values()])
+
+    def pool(self, subsystem: Optional[Subsystem] = None) -> 'AsyncConnectionPool[psycopg.AsyncConnection[Tuple[Any, ...]]]':
+        return self.pools[subsystem or current_subsystem.get()]
+
+    def connection(self, subsystem: Optional[Subsystem] = None) -> AsyncContextManager['psycopg.AsyncConnection[Tuple[Any, ...]]']:
+        # Commits at the end of the block (or rolls back if there was an exception)
+        return self.pool(subsystem).connection()
+
+    async def execute(self, query: Query, params: Optional[Params] = None, *, subsystem: Optional[Subsystem] = None) -> int:
+        async with self.connection(subsystem) as conn:
+            cur = await conn.execute(query, params)
+            return cur.rowcount
+
+    async def fetchall(self, query: Query, params: Optional[Params] = None, *, subsystem: Optional[Subsystem] = None) -> List[Tuple[Any, ...]]:
+        async with self.connection(subsystem) as conn:
+            cur = await conn.execute(query, params)
+            return await cur.fetchall()
+
+    async def fetchone(self, query: Query, params: Optional[Params] = None, *, subsystem: Optional[Subsystem] = None) -> Optional[Tuple[Any, ...]]:
+        async with self.connection(subsystem) as conn:
+            cur = await conn.execute(query, params)
+            return await cur.fetchone()
+
+    async def fetchdicts(self, query: Query, params: Optional[Params] = None, *, subsystem: Optional[Subsystem] = None) -> List[Dict[str, Any]]:
+        async with self.connection(subsystem) as conn:
+            cur = await conn.execute(query, params)
+            rows = await cur.fetchall()
+            if cur.description is None:
+                return []
+            names = [i.name for i in cur.description]
+            return [dict(zip(names, r)) for r in rows]
+
+    async def fetchrows(
+        self,
+        row_factory: 'AsyncRowFactory[R]',
+        query: Query,
+        params: Optional[Params] = None,
+        *,
+        prepare: Optional[bool] = None,
+        subsystem: Optional[Subsystem] = None,
+    ) -> List[R]:
+        async with self.connection(subsystem) as conn:
+            cur = conn.cursor(row_factory=row_factory)
+            await cur.execute(query, params, prepare=prepare)
+            return await cur.fetchall()
+
+    async def executemany(self, query: Query, params_seq: Iterable[Params], *, subsystem: Optional[Subsystem] = None) -> int:
+        # psycopg pipelines these and prepares the statement, so it's one round trip for the whole batch
+        async with self.connection(subsystem) as conn:
+            cur = conn.cursor()
+            await cur.executemany(query, params_seq)
+            return cur.rowcount
+
+    def report_stats(self) -> None:
+        for name, pool in self.pools.items():
+            stats = pool.get_stats()
+            pg_pool_size.set(stats.get('pool_size', 0), subsystem=name)
+            pg_pool_available.set(stats.get('pool_available', 0), subsystem=name)
+            pg_pool_waiting.set(stats.get('requests_waiting', 0), subsystem=name)
+
+
+pg_pool_size = REGISTRY.gauge('foxfeed_pg_pool_size', 'Number of connections in each raw postgres pool')
+pg_pool_available = REGISTRY.gauge('foxfeed_pg_pool_available', 'Number of idle connections in each raw postgres pool')
+pg_pool_waiting = REGISTRY.gauge('foxfeed_pg_pool_waiting', 'Number of callers waiting on each raw postgres pool')
+
+
 @dataclass
 class Database:
     subscriptionstate: 'prisma.actions.SubscriptionStateActions[prisma.models.SubscriptionState]'
@@ -26,12 +148,13 @@ class Database:
     postscore: 'prisma.actions.PostScoreActions[prisma.models.PostScore]'
     servedblock: 'prisma.actions.ServedBlockActions[prisma.models.ServedBlock]'
     servedpost: 'prisma.actions.ServedPostActions[prisma.models.ServedPost]'
+    feedmetricsrollup: 'prisma.actions.FeedMetricsRollupActions[prisma.models.FeedMetricsRollup]'
     experimentresult: 'prisma.actions.ExperimentResultActions[prisma.models.ExperimentResult]'
     scheduledpost: 'prisma.actions.ScheduledPostActions[prisma.models.ScheduledPost]'
     scheduledmedia: 'prisma.actions.ScheduledMediaActions[prisma.models.ScheduledMedia]'
     mediablob: 'prisma.actions.MediaBlobActions[prisma.models.MediaBlob]'
     query_raw: Callable[[Any], Any]
-    pg: psycopg.AsyncConnection
+    pg: PgPools
 
 
 async def make_database_connection(
@@ -45,24 +168,28 @@ async def make_database_connection(
     )
     await db.connect()
     assert url is not None
-    pg = await psycopg.AsyncConnection.connect(url)
+    pg = PgPools(url, timeout=timeout)
+    await pg.open()
+    REGISTRY.add_collector(pg.report_stats)
 
+    # Everything goes through with_db_timing so web requests can report how long they spent waiting on the DB
     return Database(
-        subscriptionstate = db.subscriptionstate,
-        blueskyclientsession = db.blueskyclientsession,
-        actor = db.actor,
-        post = db.post,
-        like = db.like,
-        unknownthing = db.unknownthing,
-        postscore = db.postscore,
-        servedblock = db.servedblock,
-        servedpost = db.servedpost,
-        experimentresult = db.experimentresult,
-        scheduledpost = db.scheduledpost,
-        scheduledmedia = db.scheduledmedia,
-        mediablob = db.mediablob,
-        query_raw = db.query_raw,
-        pg = pg,
+        subscriptionstate = with_db_timing(db.subscriptionstate),
+        blueskyclientsession = with_db_timing(db.blueskyclientsession),
+        actor = with_db_timing(db.actor),
+        post = with_db_timing(db.post),
+        like = with_db_timing(db.like),
+        unknownthing = with_db_timing(db.unknownthing),
+        postscore = with_db_timing(db.postscore),
+        servedblock = with_db_timing(db.servedblock),
+        servedpost = with_db_timing(db.servedpost),
+        feedmetricsrollup = with_db_timing(db.feedmetricsrollup),
+        experimentresult = with_db_timing(db.experimentresult),
+        scheduledpost = with_db_timing(db.scheduledpost),
+        scheduledmedia = with_db_timing(db.scheduledmedia),
+        mediablob = with_db_timing(db.mediablob),
+        query_raw = timed(db.query_raw),
+        pg = with_db_timing(pg),
     )
 
 
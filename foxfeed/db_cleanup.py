@@ -1,54 +1,183 @@
 import sys
+import time
 import asyncio
+import traceback
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from psycopg import sql
 from foxfeed.database import make_database_connection, Database
 from foxfeed.algos.generators import LOOKBACK_HARD_LIMIT
-from foxfeed.metrics import METRICS_MAXIMUM_LOOKBACK
-from prisma.bases import _PrismaModel
+from foxfeed.metrics import METRICS_MAXIMUM_LOOKBACK, ROLLUP_RETENTION
+from foxfeed.partitions import PARTITIONED_TABLES, ensure_partitions, drop_partitions_before
+from foxfeed.instrumentation import REGISTRY
+from foxfeed.algos.score_task import scoring_round_duration
+from foxfeed.util import sleep_on
+from termcolor import cprint
 
-from typing import Awaitable, Protocol, Callable, TypeVar, Generic, Optional, List
+from typing import Awaitable, Dict, Literal, Optional
 
 
 POST_MAX_AGE = timedelta(days=30)
 
 
-T = TypeVar('T')
-Where = TypeVar('Where', contravariant=True)
-WhereUnique = TypeVar('WhereUnique', contravariant=True)
-
-Model = TypeVar('Model', bound=_PrismaModel)
-ModelCo = TypeVar('ModelCo', bound=_PrismaModel, covariant=True)
-
-
-class FindMany(Protocol, Generic[Where, Model]):
-    async def __call__(
+OUTSIDE_MAIN_CLUSTER = '''(
+    a.is_external_to_network
+    OR a.manual_include_in_fox_feed IS FALSE
+    OR a.flagged_for_manual_review
+    OR a.is_muted
+)'''
+
+
+cleanup_rows = REGISTRY.counter(
+    'foxfeed_cleanup_rows_total',
+    'Rows deleted by the database cleanup, per table',
+)
+cleanup_seconds = REGISTRY.counter(
+    'foxfeed_cleanup_seconds_total',
+    'Time spent running cleanup deletes, per table',
+)
+cleanup_batch_size = REGISTRY.gauge(
+    'foxfeed_cleanup_batch_size',
+    'Current number of rows per cleanup delete, per table',
+)
+throttle_load = REGISTRY.gauge(
+    'foxfeed_throttle_load',
+    'How busy each throttled background task thinks the system is, 0 (idle) to 3 (overloaded, task paused)',
+)
+
+
+@dataclass
+class BatchedDelete:
+    description: str
+    table: str
+    # Selects the ctids of rows to delete, gets %(cutoff)s and %(limit)s
+    candidates: str
+    cutoff: datetime
+
+
+class BatchSizer:
+    """Picks how many rows to delete at once, aiming for each delete to hold its locks for about the target time"""
+
+    def __init__(
         self,
-        take: Optional[int] = None,
-        skip: None = None,
-        where: Optional[Where] = None,
-        cursor: None = None,
-        include: None = None,
-        order: None = None,
-        distinct: None = None,
-    ) -> List[Model]: ...
-
-
-class DeleteMany(Protocol, Generic[Where]):
-    async def __call__(self, where: Where) -> int: ...
-
-
-class Delete(Protocol, Generic[WhereUnique, ModelCo]):
-    async def __call__(self, where: WhereUnique, include: None = None) -> Optional[ModelCo]: ...
-
-
-class Table(Protocol, Generic[Where, WhereUnique, Model]):
-    @property
-    def find_many(self) -> FindMany[Where, Model]: ...
-    @property
-    def delete_many(self) -> DeleteMany[Where]: ...
-    @property
-    def delete(self) -> Delete[WhereUnique, Model]: ...
-
+        initial: int = 1 << 12,
+        target_seconds: float = 0.5,
+        minimum: int = 1 << 8,
+        maximum: int = 1 << 16,
+    ):
+        self.size = initial
+        self.target_seconds = target_seconds
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def update(self, rows: int, seconds: float) -> None:
+        if rows < self.size or seconds <= 0:
+            # Ran out of rows, so the timing doesn't say much about a full batch
+            return
+        # Move towards the target, but not too far in one go since individual timings are noisy
+        ratio = min(2.0, max(0.5, self.target_seconds / seconds))
+        self.size = int(min(self.maximum, max(self.minimum, self.size * ratio)))
+
+
+Load = Literal['idle', 'normal', 'busy', 'overloaded']
+
+
+@dataclass
+class LoadThresholds:
+    # Firehose lag, from the cursor it saves, so this works from any process
+    firehose_busy: timedelta = timedelta(minutes=2)
+    firehose_overloaded: timedelta = timedelta(minutes=10)
+    firehose_idle: timedelta = timedelta(seconds=30)
+    # The firehose saves its cursor every couple of thousand commits, if it hasn't in this long then it's stopped or
+    # stuck and the last lag it saved doesn't mean anything
+    firehose_stale: timedelta = timedelta(minutes=5)
+    # Duration of the last scoring round
+    scoring_busy: timedelta = timedelta(minutes=5)
+    scoring_overloaded: timedelta = timedelta(minutes=15)
+    scoring_idle: timedelta = timedelta(minutes=2)
+
+
+async def firehose_lag(db: Database, thresholds: LoadThresholds) -> Optional[timedelta]:
+    """How far behind the firehose was when it last saved its cursor, or None if that was too long ago to go by"""
+    row = await db.pg.fetchone(
+        '''
+        SELECT EXTRACT(EPOCH FROM updated_at - commit_time), EXTRACT(EPOCH FROM now() AT TIME ZONE 'UTC' - updated_at)
+        FROM "SubscriptionState" WHERE updated_at IS NOT NULL
+        ORDER BY updated_at DESC LIMIT 1
+        ''',
+        subsystem='background',
+    )
+    if row is None or timedelta(seconds=float(row[1])) > thresholds.firehose_stale:
+        return None
+    return timedelta(seconds=float(row[0]))
+
+
+def current_load(thresholds: LoadThresholds, lag_t: Optional[timedelta]) -> Load:
+    scoring = scoring_round_duration.get()
+    scoring_t = None if scoring is None else timedelta(seconds=scoring)
+    if (lag_t is not None and lag_t > thresholds.firehose_overloaded) or (
+        scoring_t is not None and scoring_t > thresholds.scoring_overloaded
+    ):
+        return 'overloaded'
+    if (lag_t is not None and lag_t > thresholds.firehose_busy) or (
+        scoring_t is not None and scoring_t > thresholds.scoring_busy
+    ):
+        return 'busy'
+    if (lag_t is None or lag_t < thresholds.firehose_idle) and (
+        scoring_t is None or scoring_t < thresholds.scoring_idle
+    ):
+        return 'idle'
+    return 'normal'
+
+
+# After each batch, sleep this many times as long as the batch took, so cleanup only gets a share of the database
+LOAD_SLEEP_RATIO: Dict[Load, float] = {
+    'idle': 0,
+    'normal': 1,
+    'busy': 4,
+}
+
+# How long a cleanup round is allowed to run for
+LOAD_ROUND_BUDGET: Dict[Load, timedelta] = {
+    'idle': timedelta(minutes=10),
+    'normal': timedelta(minutes=1),
+    'busy': timedelta(seconds=20),
+    'overloaded': timedelta(seconds=0),
+}
+
+
+class Throttle:
+    """Keeps a background task (cleanup, relabelling) out of the way of the firehose and the scoring task"""
+
+    def __init__(
+        self,
+        db: Database,
+        shutdown_event: asyncio.Event,
+        name: str,
+        thresholds: LoadThresholds = LoadThresholds(),
+    ):
+        self.db = db
+        self.shutdown_event = shutdown_event
+        self.name = name
+        self.thresholds = thresholds
+
+    async def load(self) -> Load:
+        load = current_load(self.thresholds, await firehose_lag(self.db, self.thresholds))
+        throttle_load.set(['idle', 'normal', 'busy', 'overloaded'].index(load), task=self.name)
+        return load
+
+    async def after_batch(self, seconds: float) -> bool:
+        """Waits until it's ok to run another batch, returns False if we should stop instead"""
+        while True:
+            if self.shutdown_event.is_set():
+                return False
+            load = await self.load()
+            if load != 'overloaded':
+                break
+            print(f'> system is overloaded, pausing {self.name}')
+            await sleep_on(self.shutdown_event, 30)
+        await sleep_on(self.shutdown_event, seconds * LOAD_SLEEP_RATIO[load])
+        return not self.shutdown_event.is_set()
 
 
 async def drop(description: str, f: Awaitable[int]) -> int:
@@ -61,35 +190,39 @@ async def drop(description: str, f: Awaitable[int]) -> int:
     return num_rows
 
 
-async def drop_limited(
-        end_at: datetime,
-        description: str,
-        table: Table[Where, WhereUnique, Model],
-        condition: Where,
-        get_id: Callable[[Model], Where]
-    ) -> int:
-    CHUNK_SIZE = 1 << 12
+def _batched_delete_query(d: BatchedDelete) -> sql.Composable:
+    # Everything happens on the server, the rows never get sent back to us
+    return sql.SQL('DELETE FROM {table} WHERE ctid = ANY(ARRAY({candidates}))').format(
+        table=sql.Identifier(d.table),
+        candidates=sql.SQL(d.candidates),  # type: ignore
+    )
+
+
+async def drop_batched(end_at: datetime, db: Database, d: BatchedDelete, sizer: BatchSizer, throttle: Throttle) -> int:
+    query = _batched_delete_query(d)
     total_deleted = 0
-    while True:
-        start = datetime.utcnow()
-        if start > end_at:
-            break
-        print(description)
-        found: List[Model] = await table.find_many(where=condition, take=CHUNK_SIZE)
-        total_deleted += len(found)
-        wheres: List[Where] = [get_id(i) for i in found]
-        await table.delete_many(where={'OR': wheres})
-        # for i in found:
-        #     await table.delete(where=get_id(i))
-        end = datetime.utcnow()
-        seconds = (end - start).total_seconds()
-        print(f'> dropped {len(found)} rows in {seconds:.1f} seconds')
-        if len(found) < CHUNK_SIZE:
+    total_seconds = 0.0
+    print(d.description)
+    while datetime.utcnow() < end_at:
+        limit = sizer.size
+        start = time.perf_counter()
+        deleted = await db.pg.execute(query, {'cutoff': d.cutoff, 'limit': limit}, subsystem='background')
+        seconds = time.perf_counter() - start
+        sizer.update(deleted, seconds)
+        total_deleted += deleted
+        total_seconds += seconds
+        cleanup_rows.inc(deleted, table=d.table)
+        cleanup_seconds.inc(seconds, table=d.table)
+        cleanup_batch_size.set(sizer.size, table=d.table)
+        print(f'> dropped {deleted} rows in {seconds:.1f} seconds (batch of {limit}, next {sizer.size})')
+        if deleted < limit or not await throttle.after_batch(seconds):
             break
+    if total_seconds > 0:
+        print(f'> {d.table}: {total_deleted} rows at {total_deleted / total_seconds:.0f} rows/s')
     return total_deleted
 
 
-async def delete_things(now: datetime, end_at: datetime, db: Database) -> int:
+async def delete_things(now: datetime, end_at: datetime, db: Database, sizers: Dict[str, BatchSizer], throttle: Throttle) -> int:
     deleted = 0 # did delete something
 
     postscore_max_version = await db.postscore.find_first(order={'version': 'desc'})
@@ -99,6 +232,11 @@ async def delete_things(now: datetime, end_at: datetime, db: Database) -> int:
             db.postscore.delete_many(where={'version': {'not': postscore_max_version.version}})
         )
 
+    await ensure_partitions(db, now)
+    for t in PARTITIONED_TABLES:
+        # Whole days at a time, the delete below then only has to deal with part of the oldest day
+        deleted += await drop_partitions_before(db, t, now - METRICS_MAXIMUM_LOOKBACK)
+
     deleted += await drop(
         'Deleting servedblocks',
         db.servedblock.delete_many(where={'when': {'lt': now - METRICS_MAXIMUM_LOOKBACK}})
@@ -109,84 +247,85 @@ async def delete_things(now: datetime, end_at: datetime, db: Database) -> int:
         db.servedpost.delete_many(where={'when': {'lt': now - METRICS_MAXIMUM_LOOKBACK}})
     )
 
+    deleted += await drop(
+        'Deleting feedmetricsrollups',
+        db.feedmetricsrollup.delete_many(where={'hour': {'lt': now - ROLLUP_RETENTION}})
+    )
+
     deleted += await drop(
         'Deleting blueskyclientsessions',
         db.blueskyclientsession.delete_many(where={'created_at': {'lt': now - timedelta(days=7)}})
     )
 
     # Can't do this while we're trying to complete our graph trees
-    deleted += await drop_limited(
-        end_at,
+    deleted += await drop_batched(end_at, db, BatchedDelete(
         'Deleting old likes',
-        db.like,
-        {'created_at': {'lt': now - POST_MAX_AGE}},
-        lambda x: {'uri': x.uri},
-    )
+        'Like',
+        'SELECT ctid FROM "Like" WHERE created_at < %(cutoff)s LIMIT %(limit)s',
+        now - POST_MAX_AGE,
+    ), sizers['Like'], throttle)
 
-    deleted += await drop_limited(
-        end_at,
+    deleted += await drop_batched(end_at, db, BatchedDelete(
         'Deleting old posts',
-        db.post,
-        {'indexed_at': {'lt': now - POST_MAX_AGE}},
-        lambda x: {'uri': x.uri}
-    )
+        'Post',
+        'SELECT ctid FROM "Post" WHERE indexed_at < %(cutoff)s LIMIT %(limit)s',
+        now - POST_MAX_AGE,
+    ), sizers['Post'], throttle)
 
-    deleted += await drop_limited(
-        end_at,
+    deleted += await drop_batched(end_at, db, BatchedDelete(
         'Deleting old likes from accounts outside the main cluster',
-        db.like,
-        {
-            'created_at': {'lt': now - LOOKBACK_HARD_LIMIT * 2},
-            'liker': {
-                'is': {
-                    'OR': [
-                        {'is_external_to_network': True},
-                        {'manual_include_in_fox_feed': False},
-                        {'flagged_for_manual_review': True},
-                        {'is_muted': True},
-                    ]
-                }
-            }
-        },
-        lambda x: {'uri': x.uri},
-    )
-
-    deleted += await drop_limited(
-        end_at,
+        'Like',
+        f'''
+        SELECT l.ctid FROM "Like" AS l
+        JOIN "Actor" AS a ON a.did = l.liker_id
+        WHERE l.created_at < %(cutoff)s AND {OUTSIDE_MAIN_CLUSTER}
+        LIMIT %(limit)s
+        ''',
+        now - LOOKBACK_HARD_LIMIT * 2,
+    ), sizers['Like'], throttle)
+
+    deleted += await drop_batched(end_at, db, BatchedDelete(
         'Deleting old posts from accounts outside the main cluster',
-        db.post,
-        {
-            'indexed_at': {'lt': now - LOOKBACK_HARD_LIMIT * 2},
-            'author': {
-                'is': {
-                    'OR': [
-                        {'is_external_to_network': True},
-                        {'manual_include_in_fox_feed': False},
-                        {'flagged_for_manual_review': True},
-                        {'is_muted': True},
-                    ]
-                }
-            },
-        },
-        lambda x: {'uri': x.uri},
-    )
+        'Post',
+        f'''
+        SELECT p.ctid FROM "Post" AS p
+        JOIN "Actor" AS a ON a.did = p."authorId"
+        WHERE p.indexed_at < %(cutoff)s AND {OUTSIDE_MAIN_CLUSTER}
+        LIMIT %(limit)s
+        ''',
+        now - LOOKBACK_HARD_LIMIT * 2,
+    ), sizers['Post'], throttle)
 
     return deleted
 
 
+async def cleanup_forever(db: Database, shutdown_event: asyncio.Event, forever: bool) -> None:
+    throttle = Throttle(db, shutdown_event, 'cleanup')
+    # Keep the batch sizes between rounds, they take a few batches to settle
+    sizers = {'Like': BatchSizer(), 'Post': BatchSizer()}
+    while not shutdown_event.is_set():
+        load = await throttle.load()
+        deleted = 0
+        if load == 'overloaded':
+            cprint('Skipping cleanup round, system is overloaded', 'yellow', force_color=True)
+        else:
+            try:
+                now = datetime.utcnow()
+                deleted = await delete_things(now, now + LOAD_ROUND_BUDGET[load], db, sizers, throttle)
+            except Exception:
+                cprint('Error during cleanup', color='red', force_color=True)
+                traceback.print_exc()
+        if not forever:
+            break
+        if deleted == 0 or load == 'overloaded':
+            await sleep_on(shutdown_event, 120)
+
+
 async def main(*, forever: bool):
     db = await make_database_connection(timeout=300)
-
     print('Cleaning up the database...')
-
-    while True:
-        now = datetime.utcnow()
-        end_at = now + timedelta(minutes=1)
-        deleted = await delete_things(now, end_at, db)
-        if not forever:
-            break
-        if deleted == 0:
-            await asyncio.sleep(120)
+    await cleanup_forever(db, asyncio.Event(), forever)
+    await db.pg.close()
 
 
 if __name__ == '__main__':
@@ -24,6 +24,7 @@ from termcolor import cprint
 from foxfeed.util import parse_datetime, Model, HasARecordModel
 from foxfeed.logger import logger
 from foxfeed.database import Database
+from foxfeed.instrumentation import REGISTRY
 
 import time
 
@@ -67,17 +68,91 @@ class OpsByType(TypedDict):
     follows: OpsPosts[models.AppBskyGraphFollow.Record]
 
 
+firehose_lag = REGISTRY.gauge(
+    "foxfeed_firehose_lag_seconds",
+    "How far behind the firehose the last processed commit was",
+)
+
+
 OPERATIONS_CALLBACK_TYPE = Callable[[Database, OpsByType], Coroutine[Any, Any, None]]
 
 
-def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> OpsByType:
-    operation_by_type: OpsByType = {
+def empty_ops() -> OpsByType:
+    return {
         "posts": {"created": [], "deleted": []},
         "reposts": {"created": [], "deleted": []},
         "likes": {"created": [], "deleted": []},
         "follows": {"created": [], "deleted": []},
     }
 
+
+def _is_collection(uri: AtUri, expected_type: HasARecordModel[Model]) -> bool:
+    return uri.collection == expected_type.Record.model_fields['py_type'].default
+
+
+def _check(uri: AtUri, r: Union[ModelBase, DotDict, None], expected_type: HasARecordModel[Model]) -> TypeGuard[Model]:
+    return _is_collection(uri, expected_type) and is_record_type(r, expected_type)
+
+
+def decode_record(raw: Any) -> Union[ModelBase, DotDict, None]:
+    record = None if raw is None else get_or_create(raw, strict=False)
+    if record is not None and not isinstance(record, (ModelBase, DotDict)):
+        return None
+    return record
+
+
+def add_created_op(
+    operation_by_type: OpsByType, uri: AtUri, cid: str, author: str, record: Union[ModelBase, DotDict, None]
+) -> None:
+    """Files a newly created record under the right type, shared by the firehose and repo backfills"""
+    if _check(uri, record, models.AppBskyFeedLike):
+        operation_by_type["likes"]["created"].append(
+            {
+                "uri": str(uri),
+                "cid": cid,
+                "author": author,
+                "record": record,
+            }
+        )
+    elif _check(uri, record, models.AppBskyFeedPost):
+        operation_by_type["posts"]["created"].append(
+            {
+                "uri": str(uri),
+                "cid": cid,
+                "author": author,
+                "record": record,
+            }
+        )
+    elif _check(uri, record, models.AppBskyGraphFollow):
+        operation_by_type["follows"]["created"].append(
+            {
+                "uri": str(uri),
+                "cid": cid,
+                "author": author,
+                "record": record,
+            }
+        )
+    # elif _check(uri, record, models.AppBskyFeedRepost):
+    #     pass
+    # elif _check(uri, record, models.AppBskyGraphBlock):
+    #     pass
+    # elif _check(uri, record, models.AppBskyGraphList):
+    #     pass
+    # elif _check(uri, record, models.AppBskyGraphListitem):
+    #     pass
+    # elif _check(uri, record, models.AppBskyGraphListblock):
+    #     pass
+    # elif _check(uri, record, models.AppBskyActorProfile):
+    #     pass
+    # elif _check(uri, record, models.AppBskyFeedGenerator):
+    #     pass
+    # else:
+    #     pass
+
+
+def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> OpsByType:
+    operation_by_type = empty_ops()
+
     assert isinstance(commit.blocks, bytes)
 
     car = CAR.from_bytes(commit.blocks)
@@ -85,26 +160,17 @@ def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> OpsB
         uri = AtUri.from_str(f"at://{commit.repo}/{op.path}")
 
         record_raw_data = None if op.cid is None else car.blocks.get(op.cid)
-        record = None if record_raw_data is None else get_or_create(record_raw_data, strict=False)
+        record = decode_record(record_raw_data)
 
-        if record is not None and not isinstance(record, (ModelBase, DotDict)):
+        if record_raw_data is not None and record is None:
             continue
 
-        def check(r: Union[ModelBase, DotDict, None], expected_type: HasARecordModel[Model]) -> TypeGuard[Model]:
-            return (
-                uri.collection == expected_type.Record.model_fields['py_type'].default
-                and is_record_type(r, expected_type)
-            )
-        
-        def check_delete(expected_type: HasARecordModel[Model]) -> bool:
-            return uri.collection == expected_type.Record.model_fields['py_type'].default
-
         if op.action == "update":
-            # if check(record, models.AppBskyActorProfile):
+            # if _check(uri, record, models.AppBskyActorProfile):
             #     pass
-            # elif check(record, models.AppBskyFeedGenerator):
+            # elif _check(uri, record, models.AppBskyFeedGenerator):
             #     pass
-            # elif check(record, models.AppBskyGraphList):
+            # elif _check(uri, record, models.AppBskyGraphList):
             #     pass
             # else:
             #     pass
@@ -113,64 +179,23 @@ def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> OpsB
         elif op.action == "create":
             if op.cid is None:
                 print('Create where op.cid is None, this is weird')
-            elif check(record, models.AppBskyFeedLike):
-                operation_by_type["likes"]["created"].append(
-                    {
-                        "uri": str(uri),
-                        "cid": str(op.cid),
-                        "author": commit.repo,
-                        "record": record,
-                    }
-                )
-            elif check(record, models.AppBskyFeedPost):
-                operation_by_type["posts"]["created"].append(
-                    {
-                        "uri": str(uri),
-                        "cid": str(op.cid),
-                        "author": commit.repo,
-                        "record": record,
-                    }
-                )
-            elif check(record, models.AppBskyGraphFollow):
-                operation_by_type["follows"]["created"].append(
-                    {
-                        "uri": str(uri),
-                        "cid": str(op.cid),
-                        "author": commit.repo,
-                        "record": record,
-                    }
-                )
-            # elif check(record, models.AppBskyFeedRepost):
-            #     pass
-            # elif check(record, models.AppBskyGraphBlock):
-            #     pass
-            # elif check(record, models.AppBskyGraphList):
-            #     pass
-            # elif check(record, models.AppBskyGraphListitem):
-            #     pass
-            # elif check(record, models.AppBskyGraphListblock):
-            #     pass
-            # elif check(record, models.AppBskyActorProfile):
-            #     pass
-            # elif check(record, models.AppBskyFeedGenerator):
-            #     pass
-            # else:
-            #     pass
+            else:
+                add_created_op(operation_by_type, uri, str(op.cid), commit.repo, record)
 
         elif op.action == "delete":
-            if check_delete(models.AppBskyFeedLike):
+            if _is_collection(uri, models.AppBskyFeedLike):
                 operation_by_type["likes"]["deleted"].append({"uri": str(uri)})
-            elif check_delete(models.AppBskyFeedPost):
+            elif _is_collection(uri, models.AppBskyFeedPost):
                 operation_by_type["posts"]["deleted"].append({"uri": str(uri)})
-            elif check_delete(models.AppBskyGraphFollow):
+            elif _is_collection(uri, models.AppBskyGraphFollow):
                 operation_by_type["follows"]["deleted"].append({"uri": str(uri)})
-            # elif check_delete(models.AppBskyFeedRepost):
+            # elif _is_collection(uri, models.AppBskyFeedRepost):
             #     pass
-            # elif check_delete(models.AppBskyGraphListitem):
+            # elif _is_collection(uri, models.AppBskyGraphListitem):
             #     pass
-            # elif check_delete(models.AppBskyGraphBlock):
+            # elif _is_collection(uri, models.AppBskyGraphBlock):
             #     pass
-            # elif check_delete(models.AppBskyGraphListblock):
+            # elif _is_collection(uri, models.AppBskyGraphListblock):
             #     pass
             # else:
             #     # cprint(f'Deleted something else idk {uri.collection}', 'red', force_color=True)
@@ -329,15 +354,17 @@ async def _run(
         message_count_time[0] = t
 
         client.update_params({'cursor': commit.seq})
+        stream_time = parse_datetime(commit.time)
+        now = datetime.now(timezone.utc)
         await db.subscriptionstate.upsert(
             where={'service': name},
             data={
-                'create': {'service': name, 'cursor': commit.seq},
-                'update': {'cursor': commit.seq},
+                'create': {'service': name, 'cursor': commit.seq, 'commit_time': stream_time, 'updated_at': now},
+                'update': {'cursor': commit.seq, 'commit_time': stream_time, 'updated_at': now},
             }
         )
-        stream_time = parse_datetime(commit.time)
-        lag = datetime.now(timezone.utc) - stream_time
+        lag = now - stream_time
+        firehose_lag.set(lag.total_seconds())
         lag_minutes = int(lag.total_seconds()) // 60
         stream_elapsed = 0 if prev_time[0] is None else (stream_time - prev_time[0]).seconds
         stream_rate = stream_elapsed / elapsed
@@ -1,25 +1,13 @@
 
-# This is kinda weird and really bad sorry
+# Generated by sql_codegen.py from the files in sql/, don't edit this by hand
 
 from datetime import datetime
 import foxfeed.database
-from typing import List, Union
+from psycopg.rows import class_row
+from typing import List, Optional, Sequence, TypedDict, Union
 
 Arg = Union[str, int, float, bool, datetime]
 
-def escape(a: Arg) -> str:
-    if isinstance(a, bool):
-        return 'TRUE' if a else 'FALSE'
-    if isinstance(a, str):
-        assert "'" not in a
-        return "'" + a + "'"
-    if isinstance(a, int):
-        return str(a)
-    if isinstance(a, float):
-        return str(a)
-    if isinstance(a, datetime):
-        return "'" + a.isoformat().split('.')[0] + "'::timestamp"
-
 score_posts_sql_query = """
 WITH "LikeCount" AS (
     -- Splitting this out seems to give performance improvements over doing the
@@ -29,13 +17,13 @@ WITH "LikeCount" AS (
         COUNT(*) AS count
     FROM "Like" as lk
     INNER JOIN "Actor" as liker ON lk.liker_id = liker.did
-    AND lk.created_at > ({current_time} - interval '96 hours')
-    AND lk.created_at < {current_time}
+    AND lk.created_at > (%(current_time)s - interval '96 hours')
+    AND lk.created_at < %(current_time)s
     AND NOT liker.is_muted
     AND liker.manual_include_in_fox_feed IS NOT FALSE
     AND liker.is_external_to_network IS FALSE
     AND (
-        {include_guy_votes}
+        %(include_guy_votes)s
         OR liker.manual_include_in_vix_feed IS TRUE
             OR (
                 liker.manual_include_in_vix_feed IS NOT FALSE
@@ -52,8 +40,8 @@ WITH "LikeCount" AS (
         post.indexed_at AS indexed_at,
         post.labels AS labels,
         (
-            EXTRACT(EPOCH FROM ({current_time} - post.indexed_at)) /
-            EXTRACT(EPOCH FROM interval {beta})
+            EXTRACT(EPOCH FROM (%(current_time)s - post.indexed_at)) /
+            EXTRACT(EPOCH FROM CAST(%(beta)s AS interval))
         ) AS x,
         (
             (CASE WHEN post.media_count > 0 AND post.media_with_alt_text_count = 0 THEN 0.7 ELSE 1.0 END)
@@ -76,15 +64,15 @@ WITH "LikeCount" AS (
     FROM "Post" as post
     INNER JOIN "Actor" as author on post."authorId" = author.did
     INNER JOIN "LikeCount" as like_count on post.uri = like_count.post_uri
-    WHERE post.indexed_at > ({current_time} - interval '96 hours')
-        AND post.indexed_at < {current_time}
+    WHERE post.indexed_at > (%(current_time)s - interval '96 hours')
+        AND post.indexed_at < %(current_time)s
         AND post.is_deleted IS FALSE
         AND post.reply_root IS NULL
         -- Pinned posts get mixed into the feed in a different way, so exclude them from scoring
         AND NOT post.is_pinned
         AND NOT author.is_muted
         AND author.manual_include_in_fox_feed IS NOT FALSE
-        AND author.is_external_to_network IS {external_posts}
+        AND author.is_external_to_network IS NOT DISTINCT FROM %(external_posts)s
 ), table2 AS (
     SELECT
         uri,
@@ -95,16 +83,16 @@ WITH "LikeCount" AS (
         labels,
         (
             (
-                CASE WHEN {do_time_decay}
-                THEN (CASE WHEN x > 1 THEN (1 / POWER(x, {alpha})) ELSE (2 - (1 / POWER((2 - x), {alpha}))) END)
+                CASE WHEN %(do_time_decay)s
+                THEN (CASE WHEN x > 1 THEN (1 / POWER(x, %(alpha)s)) ELSE (2 - (1 / POWER((2 - x), %(alpha)s))) END)
                 ELSE 1
                 END 
             )
             * multiplier
-            * (POWER(likes, {gamma}) + 2)
+            * (POWER(likes, %(gamma)s) + 2)
         ) AS score
     FROM table1 as post
-    WHERE {include_guy_posts} OR author_is_fem
+    WHERE %(include_guy_posts)s OR author_is_fem
     -- Not required but this seems to give performance improvements?
     ORDER BY author, score DESC
 ), table3 AS (
@@ -125,7 +113,7 @@ WITH "LikeCount" AS (
     FROM table2
 )
 
-SELECT * FROM table3 ORDER BY score DESC LIMIT {lmt};
+SELECT * FROM table3 ORDER BY score DESC LIMIT %(lmt)s;
 
 """
 
@@ -142,19 +130,22 @@ async def score_posts(
     include_guy_votes: Arg,
     lmt: Arg,
 ) -> List[foxfeed.database.ScorePostsOutputModel]:
-    query = score_posts_sql_query.format(
-        alpha = escape(alpha),
-        beta = escape(beta),
-        current_time = escape(current_time),
-        do_time_decay = escape(do_time_decay),
-        external_posts = escape(external_posts),
-        gamma = escape(gamma),
-        include_guy_posts = escape(include_guy_posts),
-        include_guy_votes = escape(include_guy_votes),
-        lmt = escape(lmt),
+    return await db.pg.fetchrows(
+        class_row(foxfeed.database.ScorePostsOutputModel),
+        score_posts_sql_query,
+        {
+            'alpha': alpha,
+            'beta': beta,
+            'current_time': current_time,
+            'do_time_decay': do_time_decay,
+            'external_posts': external_posts,
+            'gamma': gamma,
+            'include_guy_posts': include_guy_posts,
+            'include_guy_votes': include_guy_votes,
+            'lmt': lmt,
+        },
+        prepare=True,
     )
-    result = await db.query_raw(query, model=foxfeed.database.ScorePostsOutputModel) # type: ignore
-    return result
 
 score_by_interactions_sql_query = """
 WITH "ReplyCount" AS (
@@ -165,8 +156,8 @@ WITH "ReplyCount" AS (
     FROM "Post" as post
     INNER JOIN "Actor" as author on post."authorId" = author.did
       AND post.reply_root IS NOT NULL
-      AND post.indexed_at > ({current_time} - interval '20 hours')
-      AND post.indexed_at < {current_time}
+      AND post.indexed_at > (%(current_time)s - interval '20 hours')
+      AND post.indexed_at < %(current_time)s
       AND NOT author.is_muted
       AND author.manual_include_in_fox_feed IS NOT FALSE
     GROUP BY post.reply_root
@@ -178,8 +169,8 @@ WITH "ReplyCount" AS (
     FROM "Post" as post
     INNER JOIN "Actor" as author on post."authorId" = author.did
       AND post.embed_uri IS NOT NULL
-      AND post.indexed_at > ({current_time} - interval '20 hours')
-      AND post.indexed_at < {current_time}
+      AND post.indexed_at > (%(current_time)s - interval '20 hours')
+      AND post.indexed_at < %(current_time)s
       AND NOT author.is_muted
       AND author.manual_include_in_fox_feed IS NOT FALSE
     GROUP BY post.embed_uri
@@ -210,11 +201,14 @@ async def score_by_interactions(
     *,
     current_time: Arg,
 ) -> List[foxfeed.database.ScoreByInteractionOutputModel]:
-    query = score_by_interactions_sql_query.format(
-        current_time = escape(current_time),
+    return await db.pg.fetchrows(
+        class_row(foxfeed.database.ScoreByInteractionOutputModel),
+        score_by_interactions_sql_query,
+        {
+            'current_time': current_time,
+        },
+        prepare=True,
     )
-    result = await db.query_raw(query, model=foxfeed.database.ScoreByInteractionOutputModel) # type: ignore
-    return result
 
 find_unlinks_sql_query = """
 WITH t AS (
@@ -223,21 +217,21 @@ WITH t AS (
     LEFT OUTER JOIN "Post" as p2 ON p1.embed_uri = p2.uri
     LEFT OUTER JOIN "Actor" as author ON p1."authorId" = author.did
     WHERE p2.uri IS NULL
-      AND p1.embed_uri LIKE '%/app.bsky.feed.post/%'
+      AND p1.embed_uri LIKE '%%/app.bsky.feed.post/%%'
       AND author.is_external_to_network IS FALSE
     UNION SELECT p1.reply_root AS uri
     FROM "Post" as p1
     LEFT OUTER JOIN "Post" as p2 ON p1.reply_root = p2.uri
     LEFT OUTER JOIN "Actor" as author ON p1."authorId" = author.did
     WHERE p2.uri IS NULL
-      AND p1.reply_root LIKE '%/app.bsky.feed.post/%'
+      AND p1.reply_root LIKE '%%/app.bsky.feed.post/%%'
       AND author.is_external_to_network IS FALSE
     UNION SELECT p1.reply_parent AS uri
     FROM "Post" as p1
     LEFT OUTER JOIN "Post" as p2 ON p1.reply_parent = p2.uri
     LEFT OUTER JOIN "Actor" as author ON p1."authorId" = author.did
     WHERE p2.uri IS NULL
-      AND p1.reply_parent LIKE '%/app.bsky.feed.post/%'
+      AND p1.reply_parent LIKE '%%/app.bsky.feed.post/%%'
       AND author.is_external_to_network IS FALSE
 )
 
@@ -248,7 +242,28 @@ SELECT * FROM t LIMIT 1000;
 async def find_unlinks(
     db: foxfeed.database.Database,
 ) -> List[foxfeed.database.FindUnlinksOutputModel]:
-    query = find_unlinks_sql_query.format(
+    return await db.pg.fetchrows(
+        class_row(foxfeed.database.FindUnlinksOutputModel),
+        find_unlinks_sql_query,
+        {},
+        prepare=True,
     )
-    result = await db.query_raw(query, model=foxfeed.database.FindUnlinksOutputModel) # type: ignore
-    return result
+
+class InsertUnknownThingsRow(TypedDict):
+    kind: str
+    identifier: str
+
+insert_unknown_things_sql_query = """
+INSERT INTO "UnknownThing" (kind, identifier)
+VALUES (%(kind)s, %(identifier)s)
+ON CONFLICT DO NOTHING
+
+"""
+
+async def insert_unknown_things(
+    db: foxfeed.database.Database,
+    rows: Sequence[InsertUnknownThingsRow],
+) -> int:
+    if not rows:
+        return 0
+    return await db.pg.executemany(insert_unknown_things_sql_query, rows)
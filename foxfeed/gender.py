@@ -1,5 +1,6 @@
-from typing import List, Union
+from typing import Any, Dict, Iterable, List, Set
 from dataclasses import dataclass
+import hashlib
 import re
 import unicodedata
 
@@ -95,21 +96,84 @@ enby_vibes = Vibes(
 )
 
 
-def _test_vibes(vibes: Vibes, t: str) -> Union["re.Match[str]", str, None]:
-    for i in vibes.emoji:
-        if i in t:
-            return i
-    regex = r"\b(" + "|".join(vibes.words) + r")\b"
-    if m := re.search(regex, t):
-        return m
-    for i in vibes.regexes:
-        if m := re.search(i, t):
-            return m
-    return None
+def _trie_regex(words: List[str]) -> str:
+    """
+    One alternation for a whole word list, shaped like a trie so the regex engine never tries the same prefix
+    twice. she|her|hers|he|him comes out as (?:h(?:e(?:r(?:s|)|)|im)|she)
+    """
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
 
+    def build(node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if "" in node:
+            branches.append("")
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
 
-def vibecheck(text: str) -> VibeCheck:
-    t = (
+    return build(trie)
+
+
+class VibeMatcher:
+    """
+    Checks for all the vibes in one pass. Every word from every list goes into a single trie-shaped regex along with
+    the extra regexes, and whatever matched says which vibe it was. Emoji are just substring checks.
+    """
+
+    def __init__(self, vibes: Dict[str, Vibes]):
+        self.names = list(vibes)
+        self.emoji = [(i, name) for name, v in vibes.items() for i in v.emoji]
+        self.word_vibes: Dict[str, Set[str]] = {}
+        for name, v in vibes.items():
+            for word in v.words:
+                self.word_vibes.setdefault(word, set()).add(name)
+        self.regexes = [(re.compile(r), name) for name, v in vibes.items() for r in v.regexes]
+        # No capture groups to say which part matched, they stop the regex engine taking its fast paths and make
+        # the whole thing about twice as slow
+        self.regex = re.compile(
+            "|".join([r"\b" + _trie_regex(list(self.word_vibes)) + r"\b"] + [r.pattern for r, _ in self.regexes])
+        )
+
+    def _vibes_of(self, t: str, m: "re.Match[str]") -> Set[str]:
+        vibes = self.word_vibes.get(m.group())
+        if vibes is not None:
+            return vibes
+        for r, name in self.regexes:
+            if r.match(t, m.start()):
+                return {name}
+        return set()
+
+    def match(self, t: str) -> Set[str]:
+        found = {name for i, name in self.emoji if i in t}
+        if len(found) < len(self.names):
+            for m in self.regex.finditer(t):
+                found |= self._vibes_of(t, m)
+                if len(found) == len(self.names):
+                    break
+        return found
+
+
+_matcher = VibeMatcher({"fem": girl_vibes, "enby": enby_vibes, "masc": boy_vibes})
+
+# Bump this when _clean or the matcher start giving different answers for the same word lists
+RULESET_VERSION = 1
+
+
+def ruleset_hash(*vibes: Vibes) -> str:
+    return hashlib.sha1(repr((RULESET_VERSION, vibes)).encode("utf-8")).hexdigest()[:16]
+
+
+# Stored next to each actor's labels, so the ones labelled with old word lists can be found, see foxfeed.relabel
+RULESET = ruleset_hash(girl_vibes, enby_vibes, boy_vibes)
+
+
+def _clean(text: str) -> str:
+    return (
         unicodedata.normalize("NFKC", text)
         .replace("\n", " ")
         .replace("'", "")
@@ -119,8 +183,20 @@ def vibecheck(text: str) -> VibeCheck:
         .lower()
         .replace("f-list", " ")
     )
-    return VibeCheck(
-        fem=_test_vibes(girl_vibes, t) is not None,
-        enby=_test_vibes(enby_vibes, t) is not None,
-        masc=_test_vibes(boy_vibes, t) is not None,
-    )
+
+
+def vibecheck(text: str) -> VibeCheck:
+    found = _matcher.match(_clean(text))
+    return VibeCheck(fem="fem" in found, enby="enby" in found, masc="masc" in found)
+
+
+def vibecheck_many(texts: Iterable[str]) -> List[VibeCheck]:
+    """Same as vibecheck on each one, but lots of bios are empty or copied so each distinct one only gets checked once"""
+    cache: Dict[str, VibeCheck] = {}
+    results: List[VibeCheck] = []
+    for text in texts:
+        v = cache.get(text)
+        if v is None:
+            v = cache[text] = vibecheck(text)
+        results.append(v)
+    return results
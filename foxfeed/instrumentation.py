@@ -0,0 +1,270 @@
+import math
+import time
+from bisect import bisect_left
+from contextlib import AbstractAsyncContextManager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import inspect
+import psycopg
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar, cast
+
+
+T = TypeVar("T")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+SIZE_BUCKETS: Tuple[float, ...] = (
+    256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304
+)
+
+QUANTILES: Tuple[float, ...] = (0.5, 0.95, 0.99)
+
+
+def _labels(**kwargs: str) -> Labels:
+    return tuple(sorted(kwargs.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    everything = labels + extra
+    if not everything:
+        return ""
+    inner = ",".join(
+        k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in everything
+    )
+    return "{" + inner + "}"
+
+
+def _format_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    if v == int(v):
+        return str(int(v))
+    return repr(v)
+
+
+class Histogram:
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # The last slot is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Same linear interpolation as prometheus' histogram_quantile
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            if cumulative + c >= rank and c > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = 0.0 if i == 0 else self.buckets[i - 1]
+                upper = self.buckets[i]
+                return lower + (upper - lower) * ((rank - cumulative) / c)
+            cumulative += c
+        return self.buckets[-1]
+
+
+@dataclass
+class HistogramFamily:
+    name: str
+    help: str
+    buckets: Tuple[float, ...]
+    children: Dict[Labels, Histogram] = field(default_factory=dict)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(**labels)
+        h = self.children.get(key)
+        if h is None:
+            h = self.children[key] = Histogram(self.buckets)
+        h.observe(value)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, h in sorted(self.children.items()):
+            cumulative = 0
+            for upper, c in zip(list(h.buckets) + [math.inf], h.counts):
+                cumulative += c
+                yield f"{self.name}_bucket{_format_labels(labels, (('le', _format_value(upper)),))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(labels)} {_format_value(h.sum)}"
+            yield f"{self.name}_count{_format_labels(labels)} {h.count}"
+        # Precomputed quantiles so we can eyeball them without a prometheus server
+        yield f"# HELP {self.name}_quantile Estimated quantiles of {self.name}"
+        yield f"# TYPE {self.name}_quantile gauge"
+        for labels, h in sorted(self.children.items()):
+            for q in QUANTILES:
+                value = h.quantile(q)
+                if not math.isnan(value):
+                    yield f"{self.name}_quantile{_format_labels(labels, (('quantile', str(q)),))} {_format_value(value)}"
+
+
+@dataclass
+class CounterFamily:
+    name: str
+    help: str
+    children: Dict[Labels, float] = field(default_factory=dict)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(**labels)
+        self.children[key] = self.children.get(key, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, v in sorted(self.children.items()):
+            yield f"{self.name}{_format_labels(labels)} {_format_value(v)}"
+
+
+@dataclass
+class GaugeFamily:
+    name: str
+    help: str
+    children: Dict[Labels, float] = field(default_factory=dict)
+
+    def set(self, value: float, **labels: str) -> None:
+        self.children[_labels(**labels)] = value
+
+    def get(self, **labels: str) -> Optional[float]:
+        return self.children.get(_labels(**labels))
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, v in sorted(self.children.items()):
+            yield f"{self.name}{_format_labels(labels)} {_format_value(v)}"
+
+
+Family = Any  # HistogramFamily | CounterFamily | GaugeFamily
+
+
+class Registry:
+
+    def __init__(self):
+        self.families: Dict[str, Family] = {}
+        # Things that want to refresh their gauges right before we render
+        self.collectors: List[Callable[[], None]] = []
+
+    def _get_or_create(self, name: str, make: Callable[[], T]) -> T:
+        if name not in self.families:
+            self.families[name] = make()
+        return cast(T, self.families[name])
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> HistogramFamily:
+        return self._get_or_create(name, lambda: HistogramFamily(name, help, tuple(buckets)))
+
+    def counter(self, name: str, help: str) -> CounterFamily:
+        return self._get_or_create(name, lambda: CounterFamily(name, help))
+
+    def gauge(self, name: str, help: str) -> GaugeFamily:
+        return self._get_or_create(name, lambda: GaugeFamily(name, help))
+
+    def add_collector(self, f: Callable[[], None]) -> None:
+        self.collectors.append(f)
+
+    def render(self) -> str:
+        for f in self.collectors:
+            f()
+        lines = [line for _, family in sorted(self.families.items()) for line in family.render()]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class DbTimer:
+    """Accumulates the time spent waiting on the database within a single context (usually a web request)"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+
+
+current_db_timer: ContextVar[Optional[DbTimer]] = ContextVar("current_db_timer", default=None)
+
+
+# The query was already counted when it was executed, fetching the rows just adds to its time
+_CURSOR_FETCHES = {"fetchone", "fetchmany", "fetchall"}
+
+
+class _TimedProxy:
+    """
+    Times the async methods of whatever it wraps. Connections and cursors that come back out of it (from
+    PgPools.connection, conn.execute, conn.cursor, ...) get wrapped too, so queries made on them are timed as well.
+    """
+
+    def __init__(self, inner: Any):
+        self._inner = inner
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._inner, name)
+        if inspect.iscoroutinefunction(attr):
+            return timed(attr, count=not (isinstance(self._inner, psycopg.AsyncCursor) and name in _CURSOR_FETCHES))
+        if callable(attr):
+            def _wrapped(*args: Any, **kwargs: Any) -> Any:
+                return _timed_result(attr(*args, **kwargs))
+            return _wrapped
+        return attr
+
+    async def __aenter__(self) -> Any:
+        return _timed_result(await self._inner.__aenter__())
+
+    async def __aexit__(self, *exc: Any) -> Any:
+        return await self._inner.__aexit__(*exc)
+
+    def __aiter__(self) -> Any:
+        # Rows streaming in from a cursor aren't timed
+        return self._inner.__aiter__()
+
+
+class _TimedContext:
+
+    def __init__(self, inner: Any):
+        self._inner = inner
+
+    async def __aenter__(self) -> Any:
+        return _timed_result(await self._inner.__aenter__())
+
+    async def __aexit__(self, *exc: Any) -> Any:
+        return await self._inner.__aexit__(*exc)
+
+
+def _timed_result(value: Any) -> Any:
+    if isinstance(value, (psycopg.AsyncConnection, psycopg.AsyncCursor)):
+        return _TimedProxy(value)
+    if isinstance(value, AbstractAsyncContextManager):
+        return _TimedContext(value)
+    return value
+
+
+def timed(f: Callable[..., Any], count: bool = True) -> Callable[..., Any]:
+    async def _timed(*args: Any, **kwargs: Any) -> Any:
+        timer = current_db_timer.get()
+        if timer is None:
+            return _timed_result(await f(*args, **kwargs))
+        start = time.perf_counter()
+        try:
+            return _timed_result(await f(*args, **kwargs))
+        finally:
+            timer.seconds += time.perf_counter() - start
+            timer.queries += count
+    return _timed
+
+
+def with_db_timing(actions: T) -> T:
+    return cast(T, _TimedProxy(actions))
@@ -11,12 +11,8 @@ from foxfeed.bsky import (
     get_follows,
     get_feeds,
     get_likes,
-    get_mute_lists,
-    get_mutes,
-    get_list,
     get_specific_profiles,
     get_specific_posts,
-    get_specific_likes,
     as_detailed_profiles,
 )
 
@@ -24,6 +20,8 @@ import foxfeed.bsky
 
 from typing import (
     AsyncIterable,
+    Container,
+    Dict,
     Optional,
     Tuple,
     List,
@@ -33,6 +31,7 @@ from typing import (
     Type,
     Generic,
     TypeVar,
+    Sequence,
     Protocol,
 )
 
@@ -44,24 +43,33 @@ from atproto_client.models.app.bsky.actor.defs import (
 )
 from atproto_client.models.app.bsky.feed.defs import (
     FeedViewPost,
+    PostView,
     ReasonRepost,
 )
-from atproto_client.models.app.bsky.graph.defs import ListView
 from atproto_client.models.app.bsky.feed.get_likes import Like
 
 import gzip
+import hashlib
+import itertools
 import json
+import math
 import traceback
 from termcolor import cprint
 from dataclasses import dataclass
 
-import prisma.errors
-
 import foxfeed.algos.generators
-from foxfeed.gen.db import find_unlinks
-from foxfeed.util import parse_datetime, sleep_on, join_unless, wait_interruptable
-from foxfeed.store import store_like, store_post, store_post3, store_user
+from foxfeed import config
+from foxfeed.gen.db import find_unlinks, insert_unknown_things
+from foxfeed.util import parse_datetime, sleep_on, join_unless, wait_interruptable, groupby
+from foxfeed.store import store_user, scraped_actor_row, scraped_like_row, feed_view_post_row
+from foxfeed.bulk import ingest_scraped_actors, ingest_scraped_posts, ingest_scraped_likes
 from foxfeed.res import Res
+from foxfeed.instrumentation import REGISTRY
+from foxfeed.unknown_things import resolve_unknown_things
+from foxfeed.backfill import Backfill, fetch_backfill, store_backfills
+from foxfeed.checkpoint import Checkpoint, mark_done
+from foxfeed.bloom import BloomFilter
+from foxfeed.mutes import MUTES
 
 
 # TODO: Remove this somehow
@@ -72,6 +80,44 @@ Q = TypeVar('Q')
 T = TypeVar('T')
 
 
+@dataclass(frozen=True)
+class Shard:
+    index: int = 0
+    count: int = 1
+
+    def __contains__(self, did: str) -> bool:
+        # Not hash(), since that's randomised per process and every scraper needs to agree
+        digest = hashlib.sha1(did.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count == self.index
+
+    @staticmethod
+    def parse(s: str) -> 'Shard':
+        index, count = (int(i) for i in s.split('/'))
+        if not 0 <= index < count:
+            raise ValueError(f'Bad shard {s!r}, should be "index/count" with 0 <= index < count')
+        return Shard(index, count)
+
+
+@dataclass(frozen=True)
+class Skip:
+    """Accounts not worth looking up, because they've already been found or they belong to another shard"""
+    seen: Container[str]
+    shard: Shard
+
+    def __contains__(self, did: object) -> bool:
+        return isinstance(did, str) and (did in self.seen or did not in self.shard)
+
+
+@dataclass(frozen=True)
+class Workers:
+    posts: int = 4
+    likes: int = 4
+
+
+# Ties between posts with the same like count in the like queue, shared so post objects never get compared
+_like_queue_tiebreak = itertools.count()
+
+
 class AnyQueue(Protocol, Generic[T]):
     async def put(self, item: T) -> None: ...
     async def get(self) -> Optional[T]: ...
@@ -144,42 +190,6 @@ async def get_posts(
             yield i
 
 
-async def _get_all_mutes(
-    client: AsyncClient,
-    policy: foxfeed.bsky.Policy,
-) -> AsyncIterable[Tuple[Optional[ListView], ProfileView]]:
-    # Direct, manual mutes
-    async for i in get_mutes(client, policy):
-        yield (None, i)
-    # Mutes from a mute list
-    async for lst in get_mute_lists(client, policy):
-        async for i in get_list(client, lst.uri, policy):
-            yield (lst, i.subject)
-
-
-async def get_all_mutes(
-    client: AsyncClient,
-    *,
-    policy: foxfeed.bsky.Policy,
-) -> AsyncIterable[Tuple[Optional[ListView], ProfileView]]:
-    async for i, j in _get_all_mutes(client, policy):
-        # print('>', j.handle, j.display_name)
-        yield (i, j)
-        if policy.stop_event.is_set():
-            break
-
-
-async def get_mutes_across_clients(
-    clients: List[AsyncClient],
-    *,
-    policy: foxfeed.bsky.Policy
-) -> Set[str]:
-    return (
-        {i.did for c in clients async for _, i in get_all_mutes(c, policy=policy)}
-        - {c.me.did for c in clients if c.me is not None}
-    )
-
-
 async def no_connections(_client: AsyncClient, _did: str) -> AsyncIterable[ProfileView]:
     return
     yield
@@ -208,39 +218,140 @@ class StoreLike:
     like: Like
 
 
-StoreThing = Union[StoreUser, StorePost, StoreLike]
+@dataclass
+class StoreHighWaterMark:
+    did: str
+    newest_post_at: datetime
+
+
+@dataclass
+class StoreScrapeDone:
+    scrape: str
+    did: str
+
+
+@dataclass
+class StoreBackfill:
+    backfill: Backfill
+
+
+StoreThing = Union[StoreUser, StorePost, StoreLike, StoreHighWaterMark, StoreBackfill, StoreScrapeDone]
+
+
+# Bump this when the scraper starts storing something new about posts, so every actor gets one full lookback rescan
+SCRAPE_VERSION = 1
+
+
+async def load_high_water_marks(db: Database) -> Dict[str, datetime]:
+    """Newest post we've already stored for each actor, rescans don't need to go back any further than these"""
+    rows = await db.pg.fetchall(
+        '''
+        SELECT did, last_scraped_post_at FROM "Actor"
+        WHERE last_scraped_post_at IS NOT NULL AND rescan_version_number = %s
+        ''',
+        (SCRAPE_VERSION,),
+    )
+    return {did: at.replace(tzinfo=timezone.utc) for did, at in rows}
+
+
+# Upper limit on how many queued items get written together
+STORE_BATCH_SIZE = 500
+
+
+async def store_batch(db: Database, items: Sequence[Optional[StoreThing]]) -> None:
+    users = [
+        scraped_actor_row(
+            i.user,
+            is_muted=i.is_muted,
+            is_furrylist_verified=i.is_furrylist_verified,
+            flag_for_manual_review=False,
+            is_external_to_network=False,
+        )
+        for i in items
+        if isinstance(i, StoreUser)
+    ]
+    posts = [feed_view_post_row(i.post) for i in items if isinstance(i, StorePost)]
+    likes = [scraped_like_row(i.post_uri, i.like) for i in items if isinstance(i, StoreLike)]
+    backfills = [i.backfill for i in items if isinstance(i, StoreBackfill)]
+    marks = [
+        (i.newest_post_at, SCRAPE_VERSION, i.did)
+        for i in items
+        if isinstance(i, StoreHighWaterMark)
+    ]
+    # Users need to go in before their posts, and posts before their likes
+    await ingest_scraped_actors(db, users)
+    await ingest_scraped_posts(db, posts)
+    await ingest_scraped_likes(db, likes)
+    await store_backfills(db, backfills)
+    # Only once the posts are in, if this batch fails the next rescan needs to pick them up again
+    await db.pg.executemany(
+        '''
+        UPDATE "Actor" SET
+            last_scraped_post_at = LEAST(GREATEST(last_scraped_post_at, %s), now() AT TIME ZONE 'UTC'),
+            rescan_version_number = %s
+        WHERE did = %s
+        ''',
+        marks,
+    )
+    for scrape, dids in groupby(lambda i: i.scrape, [i for i in items if isinstance(i, StoreScrapeDone)]).items():
+        await mark_done(db, scrape, [i.did for i in dids])
+
+
+async def store_one_at_a_time(db: Database, items: Sequence[Optional[StoreThing]]) -> None:
+    """For when a batch fails, so one bad row doesn't lose everything else that came with it"""
+    failed = 0
+    # Queue order already has users ahead of their posts, and posts ahead of their likes
+    for item in items:
+        if isinstance(item, StoreHighWaterMark):
+            continue
+        try:
+            await store_batch(db, [item])
+        except Exception:
+            failed += 1
+            cprint(f"Error while storing a {type(item).__name__}", color="red", force_color=True)
+            traceback.print_exc()
+    # Can't tell whose posts went missing, so nobody's mark moves on and the next rescan picks them up again
+    if not failed:
+        await store_batch(db, [i for i in items if isinstance(i, StoreHighWaterMark)])
 
 
 async def store_to_db_task(
     shutdown_event: asyncio.Event, db: Database, q: AnyQueue[StoreThing]
 ):
     while not shutdown_event.is_set():
-        await asyncio.sleep(0.001)
-        item = await q.get()
+        first = await q.get()
+        items: List[Optional[StoreThing]] = [first]
+        # Grab whatever else has piled up while we were waiting on the last batch
+        while len(items) < STORE_BATCH_SIZE and q.qsize() > 0:
+            items.append(await q.get())
         try:
-            if isinstance(item, StoreUser):
-                await store_user(
-                    db,
-                    item.user,
-                    is_muted=item.is_muted,
-                    is_furrylist_verified=item.is_furrylist_verified,
-                    flag_for_manual_review=False,
-                    is_external_to_network=False,
-                )
-            elif isinstance(item, StorePost):
-                await store_post(db, item.post)
-            elif isinstance(item, StoreLike):
-                await store_like(db, item.post_uri, item.like)
+            try:
+                await store_batch(db, items)
+            except Exception:
+                if len(items) == 1:
+                    raise
+                cprint(f"Error while storing a batch of {len(items)} items, trying them one at a time", color="red", force_color=True)
+                traceback.print_exc()
+                await store_one_at_a_time(db, items)
         except asyncio.CancelledError:
             break
         except KeyboardInterrupt:
             break
         except Exception:
-            cprint(f"Error during handling item: {item}", color="red", force_color=True)
+            cprint(f"Error while storing a batch of {len(items)} items", color="red", force_color=True)
             traceback.print_exc()
             await asyncio.sleep(1)
         finally:
-            q.task_done()
+            for _ in items:
+                q.task_done()
+
+
+async def try_backfill(did: str, policy: foxfeed.bsky.Policy, after: datetime) -> Optional[Backfill]:
+    try:
+        return await fetch_backfill(did, policy, after)
+    except Exception as e:
+        cprint(f"Couldn't backfill {did} from their repo, using their feed instead: {e!r}", "yellow", force_color=True)
+        return None
 
 
 async def load_posts_task(
@@ -248,14 +359,16 @@ async def load_posts_task(
     client: AsyncClient,
     policy: foxfeed.bsky.Policy,
     only_posts_after: datetime,
+    high_water_marks: Dict[str, datetime],
     input_queue: AnyQueue[ProfileViewDetailed],
-    llq: AnyQueue[Tuple[int, int, FeedViewPost]],
+    llq: AnyQueue[Tuple[int, int, PostView]],
     output_queue: AnyQueue[StoreThing],
     *,
     actually_do_shit: bool = True,
+    backfill_new_actors: bool = False,
+    scrape: Optional[str] = None,
 ):
     cprint("Grabbing posts for furries...", "blue", force_color=True)
-    unique = 0
     while not shutdown_event.is_set():
         user = await input_queue.get()
         if user is None:
@@ -263,13 +376,38 @@ async def load_posts_task(
         try:
             if actually_do_shit:
                 # cprint(f'Getting posts for {user.handle}', 'blue', force_color=True)
-                async for post in get_posts(client, user.did, after=only_posts_after, policy=policy):
+                if backfill_new_actors and user.did not in high_water_marks:
+                    # One request for everything they've got, rather than paging through their feed
+                    backfill = await try_backfill(user.did, policy, only_posts_after)
+                    if backfill is not None and not policy.stop_event.is_set():
+                        await output_queue.put(StoreBackfill(backfill))
+                        # Repo records don't say how many likes they have, so the likes planner needs the AppView's
+                        # copy. Only top level posts, same as below.
+                        top_level = [i["uri"] for i in backfill.posts if i["reply_parent"] is None]
+                        async for post_view in get_specific_posts(client, top_level, policy):
+                            await llq.put((-(post_view.like_count or 0), next(_like_queue_tiebreak), post_view))
+                        # Even with nothing recent there's a mark, so they don't get their whole repo downloaded
+                        # again every rescan. The lookback cutoff is as far as we know they're done up to.
+                        mark = backfill.newest_post_at or only_posts_after
+                        await output_queue.put(StoreHighWaterMark(user.did, mark))
+                        if scrape is not None:
+                            await output_queue.put(StoreScrapeDone(scrape, user.did))
+                        continue
+                after = max(only_posts_after, high_water_marks.get(user.did, only_posts_after))
+                newest: Optional[datetime] = None
+                async for post in get_posts(client, user.did, after=after, policy=policy):
+                    indexed_at = parse_datetime(post.post.indexed_at)
+                    if newest is None or indexed_at > newest:
+                        newest = indexed_at
                     await output_queue.put(StorePost(post))
                     # Currently care about replies but aren't really fussed about likes on them TBH
                     if post.reply is None:
-                        await llq.put((-(post.post.like_count or 0), unique, post))
-                        # hack to prevent post objects being compared against each other
-                        unique += 1
+                        await llq.put((-(post.post.like_count or 0), next(_like_queue_tiebreak), post.post))
+                # Stopping early means older posts never got looked at, so the mark can't move yet
+                if newest is not None and not policy.stop_event.is_set():
+                    await output_queue.put(StoreHighWaterMark(user.did, newest))
+            if scrape is not None and not policy.stop_event.is_set():
+                await output_queue.put(StoreScrapeDone(scrape, user.did))
         except asyncio.CancelledError:
             break
         except KeyboardInterrupt:
@@ -286,12 +424,94 @@ async def load_posts_task(
             input_queue.task_done()
 
 
+# getLikes page sizes. The old loader always used the default, which is what savings get measured against.
+DEFAULT_LIKES_PAGE = 50
+MAX_LIKES_PAGE = 100
+# Missing likes aren't always the newest ones, so ask for a few more than the gap
+LIKES_PAGE_SLACK = 10
+
+
+likes_planner_calls = REGISTRY.counter(
+    "foxfeed_likes_planner_calls_total",
+    "getLikes calls the scraper made, and how many it skipped compared to fetching every like of every post",
+)
+likes_planner_posts = REGISTRY.counter(
+    "foxfeed_likes_planner_posts_total",
+    "Posts the likes planner looked at, by whether any of their likes were missing",
+)
+
+
+@dataclass
+class LikesPlannerStats:
+    posts_skipped: int = 0
+    posts_fetched: int = 0
+    calls_made: int = 0
+    calls_saved: int = 0
+
+    def record(self, calls: int, baseline: int) -> None:
+        if calls == 0:
+            self.posts_skipped += 1
+            likes_planner_posts.inc(result="complete")
+        else:
+            self.posts_fetched += 1
+            likes_planner_posts.inc(result="missing")
+        self.calls_made += calls
+        self.calls_saved += max(baseline - calls, 0)
+        likes_planner_calls.inc(calls, result="made")
+        likes_planner_calls.inc(max(baseline - calls, 0), result="saved")
+
+    def summary(self) -> str:
+        return (
+            f"Likes: {self.posts_fetched} posts fetched, {self.posts_skipped} already complete, "
+            f"{self.calls_made} calls made, {self.calls_saved} saved"
+        )
+
+
+async def load_missing_likes(
+    db: Database,
+    client: AsyncClient,
+    policy: foxfeed.bsky.Policy,
+    post: PostView,
+    output_queue: AnyQueue[StoreThing],
+    stats: LikesPlannerStats,
+) -> None:
+    """Fetches likes until we've found as many as the post's like count says we're missing"""
+    like_count = post.like_count or 0
+    baseline = max(1, math.ceil(like_count / DEFAULT_LIKES_PAGE))
+    have = {
+        did
+        for (did,) in await db.pg.fetchall('SELECT liker_id FROM "Like" WHERE post_uri = %s', (post.uri,))
+    }
+    gap = like_count - len(have)
+    if gap <= 0:
+        # The firehose already got all of them
+        stats.record(0, baseline)
+        return
+    page_size = min(MAX_LIKES_PAGE, gap + LIKES_PAGE_SLACK)
+    # Some of the gap is likes we'll never be able to store (unknown accounts, deleted likes), don't chase them forever
+    budget = math.ceil(gap / page_size) + 1
+    seen = 0
+    found = 0
+    async for like in get_likes(client, post.uri, policy, limit=page_size):
+        seen += 1
+        if like.actor.did not in have:
+            found += 1
+            await output_queue.put(StoreLike(post.uri, like))
+            if found >= gap:
+                break
+        if seen >= budget * page_size:
+            break
+    stats.record(max(1, math.ceil(seen / page_size)), baseline)
+
+
 async def load_likes_task(
     shutdown_event: asyncio.Event,
+    db: Database,
     client: AsyncClient,
     policy: foxfeed.bsky.Policy,
-    input_queue: AnyQueue[Tuple[int, int, FeedViewPost]],
+    input_queue: AnyQueue[Tuple[int, int, PostView]],
     output_queue: AnyQueue[StoreThing],
+    stats: LikesPlannerStats,
     *,
     actually_do_shit: bool = True,
 ):
@@ -303,15 +523,14 @@ async def load_likes_task(
         _, _, post = x
         try:
             if actually_do_shit:
-                async for like in get_likes(client, post.post.uri, policy):
-                    await output_queue.put(StoreLike(post.post.uri, like))
+                await load_missing_likes(db, client, policy, post, output_queue, stats)
         except asyncio.CancelledError:
             break
         except KeyboardInterrupt:
             break
         except Exception:
             cprint(
-                f"error while getting likes for post {post.post.uri}",
+                f"error while getting likes for post {post.uri}",
                 color="red",
                 force_color=True,
             )
@@ -325,18 +544,32 @@ async def log_queue_size_task(
     shutdown_event: asyncio.Event,
     storage_queue: AnyQueue[StoreThing],
     post_load_queue: AnyQueue[ProfileViewDetailed],
-    like_load_queue: AnyQueue[Tuple[int, int, FeedViewPost]],
+    like_load_queue: AnyQueue[Tuple[int, int, PostView]],
+    likes_stats: LikesPlannerStats,
 ) -> None:
     while not shutdown_event.is_set():
         print(
             f"> Load: {post_load_queue.qsize()} . Like: {like_load_queue.qsize()} . Store: {storage_queue.qsize()}"
         )
+        print(f"> {likes_stats.summary()}")
         await sleep_on(shutdown_event, 30)
 
 
+FurrySource = Callable[[Optional[str]], AsyncIterable[Tuple[ProfileViewDetailed, bool]]]
+
+
 async def find_furries_raw(
-    client: AsyncClient, *, policy: foxfeed.bsky.Policy,
+    client: AsyncClient,
+    *,
+    policy: foxfeed.bsky.Policy,
+    checkpoint: Optional[Checkpoint] = None,
+    seen: Container[str] = (),
+    shard: Shard = Shard(),
 ) -> AsyncIterable[Tuple[ProfileViewDetailed, bool]]:
+    """
+    Accounts in seen don't get their profiles looked up, except in furryli.st's follows, see below.
+    Neither do accounts in other shards, so more shards doesn't mean more lookups.
+    """
     known_furries: KNOWN_FURRIES_AND_CONNECTIONS = [
         (get_people_who_like_your_feeds, "puppyfox.bsky.social"),
         (get_people_who_like_your_feeds, "foxfeed.bsky.social"),
@@ -352,40 +585,89 @@ async def find_furries_raw(
         (get_mutuals, "jamievx.com"),
     ]
 
-    cprint("Loading furries from furryli.st", "blue", force_color=True)
-    furrylist = await client.app.bsky.actor.get_profile({"actor": "furryli.st"})
-    yield (furrylist, True)
-    async for other in as_detailed_profiles(client, get_follows, furrylist.did, policy):
-        yield (other, True)
-
-    cprint("Loading furries from seed list", "blue", force_color=True)
-    with gzip.open("./seed.json.gzip", "rb") as sff:
-        seed_list = json.loads(sff.read().decode("utf-8"))["seed"]
-
-    async for profile in get_specific_profiles(client, seed_list, policy):
-        yield (profile, False)
-
-    cprint("Grabbing furry-adjacent accounts", "blue", force_color=True)
-
-    for get_associations, handle in known_furries:
+    on_cursor = None if checkpoint is None else checkpoint.save_cursor
+    skip = Skip(seen, shard)
+
+    async def furrylist_source(cursor: Optional[str]) -> AsyncIterable[Tuple[ProfileViewDetailed, bool]]:
+        cprint("Loading furries from furryli.st", "blue", force_color=True)
+        furrylist = await client.app.bsky.actor.get_profile({"actor": "furryli.st"})
+        yield (furrylist, True)
+        # Only other shards' accounts get skipped here. With those gone a batch of lookups could cover more than a
+        # page, so details are looked up a page at a time, and a page's cursor is only saved once everyone from
+        # before it has been handed out.
+        page_cursors: List[str] = []
+        dids: List[str] = []
+
+        async def page_done(c: str) -> None:
+            page_cursors.append(c)
+
+        async for other in get_follows(client, furrylist.did, policy, cursor=cursor, on_cursor=page_done):
+            if page_cursors:
+                async for profile in get_specific_profiles(client, dids, policy):
+                    yield (profile, True)
+                dids = []
+                if on_cursor is not None:
+                    await on_cursor(page_cursors[-1])
+                page_cursors.clear()
+            if other.did in shard:
+                dids.append(other.did)
+        async for profile in get_specific_profiles(client, dids, policy):
+            yield (profile, True)
+
+    async def seed_source(_: Optional[str]) -> AsyncIterable[Tuple[ProfileViewDetailed, bool]]:
+        cprint("Loading furries from seed list", "blue", force_color=True)
+        with gzip.open("./seed.json.gzip", "rb") as sff:
+            seed_list = json.loads(sff.read().decode("utf-8"))["seed"]
+        async for profile in get_specific_profiles(client, [i for i in seed_list if i not in skip], policy):
+            yield (profile, False)
+
+    def association_source(
+        get_associations: Callable[[AsyncClient, str, foxfeed.bsky.PolicyType], AsyncIterable[ProfileView]],
+        handle: str,
+    ) -> FurrySource:
+        # These are made of several lists so there's no single cursor, a restart walks them again but
+        # doesn't look up accounts it's already found
+        async def source(_: Optional[str]) -> AsyncIterable[Tuple[ProfileViewDetailed, bool]]:
+            cprint(f"Grabbing furry-adjacent accounts from {handle}", "blue", force_color=True)
+            profile = await client.app.bsky.actor.get_profile({"actor": handle})
+            yield (profile, False)
+            async for other in as_detailed_profiles(client, get_associations, profile.did, policy, skip=skip):
+                yield (other, False)
+        return source
+
+    sources: List[FurrySource] = [furrylist_source, seed_source] + [
+        association_source(get_associations, handle) for get_associations, handle in known_furries
+    ]
+    start = 0 if checkpoint is None else checkpoint.source
+    for index, source in enumerate(sources):
         if policy.stop_event.is_set():
             break
-        profile = await client.app.bsky.actor.get_profile({"actor": handle})
-        yield (profile, False)
-        async for other in as_detailed_profiles(client, get_associations, profile.did, policy):
-            yield (other, False)
+        if index < start:
+            continue
+        cursor = None
+        if checkpoint is not None:
+            if index == start:
+                cursor = checkpoint.cursor
+            else:
+                await checkpoint.start_source(index)
+        async for i in source(cursor):
+            yield i
 
 
 async def find_furries_clean(
     client: AsyncClient,
     *,
     policy: foxfeed.bsky.Policy,
+    checkpoint: Optional[Checkpoint] = None,
+    shard: Shard = Shard(),
 ) -> AsyncIterable[Tuple[ProfileViewDetailed, bool]]:
     # Ok so we *know* that the furrylist verified ones are coming out first and we can exploit this to not miss anything
-    seen: Set[str] = set()
-    async for profile, is_furrylist_verified in find_furries_raw(client, policy=policy):
-        if profile.did not in seen and profile.did:
-            seen.add(profile.did)
+    # Memory stays flat no matter how big the graph gets, at the cost of very occasionally skipping someone new
+    seen = BloomFilter() if checkpoint is None else checkpoint.seen
+    async for profile, is_furrylist_verified in find_furries_raw(
+        client, policy=policy, checkpoint=checkpoint, seen=seen, shard=shard
+    ):
+        if profile.did and seen.add(profile.did):
             yield (profile, is_furrylist_verified)
 
 
@@ -397,15 +679,22 @@ async def load(
     policy: foxfeed.bsky.Policy,
     load_posts: bool = True,
     load_likes: bool = True,
+    workers: Workers = Workers(),
+    shard: Shard = Shard(),
+    backfill_new_actors: bool = False,
+    checkpoint: Optional[Checkpoint] = None,
 ) -> None:
     only_posts_after = datetime.now(timezone.utc) - foxfeed.algos.generators.LOOKBACK_HARD_LIMIT
 
     cprint("Getting muted accounts", "blue", force_color=True)
-    mutes = await get_mutes_across_clients([client, personal_bsky_client], policy=policy)
+    mutes = await MUTES.refresh(db, [client, personal_bsky_client], policy)
 
     if shutdown_event.is_set():
         return
 
+    high_water_marks = await load_high_water_marks(db)
+    cprint(f"{len(high_water_marks)} actors only need their new posts scraped", "blue", force_color=True)
+
     queue_size_limit = 1_000
 
     storage_queue: AnyQueue[StoreThing] = CloseableQueue(
@@ -416,59 +705,93 @@ async def load(
         asyncio.Queue(maxsize=queue_size_limit),
         shutdown_event
     )
-    like_load_queue: AnyQueue[Tuple[int, int, FeedViewPost]] = CloseableQueue(
+    like_load_queue: AnyQueue[Tuple[int, int, PostView]] = CloseableQueue(
         asyncio.PriorityQueue(maxsize=queue_size_limit),
         shutdown_event
     )
 
-    storage_worker = asyncio.create_task(
-        store_to_db_task(shutdown_event, db, storage_queue)
-    )
-    load_posts_worker = asyncio.create_task(
-        load_posts_task(
-            shutdown_event,
-            client,
-            policy,
-            only_posts_after,
-            post_load_queue,
-            like_load_queue,
-            storage_queue,
-            actually_do_shit=load_posts,
+    likes_stats = LikesPlannerStats()
+    # Only ever one of these. A user and their posts can land in different batches, and with a second worker the
+    # posts could be written before their author and get dropped.
+    storage_workers = [asyncio.create_task(store_to_db_task(shutdown_event, db, storage_queue))]
+    load_posts_workers = [
+        asyncio.create_task(
+            load_posts_task(
+                shutdown_event,
+                client,
+                policy,
+                only_posts_after,
+                high_water_marks,
+                post_load_queue,
+                like_load_queue,
+                storage_queue,
+                actually_do_shit=load_posts,
+                backfill_new_actors=backfill_new_actors,
+                scrape=None if checkpoint is None else checkpoint.name,
+            )
         )
-    )
-    load_likes_worker = asyncio.create_task(
-        load_likes_task(
-            shutdown_event,
-            client,
-            policy,
-            like_load_queue,
-            storage_queue,
-            actually_do_shit=load_likes,
+        for _ in range(workers.posts)
+    ]
+    load_likes_workers = [
+        asyncio.create_task(
+            load_likes_task(
+                shutdown_event,
+                db,
+                client,
+                policy,
+                like_load_queue,
+                storage_queue,
+                likes_stats,
+                actually_do_shit=load_likes,
+            )
         )
-    )
+        for _ in range(workers.likes)
+    ]
     report_task = asyncio.create_task(
         log_queue_size_task(
-            shutdown_event, storage_queue, post_load_queue, like_load_queue
+            shutdown_event, storage_queue, post_load_queue, like_load_queue, likes_stats
         )
     )
 
-    if client.me is not None:
-        await storage_queue.put(StoreUser(client.me, True, False))
-        await post_load_queue.put(client.me)
-
-    if personal_bsky_client.me is not None:
-        await storage_queue.put(StoreUser(personal_bsky_client.me, True, False))
-        await post_load_queue.put(personal_bsky_client.me)
+    if shard.count > 1:
+        cprint(f"Scraping shard {shard.index} of {shard.count}", "blue", force_color=True)
+
+    for me in [client.me, personal_bsky_client.me]:
+        if me is not None and me.did in shard:
+            await storage_queue.put(StoreUser(me, True, False))
+            await post_load_queue.put(me)
+
+    if checkpoint is not None:
+        # These were handed out before the restart but their posts never got stored
+        unfinished = dict(await checkpoint.unfinished())
+        if unfinished:
+            cprint(f"Picking up {len(unfinished)} accounts from the last run", "blue", force_color=True)
+        for did in unfinished:
+            checkpoint.seen.add(did)
+        async for furry in get_specific_profiles(client, list(unfinished), policy):
+            await storage_queue.put(StoreUser(furry, unfinished[furry.did], furry.did in mutes))
+            if furry.did in mutes:
+                await storage_queue.put(StoreScrapeDone(checkpoint.name, furry.did))
+            else:
+                await post_load_queue.put(furry)
 
     async for furry, is_furrlist_verified in find_furries_clean(
-        client, policy=policy
+        client, policy=policy, checkpoint=checkpoint, shard=shard
     ):
+        # Discovery already skips other shards' accounts, apart from the few it starts from
+        if furry.did not in shard:
+            continue
         # The posts for a user can be loaded before the user is stored, however the StoreUser will always be ahead of the relevant
         # StorePosts, so this will never break the DB foreign keys
         muted = furry.did in mutes
+        # Has to be written down before the next page of the source gets fetched, since that moves the cursor on
+        if checkpoint is not None:
+            await checkpoint.found(furry.did, is_furrlist_verified, done=muted)
         await storage_queue.put(StoreUser(furry, is_furrlist_verified, muted))
         if not muted:
             await post_load_queue.put(furry)
+    if checkpoint is not None:
+        await checkpoint.flush_found()
 
     cprint("Waiting for workers to finish...", "blue", force_color=True)
 
@@ -476,19 +799,13 @@ async def load(
     await join_unless(storage_queue, shutdown_event)
     await join_unless(like_load_queue, shutdown_event)
 
-    storage_worker.cancel()
-    load_posts_worker.cancel()
-    load_likes_worker.cancel()
-    report_task.cancel()
-
-    await asyncio.gather(
-        storage_worker,
-        load_posts_worker,
-        load_likes_worker,
-        report_task,
-        return_exceptions=True,
-    )
+    tasks = storage_workers + load_posts_workers + load_likes_workers + [report_task]
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
 
+    cprint(likes_stats.summary(), "blue", force_color=True)
     cprint("Ok! Yeah! Woooo!", "blue", force_color=True)
     if shutdown_event.is_set():
         cprint(
@@ -497,6 +814,8 @@ async def load(
             force_color=True,
         )
     else:
+        if checkpoint is not None:
+            await checkpoint.finish()
         cprint("Done scraping website :)", "green", force_color=True)
 
 
@@ -508,7 +827,7 @@ async def scan_once(
     policy: foxfeed.bsky.Policy,
 ) -> None:
     cprint("Loading list of furries", "blue", force_color=True)
-    mutes = await get_mutes_across_clients([client, personal_bsky_client], policy=policy)
+    mutes = await MUTES.refresh(db, [client, personal_bsky_client], policy)
     all_furries = [
         i async for i in find_furries_clean(client, policy=policy)
     ]
@@ -524,21 +843,13 @@ async def scan_once(
             is_muted=(user.did in mutes),
             is_external_to_network=False,
         )
-    # some accounts may have previously been in the dataset but are now excluded
-    await db.actor.update_many(
-        where={"did": {"in": list(mutes)}},
-        data={"is_muted": True},
-    )
     cprint("Done", "blue", force_color=True)
 
 
 async def enqueue_unlinks(db: Database) -> int:
     print('Finding unlinks!')
     unlinks = await find_unlinks(db)
-    return await db.unknownthing.create_many(
-        data=[{'kind': 'post', 'identifier': i.uri} for i in unlinks],
-        skip_duplicates=True
-    )
+    return await insert_unknown_things(db, [{'kind': 'post', 'identifier': i.uri} for i in unlinks])
 
 
 async def create_sentinels(db: Database):
@@ -560,161 +871,10 @@ async def create_sentinels(db: Database):
 
 
 async def load_unknown_things(db: Database, client: AsyncClient, policy: foxfeed.bsky.Policy) -> bool:
-    cprint(f"There are {await db.unknownthing.count(where={'kind': {'in': ['actor', 'post', 'like']}})} unknown things", "cyan", force_color=True)
-
-    max_id = await db.unknownthing.find_first(order={'id': 'desc'}, where={'kind': {'in': ['actor', 'post', 'like']}})
-    if max_id is None:
-        # Currently not finding unlinks since it might add stuff to the DB that's before the post-drop timestamp
-        # if await enqueue_unlinks(db):
-        #     return True
-        cprint("No unknown things to load", "blue", force_color=True)
-        return False
-    
-    block_size = 200
-
-    cprint("Loading unknown users", "blue", force_color=True)
-    while x := await db.unknownthing.find_many(
-        take=block_size,
-        order={'id': 'asc'},
-        where={'id': {'lte': max_id.id}, 'kind': 'actor'},
-    ):
-        users = [i async for i in get_specific_profiles(client, [i.identifier for i in x], policy)]
-        # Need to check HERE in order to not process an incomplete set of profiles and then accidentally
-        # drop incomplete work from the table. This is bad design, like the fact there's this weird edge case this actually.
-        # Might just want to raise an exception from within the bsky queries TBH.
-        if policy.stop_event.is_set():
-            break
-        gone = {i.identifier for i in x} - {i.did for i in users}
-        async with db.tx() as tx:
-            for did in gone:
-                await tx.actor.upsert(
-                    where={'did': did},
-                    data={
-                        'create': {
-                            'did': did,
-                            'handle': 'deleted',
-                            'is_muted': True,
-                        },
-                        'update': {}
-                    }
-                )
-            if users:
-                cprint(f'updating {len(users)} unknown users', 'yellow', force_color=True)
-            for user in users:
-                await store_user(
-                    tx,
-                    user,
-                    is_muted=False,
-                    is_furrylist_verified=False,
-                    flag_for_manual_review=False,
-                    is_external_to_network=True
-                )
-            await tx.unknownthing.delete_many(where={'id': {'in': [i.id for i in x]}})
-        for i in x:
-            await foxfeed.data_filter.user_exists_cached.drop_entry(i.identifier)
-        await asyncio.sleep(0.2)
-
-    cprint("Loading unknown posts", "blue", force_color=True)
-    while x := await db.unknownthing.find_many(
-        take=25,
-        order={'id': 'asc'},
-        where={'id': {'lte': max_id.id}, 'kind': 'post'},
-    ):
-        posts = [i async for i in get_specific_posts(client, [i.identifier for i in x], policy)]
-        if policy.stop_event.is_set():
-            break
-        # query didn't return information about these posts, assume they've been deleted
-        gone = {i.identifier for i in x} - {i.uri for i in posts}
-        author_dids = [i.author.did for i in posts]
-        author_dids_we_have = [
-            i.did
-            for i in await db.actor.find_many(where={'did': {'in': author_dids}})
-        ]
-        ready_to_store = [
-            i
-            for i in posts
-            if i.author.did in author_dids_we_have
-        ]
-        not_ready_to_store = [
-            i
-            for i in posts
-            if i.author.did not in author_dids_we_have
-        ]
-        async with db.tx() as tx:
-            for i in gone:
-                await tx.post.upsert(
-                    where={'uri': i},
-                    data={
-                        'create': {
-                            'uri': i,
-                            'cid': 'unknown',
-                            'text': 'unknown',
-                            'is_deleted': True,
-                            'mentions_fursuit': False,
-                            'authorId': 'unknown',
-                            'media_count': 0,
-                        },
-                        'update': {
-                            'is_deleted': True
-                        }
-                    }
-                )
-            for post in ready_to_store:
-                await store_post3(tx, post)
-            await tx.unknownthing.delete_many(where={'id': {'in': [i.id for i in x]}})
-            if not_ready_to_store:
-                await tx.unknownthing.create_many(
-                    data=[{'kind': 'actor', 'identifier': i.author.did} for i in not_ready_to_store],
-                    skip_duplicates=True
-                )
-                await tx.unknownthing.create_many(
-                    data=[{'kind': 'post', 'identifier': i.uri} for i in not_ready_to_store],
-                    skip_duplicates=True
-                )
-        for i in x:
-            await foxfeed.data_filter.post_exists_cached.drop_entry(i.identifier)
-        await asyncio.sleep(0.2)
-
-    cprint("Loading unknown likes", "blue", force_color=True)
-    while x := await db.unknownthing.find_many(
-        take=block_size,
-        order={'identifier': 'asc'},
-        # Low key don't care about the ID limiter here, we care more about getting value from queries TBH
-        where={'kind': 'like'},
-    ):
-        likes = [i async for i in get_specific_likes(client, [i.identifier for i in x], policy)]
-        # Need to check HERE in order to not process an incomplete set of profiles and then accidentally
-        # drop incomplete work from the table. This is bad design, like the fact there's this weird edge case this actually.
-        # Might just want to raise an exception from within the bsky queries TBH.
-        if policy.stop_event.is_set():
-            break
-        if likes:
-            print(f'Storing {len(likes)} likes')
-        for i in likes:
-            try:
-                await db.like.create(
-                    data={
-                        "uri": i.uri,
-                        "cid": i.cid or "",
-                        "post_uri": i.post_uri,
-                        "post_cid": i.post_cid,
-                        "liker_id": i.actor_did,
-                        "created_at": parse_datetime(i.created_at)
-                    }
-                )
-            except prisma.errors.ForeignKeyViolationError:
-                pass
-            except prisma.errors.UniqueViolationError:
-                pass
-        await db.unknownthing.delete_many(where={'id': {'in': [i.id for i in x]}})
-        if len(x) < block_size:
-            # Need to break like this since we don't have the ID limit
-            # Otherwise we risk spinning here forever as the firehose adds new things to the work queue constantly
-            break
-            # Actually I think we risk never moving on to the main scraper at this rate lmao
-        await asyncio.sleep(0.2)
-    
-    return True
+    # Currently not finding unlinks since it might add stuff to the DB that's before the post-drop timestamp
+    # if await enqueue_unlinks(db):
+    #     return True
+    return await resolve_unknown_things(db, client, policy)
 
 
 class CatchAndReportError:
@@ -755,17 +915,30 @@ async def rescan_furry_accounts(res: Res, forever: bool) -> None:
     await create_sentinels(res.db)
     if res.shutdown_event.is_set():
         return
-    # with CatchAndReportError("loading unknown things (before loop)"):
-    #     while await load_unknown_things(res.db, res.client, policy):
-    #         pass
+    # One pass each time, the firehose keeps adding to the queue so looping until it's empty might never finish
+    with CatchAndReportError("loading unknown things (before loop)"):
+        await load_unknown_things(res.db, res.client, policy)
     if res.shutdown_event.is_set():
         return
     with CatchAndReportError("full scrape"):
-        await load(res.shutdown_event, res.db, res.client, res.personal_bsky_client, policy)
+        shard = Shard.parse(config.SCRAPER_SHARD)
+        await load(
+            res.shutdown_event,
+            res.db,
+            res.client,
+            res.personal_bsky_client,
+            policy,
+            workers=Workers(
+                posts=config.SCRAPER_POST_WORKERS,
+                likes=config.SCRAPER_LIKE_WORKERS,
+            ),
+            shard=shard,
+            backfill_new_actors=config.SCRAPER_REPO_BACKFILL,
+            checkpoint=await Checkpoint.load(res.db, f'full {shard.index}/{shard.count}'),
+        )
     while forever and not res.shutdown_event.is_set():
-        # with CatchAndReportError("loading unknown things (within loop)"):
-        #     while await load_unknown_things(res.db, res.client, policy):
-        #         pass
+        with CatchAndReportError("loading unknown things (within loop)"):
+            await load_unknown_things(res.db, res.client, policy)
         with CatchAndReportError("scan once"):
             await scan_once(res.shutdown_event, res.db, res.client, res.personal_bsky_client, policy)
         await sleep_on(res.shutdown_event, 60 * 30)
@@ -1,15 +1,24 @@
 import asyncio
 import math
+import traceback
 from foxfeed.database import Database
+from foxfeed.hll import HyperLogLog
+from foxfeed.util import sleep_on
 from datetime import datetime, timedelta
 from dataclasses import dataclass
-from typing import Literal, Iterator, List, Optional
-import prisma.types
+from typing import Literal, Iterator, List, Optional, Dict, Set
+from termcolor import cprint
 
 
 METRICS_MAXIMUM_LOOKBACK = timedelta(days=3)
 DIDS_TO_IGNORE = ['did:plc:j7jc2j2htz5gxuxi2ilhbqka']
 
+ROLLUP_INTERVAL = timedelta(hours=1)
+# Likes can turn up late (e.g. if the firehose is lagging) so keep recomputing the most recent few hours
+ROLLUP_SETTLE_TIME = timedelta(hours=3)
+ROLLUP_RETENTION = timedelta(days=30)
+ALL_FEEDS = ''
+
 
 @dataclass
 class FeedMetricsSlice:
@@ -29,53 +38,140 @@ class FeedMetrics:
     timesliced: List[FeedMetricsSlice]
 
 
-async def feed_metrics_for_timeslice(
-    db: Database,
-    feed_name: Optional[str],
-    start: datetime,
-    end: datetime,
-) -> FeedMetricsSlice:
-    feedname_filter: prisma.types.StringFilter = {"endswith": feed_name or ''}
-    attributed_likes = await db.like.count(
-        where={
-            "NOT": [{"attributed_feed": None}],
-            "attributed_feed": feedname_filter,
-            "created_at": {"gte": start, "lt": end},
-            "liker_id": {"not_in": DIDS_TO_IGNORE},
-        }
+@dataclass
+class _Rollup:
+    attributed_likes: int
+    num_requests: int
+    posts_served: int
+    viewers: HyperLogLog
+
+
+async def _count_by_feed(db: Database, query: str, start: datetime, end: datetime) -> Dict[str, int]:
+    rows = await db.pg.fetchall(query, {'start': start, 'end': end, 'ignore': DIDS_TO_IGNORE})
+    return {feed_name: count for feed_name, count in rows}
+
+
+async def rollup_hour(db: Database, start: datetime) -> None:
+    end = start + ROLLUP_INTERVAL
+    attributed_likes = await _count_by_feed(
+        db,
+        '''
+        SELECT attributed_feed, COUNT(*) FROM "Like"
+        WHERE attributed_feed IS NOT NULL
+          AND created_at >= %(start)s AND created_at < %(end)s
+          AND liker_id <> ALL(%(ignore)s)
+        GROUP BY attributed_feed
+        ''',
+        start,
+        end,
     )
-    num_requests = await db.servedblock.count(
-        where={
-            "feed_name": feedname_filter,
-            "when": {"gte": start, "lt": end},
-            "client_did": {"not_in": DIDS_TO_IGNORE},
-        }
+    num_requests = await _count_by_feed(
+        db,
+        '''
+        SELECT feed_name, COUNT(*) FROM "ServedBlock"
+        WHERE "when" >= %(start)s AND "when" < %(end)s
+          AND client_did <> ALL(%(ignore)s)
+        GROUP BY feed_name
+        ''',
+        start,
+        end,
     )
-    posts_served = await db.servedpost.count(
-        where={
-            "feed_name": feedname_filter,
-            "when": {"gte": start, "lt": end},
-            "client_did": {"not_in": DIDS_TO_IGNORE},
-        }
+    posts_served = await _count_by_feed(
+        db,
+        '''
+        SELECT feed_name, COUNT(*) FROM "ServedPost"
+        WHERE "when" >= %(start)s AND "when" < %(end)s
+          AND client_did <> ALL(%(ignore)s)
+        GROUP BY feed_name
+        ''',
+        start,
+        end,
     )
-    unique_viewers = len(
-        await db.servedblock.find_many(
-            where={
-                "feed_name": feedname_filter,
-                "when": {"gte": start, "lt": end},
-                "client_did": {"not_in": DIDS_TO_IGNORE},
-            },
-            distinct=["client_did"],
-        )
+    rows = await db.pg.fetchall(
+        '''
+        SELECT DISTINCT feed_name, client_did FROM "ServedBlock"
+        WHERE "when" >= %(start)s AND "when" < %(end)s
+          AND client_did IS NOT NULL
+          AND client_did <> ALL(%(ignore)s)
+        ''',
+        {'start': start, 'end': end, 'ignore': DIDS_TO_IGNORE},
     )
-    return FeedMetricsSlice(
-        start=start,
-        end=end,
-        attributed_likes=attributed_likes,
-        num_requests=num_requests,
-        posts_served=posts_served,
-        unique_viewers=unique_viewers,
+    viewers: Dict[str, Set[str]] = {}
+    for feed_name, client_did in rows:
+        viewers.setdefault(feed_name, set()).add(client_did)
+
+    feed_names = set(attributed_likes) | set(num_requests) | set(posts_served) | set(viewers)
+    rollups: Dict[str, _Rollup] = {}
+    total = _Rollup(0, 0, 0, HyperLogLog())
+    for feed_name in feed_names:
+        sketch = HyperLogLog()
+        sketch.update(viewers.get(feed_name, set()))
+        rollups[feed_name] = _Rollup(
+            attributed_likes=attributed_likes.get(feed_name, 0),
+            num_requests=num_requests.get(feed_name, 0),
+            posts_served=posts_served.get(feed_name, 0),
+            viewers=sketch,
+        )
+        total.attributed_likes += rollups[feed_name].attributed_likes
+        total.num_requests += rollups[feed_name].num_requests
+        total.posts_served += rollups[feed_name].posts_served
+        total.viewers.merge(sketch)
+    rollups[ALL_FEEDS] = total
+
+    # All the upserts for the hour land in a single transaction, committed when the block exits
+    async with db.pg.connection() as conn:
+        async with conn.transaction():
+            for feed_name, r in rollups.items():
+                await conn.execute(
+                    '''
+                    INSERT INTO "FeedMetricsRollup"
+                        (feed_name, hour, attributed_likes, num_requests, posts_served, unique_viewers, viewer_sketch, updated_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+                    ON CONFLICT (feed_name, hour) DO UPDATE SET
+                        attributed_likes = EXCLUDED.attributed_likes,
+                        num_requests = EXCLUDED.num_requests,
+                        posts_served = EXCLUDED.posts_served,
+                        unique_viewers = EXCLUDED.unique_viewers,
+                        viewer_sketch = EXCLUDED.viewer_sketch,
+                        updated_at = EXCLUDED.updated_at
+                    ''',
+                    (
+                        feed_name,
+                        start,
+                        r.attributed_likes,
+                        r.num_requests,
+                        r.posts_served,
+                        r.viewers.count(),
+                        r.viewers.to_bytes(),
+                    ),
+                )
+
+
+async def rollup_metrics(db: Database, now: datetime) -> int:
+    start = floor_datetime(now - METRICS_MAXIMUM_LOOKBACK, ROLLUP_INTERVAL)
+    latest = await db.feedmetricsrollup.find_first(
+        where={'feed_name': ALL_FEEDS},
+        order={'hour': 'desc'},
     )
+    if latest is not None:
+        start = max(start, floor_datetime(latest.hour.replace(tzinfo=None) - ROLLUP_SETTLE_TIME, ROLLUP_INTERVAL))
+    hours = list(daterange(start, now, ROLLUP_INTERVAL))
+    for hour in hours:
+        await rollup_hour(db, hour)
+    return len(hours)
+
+
+async def rollup_metrics_forever(db: Database, shutdown_event: asyncio.Event, forever: bool) -> None:
+    while True:
+        try:
+            hours = await rollup_metrics(db, datetime.now())
+            cprint(f'Rolled up {hours} hours of feed metrics', 'yellow', force_color=True)
+        except Exception:
+            cprint('Error during rollup_metrics', color='red', force_color=True)
+            traceback.print_exc()
+        if not forever or shutdown_event.is_set():
+            break
+        await sleep_on(shutdown_event, 60 * 5)
 
 
 async def feed_metrics_for_time_range(
@@ -87,11 +183,29 @@ async def feed_metrics_for_time_range(
     *,
     floor_start_and_end: Literal[True] = True
 ) -> FeedMetrics:
+    if interval != ROLLUP_INTERVAL:
+        raise ValueError(f'feed metrics are only available in intervals of {ROLLUP_INTERVAL}')
     f_start = floor_datetime(start, interval)
-    metrics = await asyncio.gather(*[
-        feed_metrics_for_timeslice(db, feed_name, i, i + interval)
-        for i in daterange(f_start, end, interval)
-    ])
+    rows = await db.feedmetricsrollup.find_many(
+        where={
+            'feed_name': feed_name or ALL_FEEDS,
+            'hour': {'gte': f_start, 'lt': end},
+        },
+    )
+    by_hour = {i.hour.replace(tzinfo=None): i for i in rows}
+    metrics: List[FeedMetricsSlice] = []
+    for i in daterange(f_start, end, interval):
+        row = by_hour.get(i)
+        metrics.append(
+            FeedMetricsSlice(
+                start=i,
+                end=i + interval,
+                attributed_likes=0 if row is None else row.attributed_likes,
+                num_requests=0 if row is None else row.num_requests,
+                posts_served=0 if row is None else row.posts_served,
+                unique_viewers=0 if row is None else row.unique_viewers,
+            )
+        )
     return FeedMetrics(
         start=f_start,
         end=f_start + interval * len(metrics),
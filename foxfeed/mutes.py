@@ -0,0 +1,116 @@
+import time
+import atproto.exceptions
+from termcolor import cprint
+
+from foxfeed.bsky import AsyncClient, Policy, get_mutes, get_mute_lists, get_list, get_latest_rev
+from foxfeed.database import Database
+from foxfeed.instrumentation import REGISTRY
+
+from atproto_client.models.app.bsky.graph.defs import ListView
+
+from typing import Collection, List, Optional, Set
+
+
+# How stale the firehose's copy can get, the scraper refreshes it straight away when it fetches
+MUTES_RELOAD_INTERVAL = 5 * 60
+
+
+mute_lists_checked = REGISTRY.counter(
+    'foxfeed_mute_lists_total',
+    'Mute lists checked, by whether they had to be fetched again, and ones whose revision couldn\'t be looked up',
+)
+
+
+async def _list_rev(lst: ListView, policy: Policy) -> Optional[str]:
+    # List items live in the creator's repo, so if that hasn't moved then neither has the list
+    try:
+        rev = await get_latest_rev(lst.creator.did, policy)
+    except atproto.exceptions.RequestException as e:
+        cprint(f'Couldn\'t get the latest revision for mute list {lst.uri}: {e!r}', 'yellow', force_color=True)
+        rev = None
+    if rev is None and not policy.stop_event.is_set():
+        # Without one the list has to be fetched again every time, so keep an eye on how often this happens
+        mute_lists_checked.inc(result='no rev')
+    return rev
+
+
+async def _save(db: Database, source: str, rev: Optional[str], members: Collection[str]) -> None:
+    await db.pg.execute(
+        '''
+        INSERT INTO "MuteSource" (source, rev, members, updated_at) VALUES (%s, %s, %s, now() AT TIME ZONE 'UTC')
+        ON CONFLICT (source) DO UPDATE SET rev = EXCLUDED.rev, members = EXCLUDED.members, updated_at = EXCLUDED.updated_at
+        ''',
+        (source, rev, list(members)),
+    )
+
+
+class Mutes:
+    """
+    Everyone muted by our accounts, directly or through a mute list.
+    One of these is shared by everything running in the process, so the firehose sees new mutes as soon as the
+    scraper fetches them. Lists are stored in MuteSource and only fetched again when their creator's repo changes.
+    """
+
+    def __init__(self) -> None:
+        self.dids: Set[str] = set()
+        self.loaded_at: Optional[float] = None
+
+    def __contains__(self, did: object) -> bool:
+        return did in self.dids
+
+    async def load(self, db: Database) -> Set[str]:
+        rows = await db.pg.fetchall('SELECT DISTINCT unnest(members) FROM "MuteSource"')
+        self.dids = {did for (did,) in rows}
+        self.loaded_at = time.monotonic()
+        return self.dids
+
+    async def load_if_stale(self, db: Database) -> Set[str]:
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > MUTES_RELOAD_INTERVAL:
+            await self.load(db)
+        return self.dids
+
+    async def refresh(self, db: Database, clients: List[AsyncClient], policy: Policy) -> Set[str]:
+        stored = dict(await db.pg.fetchall('SELECT source, rev FROM "MuteSource"'))
+        own = {c.me.did for c in clients if c.me is not None}
+        current: Set[str] = set()
+        refreshed = 0
+        for client in clients:
+            if client.me is None or policy.stop_event.is_set():
+                continue
+            # Direct mutes are private to the account so there's no revision to check, but it's a short list
+            source = f'direct:{client.me.did}'
+            current.add(source)
+            members = {i.did async for i in get_mutes(client, policy)}
+            # Stopping early leaves a partial list, which would unmute people
+            if policy.stop_event.is_set():
+                break
+            await _save(db, source, None, members - own)
+            async for lst in get_mute_lists(client, policy):
+                current.add(lst.uri)
+                rev = await _list_rev(lst, policy)
+                if rev is not None and stored.get(lst.uri) == rev:
+                    mute_lists_checked.inc(result='unchanged')
+                    continue
+                members = {i.subject.did async for i in get_list(client, lst.uri, policy)}
+                if policy.stop_event.is_set():
+                    break
+                await _save(db, lst.uri, rev, members - own)
+                stored[lst.uri] = rev
+                mute_lists_checked.inc(result='fetched')
+            if not policy.stop_event.is_set():
+                refreshed += 1
+        # Lists we've unsubscribed from. A mute list can be anyone's, so there's no telling which of our accounts a
+        # stored one came from, and it's only safe to throw them out once every account's mutes have been looked at.
+        if current and refreshed == len(clients):
+            await db.pg.execute('DELETE FROM "MuteSource" WHERE NOT source = ANY(%s)', (list(current),))
+        await self.load(db)
+        # Scoring only looks at the flag, so don't make it wait for the scraper to get around to these people
+        flagged = await db.pg.execute(
+            'UPDATE "Actor" SET is_muted = TRUE WHERE did = ANY(%s) AND NOT is_muted',
+            (list(self.dids),),
+        )
+        cprint(f'{len(self.dids)} muted accounts, {flagged} newly muted', 'blue', force_color=True)
+        return self.dids
+
+
+MUTES = Mutes()
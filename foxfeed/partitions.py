@@ -0,0 +1,181 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from psycopg import sql
+from termcolor import cprint
+
+from foxfeed.database import Database
+from foxfeed.metrics import floor_datetime, daterange
+
+from typing import List, Optional, Tuple
+
+
+PARTITION_INTERVAL = timedelta(days=1)
+# Always have this many days of partitions ready to go, so inserts never land in the default partition
+PARTITIONS_AHEAD = timedelta(days=3)
+
+
+@dataclass(frozen=True)
+class PartitionedTable:
+    table: str
+    column: str
+
+
+# Only tables that nothing else points at can be partitioned, since postgres needs the partition column in every
+# unique constraint. Post and Like are referenced by uri, so they stay as normal tables.
+PARTITIONED_TABLES = [
+    PartitionedTable('ServedBlock', 'when'),
+    PartitionedTable('ServedPost', 'when'),
+]
+
+
+def partition_name(t: PartitionedTable, start: datetime) -> str:
+    return f'{t.table}_{start:%Y%m%d}'
+
+
+def default_partition_name(t: PartitionedTable) -> str:
+    return f'{t.table}_default'
+
+
+def _partition_start(t: PartitionedTable, name: str) -> Optional[datetime]:
+    m = re.fullmatch(re.escape(t.table) + r'_(\d{8})', name)
+    return None if m is None else datetime.strptime(m[1], '%Y%m%d')
+
+
+async def is_partitioned(db: Database, t: PartitionedTable) -> bool:
+    row = await db.pg.fetchone('SELECT relkind FROM pg_class WHERE relname = %s', (t.table,))
+    return row is not None and row[0] == 'p'
+
+
+async def list_partitions(db: Database, t: PartitionedTable) -> List[Tuple[str, datetime]]:
+    rows = await db.pg.fetchall(
+        '''
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+        ''',
+        (t.table,),
+    )
+    partitions: List[Tuple[str, datetime]] = []
+    for (name,) in rows:
+        start = _partition_start(t, name)
+        if start is not None:
+            partitions.append((name, start))
+    return sorted(partitions, key=lambda x: x[1])
+
+
+def _create_partition(t: PartitionedTable, start: datetime) -> sql.Composable:
+    # DDL can't take bound parameters, so the bounds get inlined as literals
+    return sql.SQL('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})').format(
+        sql.Identifier(partition_name(t, start)),
+        sql.Identifier(t.table),
+        sql.Literal(start),
+        sql.Literal(start + PARTITION_INTERVAL),
+    )
+
+
+async def create_partition(db: Database, t: PartitionedTable, start: datetime) -> None:
+    """
+    Creates the partition for the day starting at start. Postgres refuses to create a partition while the default
+    partition holds rows that belong in it, so any of those get moved across in the same transaction.
+    """
+    ident = sql.Identifier(t.table)
+    default = sql.Identifier(default_partition_name(t))
+    in_range = sql.SQL('{} >= %s AND {} < %s').format(sql.Identifier(t.column), sql.Identifier(t.column))
+    bounds = (start, start + PARTITION_INTERVAL)
+    async with db.pg.connection() as conn:
+        async with conn.transaction():
+            row = await (await conn.execute(
+                'SELECT 1 FROM pg_class WHERE relname = %s', (default_partition_name(t),)
+            )).fetchone()
+            if row is not None:
+                row = await (await conn.execute(
+                    sql.SQL('SELECT 1 FROM {} WHERE {} LIMIT 1').format(default, in_range), bounds
+                )).fetchone()
+            if row is None:
+                await conn.execute(_create_partition(t, start))
+                return
+            cprint(f'Moving rows out of {default_partition_name(t)} into {partition_name(t, start)}', 'yellow', force_color=True)
+            await conn.execute(sql.SQL('ALTER TABLE {} DETACH PARTITION {}').format(ident, default))
+            await conn.execute(_create_partition(t, start))
+            await conn.execute(
+                sql.SQL('INSERT INTO {} SELECT * FROM {} WHERE {}').format(
+                    sql.Identifier(partition_name(t, start)), default, in_range
+                ),
+                bounds,
+            )
+            await conn.execute(sql.SQL('DELETE FROM {} WHERE {}').format(default, in_range), bounds)
+            await conn.execute(sql.SQL('ALTER TABLE {} ATTACH PARTITION {} DEFAULT').format(ident, default))
+
+
+async def ensure_partitions(db: Database, now: datetime) -> int:
+    created = 0
+    for t in PARTITIONED_TABLES:
+        if not await is_partitioned(db, t):
+            continue
+        existing = {start for _, start in await list_partitions(db, t)}
+        start = floor_datetime(now, PARTITION_INTERVAL)
+        for day in daterange(start, now + PARTITIONS_AHEAD, PARTITION_INTERVAL):
+            if day not in existing:
+                await create_partition(db, t, day)
+                created += 1
+    return created
+
+
+async def drop_partitions_before(db: Database, t: PartitionedTable, cutoff: datetime) -> int:
+    """Drops every partition that only holds rows older than the cutoff, returns how many there were"""
+    dropped = 0
+    for name, start in await list_partitions(db, t):
+        if start + PARTITION_INTERVAL > cutoff:
+            continue
+        cprint(f'Dropping partition {name}', 'yellow', force_color=True)
+        async with db.pg.connection() as conn:
+            await conn.execute(
+                sql.SQL('ALTER TABLE {} DETACH PARTITION {}').format(sql.Identifier(t.table), sql.Identifier(name))
+            )
+            await conn.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(name)))
+        dropped += 1
+    return dropped
+
+
+async def convert_to_partitioned(db: Database, t: PartitionedTable, now: datetime) -> None:
+    """One-off migration from a plain table to a partitioned one, copies the existing rows across"""
+    if await is_partitioned(db, t):
+        return
+    old = f'{t.table}_unpartitioned'
+    ident = sql.Identifier(t.table)
+    old_ident = sql.Identifier(old)
+    column = sql.Identifier(t.column)
+    async with db.pg.connection() as conn:
+        row = await (await conn.execute(sql.SQL('SELECT MIN({}) FROM {}').format(column, ident))).fetchone()
+        oldest: datetime = now if row is None or row[0] is None else row[0]
+        # Move the old table (and the names of its constraints and indexes) out of the way
+        await conn.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(ident, old_ident))
+        await conn.execute(sql.SQL('ALTER TABLE {} RENAME CONSTRAINT {} TO {}').format(
+            old_ident, sql.Identifier(f'{t.table}_pkey'), sql.Identifier(f'{old}_pkey')
+        ))
+        await conn.execute(sql.SQL('ALTER INDEX {} RENAME TO {}').format(
+            sql.Identifier(f'{t.table}_{t.column}_idx'), sql.Identifier(f'{old}_{t.column}_idx')
+        ))
+        # The primary key has to include the partition column
+        await conn.execute(
+            sql.SQL(
+                'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS, CONSTRAINT {} PRIMARY KEY (id, {})) PARTITION BY RANGE ({})'
+            ).format(ident, old_ident, sql.Identifier(f'{t.table}_pkey'), column, column)
+        )
+        await conn.execute(sql.SQL('CREATE INDEX {} ON {} ({})').format(
+            sql.Identifier(f'{t.table}_{t.column}_idx'), ident, column
+        ))
+        # Anything that somehow misses the daily partitions goes here instead of failing
+        await conn.execute(sql.SQL('CREATE TABLE {} PARTITION OF {} DEFAULT').format(
+            sql.Identifier(default_partition_name(t)), ident
+        ))
+        for day in daterange(floor_datetime(oldest, PARTITION_INTERVAL), now + PARTITIONS_AHEAD, PARTITION_INTERVAL):
+            await conn.execute(_create_partition(t, day))
+        await conn.execute(sql.SQL('INSERT INTO {} SELECT * FROM {}').format(ident, old_ident))
+        # The id sequence belongs to the old table, and would get dropped along with it
+        await conn.execute(
+            sql.SQL('ALTER SEQUENCE {} OWNED BY {}.id').format(sql.Identifier(f'{t.table}_id_seq'), ident)
+        )
+        await conn.execute(sql.SQL('DROP TABLE {}').format(old_ident))
@@ -0,0 +1,89 @@
+import asyncio
+import time
+import traceback
+from termcolor import cprint
+
+from foxfeed import gender
+from foxfeed.database import Database
+from foxfeed.db_cleanup import Throttle
+from foxfeed.instrumentation import REGISTRY
+from foxfeed.util import sleep_on
+
+from typing import List, Optional, Tuple
+
+
+RELABEL_PAGE_SIZE = 1_000
+# New actors mostly come in through the scraper with labels already on them, this only catches the stragglers
+RELABEL_INTERVAL = 60 * 60
+
+
+actors_relabelled = REGISTRY.counter(
+    'foxfeed_relabel_actors_total',
+    'Actors given labels from the current gender word lists, by whether the labels changed',
+)
+
+
+async def relabel_batch(db: Database, after: str) -> Tuple[int, str]:
+    """Relabels the next page of actors with stale labels, returns how many there were and the did to carry on from"""
+    rows = await db.pg.fetchall(
+        '''
+        SELECT did, description, autolabel_fem_vibes, autolabel_nb_vibes, autolabel_masc_vibes FROM "Actor"
+        WHERE did > %s AND autolabel_ruleset IS DISTINCT FROM %s
+        ORDER BY did LIMIT %s
+        ''',
+        (after, gender.RULESET, RELABEL_PAGE_SIZE),
+    )
+    if not rows:
+        return 0, after
+    # A page of bios is a few milliseconds of regex, keep it off the event loop anyway
+    loop = asyncio.get_running_loop()
+    descriptions = [description or '' for _, description, *_ in rows]
+    vibes = await loop.run_in_executor(None, gender.vibecheck_many, descriptions)
+    updates: List[Tuple[bool, bool, bool, str, str, Optional[str]]] = []
+    changed = 0
+    for (did, description, fem, enby, masc), v in zip(rows, vibes):
+        updates.append((v.fem, v.enby, v.masc, gender.RULESET, did, description))
+        changed += (fem, enby, masc) != (v.fem, v.enby, v.masc)
+    # Rows the scraper rewrote in the meantime already have labels for their new description
+    await db.pg.executemany(
+        '''
+        UPDATE "Actor" SET
+            autolabel_fem_vibes = %s, autolabel_nb_vibes = %s, autolabel_masc_vibes = %s, autolabel_ruleset = %s
+        WHERE did = %s AND description IS NOT DISTINCT FROM %s
+        ''',
+        updates,
+    )
+    actors_relabelled.inc(changed, result='changed')
+    actors_relabelled.inc(len(rows) - changed, result='same')
+    return len(rows), rows[-1][0]
+
+
+async def relabel_actors(db: Database, throttle: Throttle) -> int:
+    """
+    Relabels every actor whose labels came from different word lists, returns how many were looked at.
+    Finished pages are marked with the current ruleset, so stopping part way and starting again picks up where it
+    left off.
+    """
+    after = ''
+    total = 0
+    while True:
+        start = time.monotonic()
+        n, after = await relabel_batch(db, after)
+        total += n
+        if n < RELABEL_PAGE_SIZE or not await throttle.after_batch(time.monotonic() - start):
+            return total
+
+
+async def relabel_forever(db: Database, shutdown_event: asyncio.Event, forever: bool) -> None:
+    throttle = Throttle(db, shutdown_event, 'relabel')
+    while not shutdown_event.is_set():
+        try:
+            relabelled = await relabel_actors(db, throttle)
+            if relabelled:
+                cprint(f'Relabelled {relabelled} actors with ruleset {gender.RULESET}', 'yellow', force_color=True)
+        except Exception:
+            cprint('Error while relabelling actors', color='red', force_color=True)
+            traceback.print_exc()
+        if not forever:
+            break
+        await sleep_on(shutdown_event, RELABEL_INTERVAL)
@@ -0,0 +1,212 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from psycopg import sql
+
+import foxfeed.algos.feeds
+import foxfeed.database
+from foxfeed.database import Database
+from foxfeed.metrics import floor_datetime
+
+from typing import Any, Coroutine, Dict, List, Optional, Tuple, Union
+
+
+Stats = List[Tuple[str, int]]
+
+
+RECENT_WINDOW = timedelta(hours=96)
+BUCKET_SIZE = timedelta(hours=1)
+# Buckets newer than this might still get rows added to them (e.g. late likes from a lagging firehose)
+BUCKET_SETTLE_TIME = timedelta(hours=2)
+
+
+async def _labelled(s: str, c: Union[int, Coroutine[Any, Any, int]]) -> Tuple[str, int]:
+    return (s, c if isinstance(c, int) else await c)
+
+
+class HourlyCounter:
+    """Counts rows in a sliding time window, remembering the counts for hours that won't change anymore"""
+
+    def __init__(self, table: str, column: str):
+        self.table = table
+        self.column = column
+        self.buckets: Dict[datetime, int] = {}
+
+    async def _count_range(self, db: Database, start: datetime, end: datetime, *, include_start: bool) -> int:
+        if start >= end:
+            return 0
+        row = await db.pg.fetchone(
+            sql.SQL('SELECT COUNT(*) FROM {} WHERE {} ' + ('>=' if include_start else '>') + ' %s AND {} < %s').format(
+                sql.Identifier(self.table), sql.Identifier(self.column), sql.Identifier(self.column)
+            ),
+            (start, end),
+        )
+        return 0 if row is None else row[0]
+
+    async def _fill_buckets(self, db: Database, start: datetime, end: datetime) -> None:
+        missing = [i for i in _hours(start, end) if i not in self.buckets]
+        if not missing:
+            return
+        rows = await db.pg.fetchall(
+            sql.SQL(
+                'SELECT date_trunc(\'hour\', {}), COUNT(*) FROM {} WHERE {} >= %s AND {} < %s GROUP BY 1'
+            ).format(
+                sql.Identifier(self.column), sql.Identifier(self.table), sql.Identifier(self.column), sql.Identifier(self.column)
+            ),
+            (missing[0], missing[-1] + BUCKET_SIZE),
+        )
+        counts = {hour: count for hour, count in rows}
+        for i in missing:
+            self.buckets[i] = counts.get(i, 0)
+
+    async def count_since(self, db: Database, now: datetime, window: timedelta) -> int:
+        start = now - window
+        first_bucket = floor_datetime(start, BUCKET_SIZE) + BUCKET_SIZE
+        settled_until = max(first_bucket, floor_datetime(now - BUCKET_SETTLE_TIME, BUCKET_SIZE))
+        for i in [i for i in self.buckets if i < first_bucket]:
+            del self.buckets[i]
+        await self._fill_buckets(db, first_bucket, settled_until)
+        settled = sum(self.buckets.get(i, 0) for i in _hours(first_bucket, settled_until))
+        # The ragged bit at the start of the window and the unsettled bit at the end get counted live
+        head = await self._count_range(db, start, first_bucket, include_start=False)
+        tail = await self._count_range(db, settled_until, now, include_start=True)
+        return head + settled + tail
+
+
+def _hours(start: datetime, end: datetime) -> List[datetime]:
+    out: List[datetime] = []
+    c = start
+    while c < end:
+        out.append(c)
+        c += BUCKET_SIZE
+    return out
+
+
+class StatsProvider:
+    """Numbers for the /stats page, cheap enough that anyone can load it"""
+
+    def __init__(self, db: Database, ttl: timedelta = timedelta(seconds=60)):
+        self.db = db
+        self.ttl = ttl.total_seconds()
+        self.cached: Optional[Tuple[float, Stats]] = None
+        self.lock = asyncio.Lock()
+        self.recent_posts = HourlyCounter('Post', 'indexed_at')
+        self.recent_likes = HourlyCounter('Like', 'created_at')
+
+    async def _estimated_rows(self) -> Dict[str, int]:
+        # reltuples is maintained by vacuum/analyse, it's -1 for tables that have never been analysed
+        # Partitioned tables don't have their own estimate, so add up their partitions
+        rows = await self.db.pg.fetchall(
+            '''
+            SELECT COALESCE(parent.relname, c.relname), SUM(GREATEST(c.reltuples, 0))::bigint
+            FROM pg_class AS c
+            LEFT JOIN pg_inherits AS i ON i.inhrelid = c.oid
+            LEFT JOIN pg_class AS parent ON parent.oid = i.inhparent
+            WHERE c.relkind = 'r' AND COALESCE(parent.relname, c.relname) = ANY(%s)
+            GROUP BY 1
+            ''',
+            [['Actor', 'Post', 'Like', 'PostScore', 'ServedBlock', 'ServedPost', 'UnknownThing']],
+        )
+        return {name: count for name, count in rows}
+
+    async def _unknown_thing_kinds(self) -> Dict[str, float]:
+        # Fraction of rows with each kind, from the column stats analyse keeps. There's only a handful of kinds,
+        # so they all make it into the most common values list.
+        row = await self.db.pg.fetchone(
+            '''
+            SELECT most_common_vals::text::text[], most_common_freqs FROM pg_stats
+            WHERE tablename = 'UnknownThing' AND attname = 'kind'
+            '''
+        )
+        if row is None or row[0] is None:
+            return {}
+        return dict(zip(row[0], row[1]))
+
+    async def approximate(self, now: datetime) -> Stats:
+        async with self.lock:
+            if self.cached is not None and time.monotonic() < self.cached[0]:
+                return self.cached[1]
+            estimates, kinds, stats = await asyncio.gather(
+                self._estimated_rows(),
+                self._unknown_thing_kinds(),
+                asyncio.gather(
+                    _labelled(
+                        "> in-fox-feed",
+                        self.db.actor.count(where=foxfeed.database.user_is_in_fox_feed),
+                    ),
+                    _labelled(
+                        "> in-vix-feed",
+                        self.db.actor.count(where=foxfeed.database.user_is_in_vix_feed),
+                    ),
+                    _labelled(
+                        "> storing-data-for",
+                        self.db.actor.count(where=foxfeed.database.care_about_storing_user_data_preemptively),
+                    ),
+                    _labelled("> posts-recent", self.recent_posts.count_since(self.db, now, RECENT_WINDOW)),
+                    _labelled("> likes-recent", self.recent_likes.count_since(self.db, now, RECENT_WINDOW)),
+                ),
+            )
+            labelled = dict(stats)
+            unknown = {kind: int(freq * estimates.get('UnknownThing', 0)) for kind, freq in kinds.items()}
+            result: Stats = [
+                ("feeds", len(foxfeed.algos.feeds.algo_details)),
+                ("users (approx)", estimates.get('Actor', 0)),
+                ("> in-fox-feed", labelled["> in-fox-feed"]),
+                ("> in-vix-feed", labelled["> in-vix-feed"]),
+                ("> storing-data-for", labelled["> storing-data-for"]),
+                ("posts (approx)", estimates.get('Post', 0)),
+                ("> posts-recent", labelled["> posts-recent"]),
+                ("likes (approx)", estimates.get('Like', 0)),
+                ("> likes-recent", labelled["> likes-recent"]),
+                ("postscores (approx)", estimates.get('PostScore', 0)),
+                ("servedblock (approx)", estimates.get('ServedBlock', 0)),
+                ("servedpost (approx)", estimates.get('ServedPost', 0)),
+                ("unknownthings (approx)", estimates.get('UnknownThing', 0)),
+                ("> users", unknown.get('actor', 0)),
+                ("> posts", unknown.get('post', 0)),
+                ("> likes", unknown.get('like', 0)),
+            ]
+            self.cached = (time.monotonic() + self.ttl, result)
+            return result
+
+    async def exact(self, now: datetime) -> Stats:
+        db = self.db
+        return await asyncio.gather(
+            _labelled("feeds", len(foxfeed.algos.feeds.algo_details)),
+            _labelled("users", db.actor.count()),
+            _labelled(
+                "> in-fox-feed",
+                db.actor.count(where=foxfeed.database.user_is_in_fox_feed),
+            ),
+            _labelled(
+                "> in-vix-feed",
+                db.actor.count(where=foxfeed.database.user_is_in_vix_feed),
+            ),
+            _labelled(
+                "> storing-data-for",
+                db.actor.count(
+                    where=foxfeed.database.care_about_storing_user_data_preemptively
+                ),
+            ),
+            _labelled("posts", db.post.count()),
+            _labelled(
+                "> posts-recent",
+                db.post.count(
+                    where={"indexed_at": {"gt": now - RECENT_WINDOW}}
+                ),
+            ),
+            _labelled("likes", db.like.count()),
+            _labelled(
+                "> likes-recent",
+                db.like.count(
+                    where={"created_at": {"gt": now - RECENT_WINDOW}}
+                ),
+            ),
+            _labelled("postscores", db.postscore.count()),
+            _labelled("servedblock", db.servedblock.count()),
+            _labelled("servedpost", db.servedpost.count()),
+            _labelled("unknownthings", db.unknownthing.count()),
+            _labelled("> users", db.unknownthing.count(where={'kind': 'actor'})),
+            _labelled("> posts", db.unknownthing.count(where={'kind': 'post'})),
+            _labelled("> likes", db.unknownthing.count(where={'kind': 'like'})),
+        )
@@ -12,6 +12,7 @@ from atproto_client.models.app.bsky.feed.get_likes import Like
 from atproto_client.models.com.atproto.label.defs import Label
 from atproto_client import models
 from foxfeed.util import parse_datetime, ensure_string, mentions_fursuit, is_record_type
+from foxfeed.bulk import LikeRow, ScrapedActorRow, ScrapedPostRow, ingest_scraped_posts, ingest_scraped_likes
 from datetime import datetime
 
 from typing import Optional, List, Union, Tuple
@@ -26,8 +27,38 @@ async def store_user(
     flag_for_manual_review: bool,
     is_external_to_network: bool,
 ) -> None:
+    # Same row the bulk path writes, so the two can't drift apart
+    row = scraped_actor_row(
+        user,
+        is_muted=is_muted,
+        is_furrylist_verified=is_furrylist_verified,
+        flag_for_manual_review=flag_for_manual_review,
+        is_external_to_network=is_external_to_network,
+    )
+    create: prisma.types.ActorCreateInput = {**row}
+    update: prisma.types.ActorUpdateInput = {**row}
+    # Only gets set for new users
+    del update["flagged_for_manual_review"]
+    # Once this flag turns on, we don't turn it off
+    if not is_furrylist_verified:
+        del update["was_ever_furrylist_verified"]
+    # Actually do the upsert
+    await db.actor.upsert(
+        where={"did": user.did},
+        data={"create": create, "update": update},
+    )
+
+
+def scraped_actor_row(
+    user: ProfileViewDetailed,
+    *,
+    is_muted: bool,
+    is_furrylist_verified: bool,
+    flag_for_manual_review: bool,
+    is_external_to_network: bool,
+) -> ScrapedActorRow:
     gender_vibes = gender.vibecheck(user.description or "")
-    create: prisma.types.ActorCreateInput = {
+    return {
         "did": user.did,
         "handle": user.handle,
         "description": user.description,
@@ -37,6 +68,7 @@ async def store_user(
         "autolabel_fem_vibes": gender_vibes.fem,
         "autolabel_nb_vibes": gender_vibes.enby,
         "autolabel_masc_vibes": gender_vibes.masc,
+        "autolabel_ruleset": gender.RULESET,
         "is_furrylist_verified": is_furrylist_verified,
         "was_ever_furrylist_verified": is_furrylist_verified,
         "is_muted": is_muted,
@@ -44,75 +76,43 @@ async def store_user(
         "follower_count": user.followers_count or 0,
         "following_count": user.follows_count or 0,
     }
-    update: prisma.types.ActorUpdateInput = {
-        "did": user.did,
-        "handle": user.handle,
-        "description": user.description,
-        "displayName": user.display_name,
-        "avatar": user.avatar,
-        "autolabel_fem_vibes": gender_vibes.fem,
-        "autolabel_nb_vibes": gender_vibes.enby,
-        "autolabel_masc_vibes": gender_vibes.masc,
-        "is_muted": is_muted,
-        "is_external_to_network": is_external_to_network,
-        "is_furrylist_verified": is_furrylist_verified,
-        # "was_ever_furrylist_verified" is special, see below
-        "follower_count": user.followers_count or 0,
-        "following_count": user.follows_count or 0,
-    }
-    # Once this flag turns out, we don't turn it off
-    if is_furrylist_verified:
-        update["was_ever_furrylist_verified"] = True
-    # Actually do the upsert
-    await db.actor.upsert(
-        where={"did": user.did},
-        data={"create": create, "update": update},
-    )
 
 
-async def store_like(
-    db: Database, post_uri: str, like: Like
-) -> Optional[prisma.models.Like]:
+def scraped_like_row(post_uri: str, like: Like) -> LikeRow:
     ugh = datetime.utcnow().isoformat()
     blh = random.randint(0, 1 << 32)
     uri = f"fuck://{ugh}-{blh}"
-    try:
-        return await db.like.create(
-            data={
-                "uri": uri,  # TODO
-                "cid": "",  # TODO
-                "post_uri": post_uri,
-                "post_cid": "",  # TODO
-                "liker_id": like.actor.did,
-                "created_at": parse_datetime(like.created_at),
-            }
-        )
-    except prisma.errors.UniqueViolationError:
-        pass
-    except prisma.errors.ForeignKeyViolationError:
-        pass
-    return None
-
-
-async def store_post(db: Database, post: FeedViewPost, *, now: Optional[datetime] = None) -> None:
-    await store_post2(
-        db,
+    return {
+        "uri": uri,  # TODO
+        "cid": "",  # TODO
+        "post_uri": post_uri,
+        "post_cid": "",  # TODO
+        "liker_id": like.actor.did,
+        "created_at": parse_datetime(like.created_at),
+        "attributed_feed": None,
+    }
+
+
+async def store_like(db: Database, post_uri: str, like: Like) -> bool:
+    # Likes for posts or users we don't have get dropped
+    return await ingest_scraped_likes(db, [scraped_like_row(post_uri, like)]) > 0
+
+
+def feed_view_post_row(post: FeedViewPost) -> ScrapedPostRow:
+    return scraped_post_row(
         post.post,
         None if post.reply is None else post.reply.parent.uri,
         None if post.reply is None else post.reply.root.uri,
-        datetime.now() if now is None else now
     )
 
 
-async def store_post3(db: Database, post: PostView, *, now: Optional[datetime] = None) -> None:
+async def store_post(db: Database, post: FeedViewPost) -> None:
+    await ingest_scraped_posts(db, [feed_view_post_row(post)])
+
+
+async def store_post3(db: Database, post: PostView) -> None:
     root, parent = get_parent_skeets(post)
-    await store_post2(
-        db,
-        post,
-        parent,
-        root,
-        datetime.now() if now is None else now,
-    )
+    await store_post2(db, post, parent, root)
 
 
 def labels_to_strings(labels: List[Label]) -> List[str]:
@@ -144,7 +144,7 @@ def get_parent_skeets(post: PostView) -> Union[Tuple[str, str], Tuple[None, None
     return (None, None)
 
 
-async def store_post2(db: Database, p: PostView, reply_parent: Optional[str], reply_root: Optional[str], now: datetime) -> None:
+def scraped_post_row(p: PostView, reply_parent: Optional[str], reply_root: Optional[str]) -> ScrapedPostRow:
     media = get_media(p)
     media_with_alt_text = sum(i.alt != "" for i in media)
     # if verbose:
@@ -154,7 +154,8 @@ async def store_post2(db: Database, p: PostView, reply_parent: Optional[str], re
         text = ensure_string(p.record.text or '')
     labels = labels_to_strings(p.labels or [])
     embed_uri, embed_cid = get_quoted_skeet(p)
-    create: prisma.types.PostCreateInput = {
+    # Existing posts only get the counts and content refreshed, see foxfeed.bulk.SCRAPED_POSTS
+    return {
         "uri": p.uri,
         "cid": p.cid,
         # TODO: Fix these
@@ -175,25 +176,7 @@ async def store_post2(db: Database, p: PostView, reply_parent: Optional[str], re
         "embed_uri": embed_uri,
         "embed_cid": embed_cid,
     }
-    update: prisma.types.PostUpdateInput = {
-        "like_count": p.like_count or 0,
-        "media_count": len(media),
-        "media_with_alt_text_count": media_with_alt_text,
-        "mentions_fursuit": mentions_fursuit(text),
-        "text": text,
-        "labels": labels,
-        "m0": None if len(media) <= 0 else media[0].thumb,
-        "m1": None if len(media) <= 1 else media[1].thumb,
-        "m2": None if len(media) <= 2 else media[2].thumb,
-        "m3": None if len(media) <= 3 else media[3].thumb,
-        "last_rescan": now,
-        "embed_uri": embed_uri,
-        "embed_cid": embed_cid,
-    }
-    await db.post.upsert(
-        where={"uri": p.uri},
-        data={
-            "create": create,
-            "update": update,
-        },
-    )
\ No newline at end of file
+
+
+async def store_post2(db: Database, p: PostView, reply_parent: Optional[str], reply_root: Optional[str]) -> None:
+    await ingest_scraped_posts(db, [scraped_post_row(p, reply_parent, reply_root)])
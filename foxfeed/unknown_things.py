@@ -0,0 +1,291 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from termcolor import cprint
+
+from foxfeed.database import Database
+from foxfeed.bsky import (
+    AsyncClient,
+    Policy,
+    LikeWithDeets,
+    get_specific_profiles,
+    get_specific_posts,
+    get_specific_likes,
+)
+from foxfeed.bulk import LikeRow, ScrapedPostRow, ingest_scraped_actors, ingest_scraped_posts, ingest_scraped_likes, ingest_unknown_things
+from foxfeed.instrumentation import REGISTRY
+from foxfeed.store import scraped_actor_row, scraped_post_row, get_parent_skeets
+from foxfeed.util import chunkify, parse_datetime
+
+from atproto_client.models.app.bsky.actor.defs import ProfileViewDetailed
+from atproto_client.models.app.bsky.feed.defs import PostView
+
+from typing import Dict, List, Literal, Optional, Set, Tuple
+
+
+Kind = Literal['actor', 'post', 'like']
+
+# Lower goes first. Posts need their authors and likes need their posts, so resolving in this order means
+# fewer things get stuck waiting on each other.
+KIND_PRIORITY: Dict[Kind, int] = {'actor': 0, 'post': 1, 'like': 2}
+
+# getProfiles and getPosts both take 25 at a time. Likes come from listRecords, one call per repo, so bigger
+# chunks give more of them a chance to share a repo.
+CHUNK_SIZE: Dict[Kind, int] = {'actor': 25, 'post': 25, 'like': 100}
+
+# Requests in flight at once, they all count against the same Policy
+FETCH_WORKERS = 4
+# Fetched chunks waiting to be written, stops the fetchers running too far ahead of the database
+WRITE_QUEUE_SIZE = 8
+REPORT_INTERVAL = 30
+
+
+unknown_things_resolved = REGISTRY.counter(
+    'foxfeed_unknown_things_resolved_total',
+    'Unknown things taken off the queue, by whether they were found, gone, or still waiting on something else',
+)
+unknown_things_backlog = REGISTRY.gauge(
+    'foxfeed_unknown_things_backlog',
+    'Unknown things left in the current resolver pass',
+)
+
+
+# (id, identifier) from the UnknownThing table
+Thing = Tuple[int, str]
+
+
+@dataclass(order=True)
+class Chunk:
+    # (kind priority, oldest id in the chunk)
+    priority: Tuple[int, int]
+    kind: Kind = field(compare=False)
+    things: List[Thing] = field(compare=False)
+
+
+# Sorts after every real chunk, so workers only see these once everything else has been handed out
+_DONE = Chunk((len(KIND_PRIORITY), 0), 'actor', [])
+
+
+@dataclass
+class Resolved:
+    chunk: Chunk
+    actors: List[ProfileViewDetailed] = field(default_factory=list)
+    posts: List[PostView] = field(default_factory=list)
+    likes: List[LikeWithDeets] = field(default_factory=list)
+
+    def gone(self) -> Set[str]:
+        found = {i.did for i in self.actors} | {i.uri for i in self.posts} | {i.uri for i in self.likes}
+        return {i for _, i in self.chunk.things} - found
+
+
+@dataclass
+class Progress:
+    backlog: int
+    started: float = field(default_factory=time.monotonic)
+    resolved: int = 0
+
+    def done(self, n: int) -> None:
+        self.resolved += n
+        unknown_things_backlog.set(max(self.backlog - self.resolved, 0))
+
+    def report(self) -> None:
+        elapsed = time.monotonic() - self.started
+        rate = self.resolved / elapsed if elapsed > 0 else 0
+        left = max(self.backlog - self.resolved, 0)
+        eta = f'{left / rate / 60:.1f} minutes' if rate > 0 else 'unknown'
+        cprint(
+            f'Resolved {self.resolved} unknown things in {elapsed:.0f}s ({rate:.1f}/s), {left} left, eta {eta}',
+            'cyan',
+            force_color=True,
+        )
+
+
+def specific_like_row(like: LikeWithDeets) -> LikeRow:
+    return {
+        'uri': like.uri,
+        'cid': like.cid or '',
+        'post_uri': like.post_uri,
+        'post_cid': like.post_cid,
+        'liker_id': like.actor_did,
+        'created_at': parse_datetime(like.created_at),
+        'attributed_feed': None,
+    }
+
+
+async def _produce(db: Database, kind: Kind, max_id: int, queue: 'asyncio.PriorityQueue[Chunk]', stop: asyncio.Event) -> None:
+    # Likes are paged by identifier so that likes from the same repo end up in the same chunk
+    order = 'identifier' if kind == 'like' else 'id'
+    after: Tuple[int, str] = (0, '')
+    size = CHUNK_SIZE[kind]
+    while not stop.is_set():
+        rows = await db.pg.fetchall(
+            f'''
+            SELECT id, identifier FROM "UnknownThing"
+            WHERE kind = %s AND id <= %s AND {order} > %s
+            ORDER BY {order} LIMIT %s
+            ''',
+            (kind, max_id, after[1] if kind == 'like' else after[0], size * FETCH_WORKERS),
+        )
+        if not rows:
+            return
+        after = rows[-1]
+        for things in chunkify(rows, size):
+            await queue.put(Chunk((KIND_PRIORITY[kind], min(i for i, _ in things)), kind, things))
+
+
+async def _fetch(client: AsyncClient, policy: Policy, chunk: Chunk) -> Optional[Resolved]:
+    identifiers = [i for _, i in chunk.things]
+    r = Resolved(chunk)
+    if chunk.kind == 'actor':
+        r.actors = [i async for i in get_specific_profiles(client, identifiers, policy)]
+    elif chunk.kind == 'post':
+        r.posts = [i async for i in get_specific_posts(client, identifiers, policy)]
+    else:
+        r.likes = [i async for i in get_specific_likes(client, identifiers, policy)]
+    # The queries stop early on shutdown, and an incomplete result would make everything missing look deleted
+    if policy.stop_event.is_set():
+        return None
+    return r
+
+
+async def _fetch_worker(
+    client: AsyncClient,
+    policy: Policy,
+    chunks: 'asyncio.PriorityQueue[Chunk]',
+    results: 'asyncio.Queue[Optional[Resolved]]',
+) -> None:
+    while (chunk := await chunks.get()) is not _DONE:
+        r = await _fetch(client, policy, chunk)
+        if r is not None:
+            await results.put(r)
+
+
+async def _write_actors(db: Database, r: Resolved) -> None:
+    await ingest_scraped_actors(db, [
+        scraped_actor_row(
+            i,
+            is_muted=False,
+            is_furrylist_verified=False,
+            flag_for_manual_review=False,
+            is_external_to_network=True,
+        )
+        for i in r.actors
+    ])
+    # Placeholders so the firehose stops asking about them
+    await db.pg.executemany(
+        '''
+        INSERT INTO "Actor" (did, handle, is_muted) VALUES (%s, 'deleted', TRUE)
+        ON CONFLICT (did) DO NOTHING
+        ''',
+        [(i,) for i in r.gone()],
+    )
+
+
+async def _write_posts(db: Database, r: Resolved) -> List[int]:
+    """Returns the ids of posts that can't be stored yet since we don't have their author"""
+    authors = list({i.author.did for i in r.posts})
+    have = {did for (did,) in await db.pg.fetchall('SELECT did FROM "Actor" WHERE did = ANY(%s)', (authors,))}
+    rows: List[ScrapedPostRow] = []
+    waiting: List[PostView] = []
+    for post in r.posts:
+        if post.author.did in have:
+            root, parent = get_parent_skeets(post)
+            rows.append(scraped_post_row(post, parent, root))
+        else:
+            waiting.append(post)
+    await ingest_scraped_posts(db, rows)
+    # Query didn't return information about these posts, assume they've been deleted
+    await db.pg.executemany(
+        '''
+        INSERT INTO "Post" (uri, cid, text, is_deleted, mentions_fursuit, "authorId", media_count)
+        VALUES (%s, 'unknown', 'unknown', TRUE, FALSE, 'unknown', 0)
+        ON CONFLICT (uri) DO UPDATE SET is_deleted = TRUE
+        ''',
+        [(i,) for i in r.gone()],
+    )
+    # The post stays on the queue, and gets picked up again once its author is in
+    await ingest_unknown_things(db, [{'kind': 'actor', 'identifier': i.author.did} for i in waiting])
+    uris = {i.uri for i in waiting}
+    return [i for i, uri in r.chunk.things if uri in uris]
+
+
+async def _write(db: Database, r: Resolved) -> Tuple[int, int]:
+    """Stores what got fetched and drops it from the queue, returns (resolved, waiting)"""
+    waiting: List[int] = []
+    if r.chunk.kind == 'actor':
+        await _write_actors(db, r)
+    elif r.chunk.kind == 'post':
+        waiting = await _write_posts(db, r)
+    else:
+        # Likes for posts we don't have get dropped, same as the firehose
+        await ingest_scraped_likes(db, [specific_like_row(i) for i in r.likes])
+    done = [i for i, _ in r.chunk.things if i not in waiting]
+    await db.pg.execute('DELETE FROM "UnknownThing" WHERE id = ANY(%s)', (done,))
+    gone = len(r.gone())
+    unknown_things_resolved.inc(len(done) - gone, kind=r.chunk.kind, result='found')
+    unknown_things_resolved.inc(gone, kind=r.chunk.kind, result='gone')
+    unknown_things_resolved.inc(len(waiting), kind=r.chunk.kind, result='waiting')
+    return len(done), len(waiting)
+
+
+async def _write_worker(db: Database, results: 'asyncio.Queue[Optional[Resolved]]', progress: Progress) -> None:
+    while (r := await results.get()) is not None:
+        resolved, waiting = await _write(db, r)
+        progress.done(resolved + waiting)
+
+
+async def _report_worker(progress: Progress, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), REPORT_INTERVAL)
+        except asyncio.TimeoutError:
+            progress.report()
+
+
+async def resolve_unknown_things(db: Database, client: AsyncClient, policy: Policy) -> bool:
+    """
+    Looks up everything that was on the unknown things queue when this started, returns False if there was nothing.
+    Several chunks are fetched at once while the previous ones are being written.
+    """
+    kinds = list(KIND_PRIORITY)
+    row = await db.pg.fetchone(
+        'SELECT COUNT(*), MAX(id) FROM "UnknownThing" WHERE kind = ANY(%s)',
+        (kinds,),
+    )
+    if row is None or row[1] is None:
+        cprint('No unknown things to load', 'blue', force_color=True)
+        return False
+    backlog, max_id = row
+    cprint(f'There are {backlog} unknown things', 'cyan', force_color=True)
+
+    progress = Progress(backlog)
+    progress.done(0)
+    chunks: 'asyncio.PriorityQueue[Chunk]' = asyncio.PriorityQueue(maxsize=FETCH_WORKERS * 2)
+    results: 'asyncio.Queue[Optional[Resolved]]' = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    finished = asyncio.Event()
+
+    async def feed() -> None:
+        await asyncio.gather(*[_produce(db, kind, max_id, chunks, policy.stop_event) for kind in kinds])
+        for _ in range(FETCH_WORKERS):
+            await chunks.put(_DONE)
+
+    async def drain() -> None:
+        await asyncio.gather(*[_fetch_worker(client, policy, chunks, results) for _ in range(FETCH_WORKERS)])
+        await results.put(None)
+
+    # If any stage fails the others would wait on it forever, so everything gets torn down together
+    tasks = [
+        asyncio.create_task(feed()),
+        asyncio.create_task(drain()),
+        asyncio.create_task(_write_worker(db, results, progress)),
+    ]
+    reporter = asyncio.create_task(_report_worker(progress, finished))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        finished.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, reporter, return_exceptions=True)
+    progress.report()
+    return True
@@ -1,7 +1,9 @@
 import asyncio
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 import dateutil
+import re
 import types
 from typing import ClassVar, Protocol, Type, List, TypeVar, Union, Callable, Dict, Coroutine, Any, Optional, Iterable, AsyncIterable
 import dateutil.parser
@@ -51,24 +53,35 @@ def mentions_fursuit(text: str) -> bool:
     return "fursuit" in text or "murrsuit" in text
 
 
+# The datetime format atproto records are supposed to use, https://atproto.com/specs/lexicon#datetime
+# Nearly everything on the firehose matches this, the odd ones go through dateutil
+_atproto_datetime = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)", re.ASCII)
+
+
+def _parse_atproto_datetime(s: str) -> Optional[datetime]:
+    m = _atproto_datetime.fullmatch(s)
+    if m is None:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = m.groups()
+    # dateutil truncates anything past microseconds as well
+    microsecond = 0 if fraction is None else int(fraction[:6].ljust(6, "0"))
+    try:
+        if offset == "Z" or offset[1:] == "00:00":
+            tz = timezone.utc
+        else:
+            delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))
+            tz = timezone(-delta if offset[0] == "-" else delta)
+        dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, tz)
+    except ValueError:
+        return None
+    return dt if tz is timezone.utc else dt.astimezone(timezone.utc)
+
+
 def parse_datetime(s: str) -> datetime:
-    return dateutil.parser.parse(s).astimezone(timezone.utc)
-    # formats = [
-    #     r"%Y-%m-%dT%H:%M:%S.%fZ",
-    #     r"%Y-%m-%dT%H:%M:%S.%f",
-    #     r"%Y-%m-%dT%H:%M:%SZ",
-    #     r"%Y-%m-%dT%H:%M:%S",
-    #     r"%Y-%m-%dT%H:%M:%S.%f+00:00",
-    #     r"%Y-%m-%dT%H:%M:%S+00:00",
-    #     r"%Y-%m-%dT%H:%M:%S.%f+0000",
-    #     r"%Y-%m-%dT%H:%M:%S+0000",
-    # ]
-    # for fmt in formats:
-    #     try:
-    #         return datetime.strptime(s, fmt).astimezone(timezone.utc)
-    #     except ValueError:
-    #         pass
-    # raise ValueError(f'failed to parse datetime string "{s}"')
+    dt = _parse_atproto_datetime(s)
+    if dt is None:
+        dt = dateutil.parser.parse(s).astimezone(timezone.utc)
+    return dt
 
 
 def interleave(sep: T, xs: List[U]) -> List[Union[U, T]]:
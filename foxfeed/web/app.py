@@ -8,7 +8,11 @@ from foxfeed.post_schedule import run_schedule
 from aiohttp import web
 import aiojobs.aiohttp
 import foxfeed.metrics
+import foxfeed.db_cleanup
+import foxfeed.relabel
 import foxfeed.web.routes
+from foxfeed.web.middleware import instrumentation_middleware
+from foxfeed.database import Subsystem, current_subsystem
 
 from foxfeed.data_filter import operations_callback
 from foxfeed.algos.score_task import score_posts_forever
@@ -46,13 +50,17 @@ async def create_and_run_webapp(
     print("Did runner.cleanup")
     await runner.shutdown()
     print("Did runner.shutdown")
+    # Only after the services have stopped, the cleanup above is what waits for them
+    await res.db.pg.close()
+    print("Did db.pg.close")
 
 
 def create_web_application(
     res: Res, args: Args
 ) -> web.Application:
     app = web.Application(
-        client_max_size=100_000_000
+        client_max_size=100_000_000,
+        middlewares=[instrumentation_middleware],
     )
     app.add_routes(foxfeed.web.routes.create_route_table(res.db, res.client, res.personal_bsky_client, admin_panel=args.admin_panel, require_login=not args.dont_require_admin_login))
     app.cleanup_ctx.append(webapp_background_tasks(res, args))
@@ -72,9 +80,12 @@ async def run_services(
 ) -> None:
     async for _ in _run_services(res, args):
         pass
+    await res.db.pg.close()
 
 
-async def _catch_service(name: str, c: Coroutine[Any, Any, None]) -> None:
+async def _catch_service(name: str, subsystem: Subsystem, c: Coroutine[Any, Any, None]) -> None:
+    # Each service runs in its own task, so this only affects which connection pool that service uses
+    current_subsystem.set(subsystem)
     try:
         termcolor.cprint(
             f"--------[  {name} started   ]--------", "green", force_color=True
@@ -111,21 +122,26 @@ async def _run_services(
     scores = None
     firehose = None
     scheduler = None
+    rollups = None
+    cleanup = None
+    relabel = None
     if args.scraper:
         scraper = asyncio.create_task(
             _catch_service(
                 "LOADDB",
+                "scraper",
                 foxfeed.load_known_furries.rescan_furry_accounts(res, args.forever),
             )
         )
     if args.scores:
         scores = asyncio.create_task(
-            _catch_service("SCORES", score_posts_forever(res.shutdown_event, res.db, res.client, args.forever))
+            _catch_service("SCORES", "scoring", score_posts_forever(res.shutdown_event, res.db, res.client, args.forever))
         )
     if args.firehose:
         firehose = asyncio.create_task(
             _catch_service(
                 "FIREHS",
+                "firehose",
                 data_stream.run(
                     res.db, config.SERVICE_DID, operations_callback, res.shutdown_event
                 ),
@@ -135,9 +151,34 @@ async def _run_services(
         scheduler = asyncio.create_task(
             _catch_service(
                 "POSTER",
+                "background",
                 run_schedule(res.db, res.personal_bsky_client, res.shutdown_event, args.forever)
             )
         )
+    if args.rollups:
+        rollups = asyncio.create_task(
+            _catch_service(
+                "ROLLUP",
+                "background",
+                foxfeed.metrics.rollup_metrics_forever(res.db, res.shutdown_event, args.forever)
+            )
+        )
+    if args.cleanup:
+        cleanup = asyncio.create_task(
+            _catch_service(
+                "CLEANR",
+                "background",
+                foxfeed.db_cleanup.cleanup_forever(res.db, res.shutdown_event, args.forever)
+            )
+        )
+    if args.relabel:
+        relabel = asyncio.create_task(
+            _catch_service(
+                "RELABL",
+                "background",
+                foxfeed.relabel.relabel_forever(res.db, res.shutdown_event, args.forever)
+            )
+        )
     yield
     if running_in_webapp:
         print("Waiting for service tasks to finish")
@@ -151,6 +192,12 @@ async def _run_services(
         await firehose
     if scheduler is not None:
         await scheduler
+    if rollups is not None:
+        await rollups
+    if cleanup is not None:
+        await cleanup
+    if relabel is not None:
+        await relabel
     if running_in_webapp:
         print("Service tasks finished")
 
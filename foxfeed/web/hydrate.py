@@ -0,0 +1,36 @@
+from foxfeed.database import Database, Post
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class PostHydrator:
+    """Loads posts (with their authors) in batches, remembering everything it's seen for the rest of the request"""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.posts: Dict[str, Optional[Post]] = {}
+
+    async def load(self, uris: Iterable[str]) -> None:
+        missing = list({i for i in uris if i not in self.posts})
+        if not missing:
+            return
+        found = await self.db.post.find_many(
+            where={"uri": {"in": missing}},
+            include={"author": True},
+        )
+        for i in missing:
+            self.posts[i] = None
+        for p in found:
+            self.posts[p.uri] = p
+
+    def get(self, uri: Optional[str]) -> Optional[Post]:
+        return None if uri is None else self.posts.get(uri)
+
+    async def posts_in_order(self, uris: List[str]) -> List[Optional[Post]]:
+        await self.load(uris)
+        return [self.get(i) for i in uris]
+
+    async def posts_with_quotes(self, uris: List[str]) -> List[Tuple[Optional[Post], Optional[Post]]]:
+        posts = [i for i in await self.posts_in_order(uris) if i is not None]
+        await self.load(i.embed_uri for i in posts if i.embed_uri is not None)
+        return [(i, self.get(i.embed_uri)) for i in posts]
@@ -1,6 +1,7 @@
 from foxfeed.web import html
 from foxfeed.web.html import Node, head, img, div, h3, h4, p, span, a, UnescapedString
 import re
+import urllib.parse
 from typing import List, Tuple, Union, TypeVar, Optional, Callable
 from prisma.models import Post, Actor, ScheduledPost
 from foxfeed.util import interleave, groupby
@@ -275,7 +276,7 @@ def stats_page(stats: List[Tuple[str, int]], metrics: FeedMetrics) -> Node:
     )
 
 
-def user_main(enable_admin_controls: bool, user: Actor, posts: List[Post]) -> Node:
+def user_main(enable_admin_controls: bool, user: Actor, posts: List[Post], next_cursor: Optional[str] = None) -> Node:
     hline = [
         a("☁️", href="https://bsky.app/profile/" + user.handle, target="_blank"),
         "🚩" if user.flagged_for_manual_review and enable_admin_controls else None,
@@ -320,15 +321,16 @@ def user_main(enable_admin_controls: bool, user: Actor, posts: List[Post]) -> No
         p(user.description),
         p(f'{user.following_count} following, ', Node('b', [str(user.follower_count)], {}), ' followers'),
         *(admin_controls if enable_admin_controls else []),
-        h3(f"{len(posts)} posts") if posts else None,
+        h3("posts") if posts else None,
         *[post(enable_admin_controls, i) for i in posts],
+        a(href=f"/user/{user.handle}?cursor={urllib.parse.quote(next_cursor, safe='')}")(p("next page")) if next_cursor else None,
     )
 
 
-def user_page(enable_admin_controls: bool, user: Actor, posts: List[Post]) -> Node:
+def user_page(enable_admin_controls: bool, user: Actor, posts: List[Post], next_cursor: Optional[str] = None) -> Node:
     return wrap_body(
         f"Fox Feed - User - {user.handle}",
-        user_main(enable_admin_controls, user, posts)
+        user_main(enable_admin_controls, user, posts, next_cursor)
     )
 
 
@@ -0,0 +1,82 @@
+import time
+from aiohttp import web
+
+from foxfeed.instrumentation import REGISTRY, SIZE_BUCKETS, DbTimer, current_db_timer
+
+from typing import Awaitable, Callable, Optional
+
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+# Handlers can stash the feed name in here so the latency gets broken down per feed as well
+FEED_NAME_KEY = "foxfeed.feed_name"
+
+
+request_latency = REGISTRY.histogram(
+    "foxfeed_http_request_duration_seconds",
+    "Time taken to handle HTTP requests",
+)
+request_db_time = REGISTRY.histogram(
+    "foxfeed_http_request_db_seconds",
+    "Time spent waiting on the database while handling HTTP requests",
+)
+request_size = REGISTRY.histogram(
+    "foxfeed_http_response_size_bytes",
+    "Size of HTTP response bodies",
+    SIZE_BUCKETS,
+)
+request_count = REGISTRY.counter(
+    "foxfeed_http_requests_total",
+    "Number of HTTP requests handled",
+)
+request_db_queries = REGISTRY.counter(
+    "foxfeed_http_request_db_queries_total",
+    "Number of database queries made while handling HTTP requests",
+)
+feed_latency = REGISTRY.histogram(
+    "foxfeed_feed_skeleton_duration_seconds",
+    "Time taken to serve getFeedSkeleton, per feed",
+)
+
+
+def route_name(request: web.Request) -> str:
+    # Use the route template rather than the path, otherwise every user page gets its own timeseries
+    resource = request.match_info.route.resource
+    if resource is None:
+        return "unmatched"
+    return resource.canonical
+
+
+def response_size(response: Optional[web.StreamResponse]) -> int:
+    if response is None:
+        return 0
+    return response.content_length or 0
+
+
+@web.middleware
+async def instrumentation_middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+    timer = DbTimer()
+    token = current_db_timer.set(timer)
+    start = time.perf_counter()
+    status = 500
+    response: Optional[web.StreamResponse] = None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        current_db_timer.reset(token)
+        route = route_name(request)
+        request_latency.observe(elapsed, route=route, method=request.method)
+        request_db_time.observe(timer.seconds, route=route, method=request.method)
+        request_size.observe(response_size(response), route=route, method=request.method)
+        request_count.inc(route=route, method=request.method, status=str(status))
+        request_db_queries.inc(timer.queries, route=route, method=request.method)
+        feed_name = request.get(FEED_NAME_KEY)
+        if isinstance(feed_name, str):
+            feed_latency.observe(elapsed, feed=feed_name)
@@ -2,16 +2,21 @@
 
 import asyncio
 import secrets
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from aiohttp import web
 import foxfeed.metrics
 import foxfeed.web.interface
 import foxfeed.algos.feeds
 import foxfeed.database
 import foxfeed.web.jwt_verification
-from foxfeed.database import Database, Post
+from foxfeed.web.middleware import FEED_NAME_KEY
+from foxfeed.instrumentation import REGISTRY
+from foxfeed.stats import StatsProvider
+from foxfeed.database import Database
 from foxfeed.bsky import AsyncClient
 from foxfeed.web.ratelimit import Ratelimit
+from foxfeed.web.hydrate import PostHydrator
+from foxfeed.web.serialize import PrebuiltCache, json_response, json_bytes_response
 from foxfeed import config
 from foxfeed.post_schedule import send_post_and_update_db
 import foxfeed.algos.generators
@@ -22,7 +27,7 @@ import scripts.find_furry_girls
 import gc
 from foxfeed import image
 
-from typing import Callable, Coroutine, Any, Optional, Set, List, Tuple, Literal, Union
+from typing import Callable, Coroutine, Any, Optional, Set, List, Tuple, Literal
 
 
 def data_to_thumbnail(b: bytes) -> bytes:
@@ -46,6 +51,9 @@ algos = {
 }
 
 
+USER_PAGE_SIZE = 50
+
+
 algos_by_short_name = {
     i["record_name"]: i["handler"] for i in foxfeed.algos.feeds.algo_details
 }
@@ -99,6 +107,12 @@ def create_route_table(
 
     admin_token = secrets.token_urlsafe()
 
+    # Skeletons aren't personalised so we can hand the same bytes to everyone for a little while
+    skeleton_cache = PrebuiltCache(ttl=30, max_entries=1024)
+
+    # The public stats page gets estimates, admins can ask for exact counts with ?exact=1
+    stats_provider = StatsProvider(db)
+
     routes = web.RouteTableDef()
 
     routes.static("/static", "./static")
@@ -111,49 +125,6 @@ def create_route_table(
     async def favicon(request: web.Request) -> web.StreamResponse:
         return web.FileResponse("./static/logo.png")
 
-    async def query_stats(now: datetime) -> List[Tuple[str, int]]:
-        async def f(s: str, c: Union[int, Coroutine[Any, Any, int]]) -> Tuple[str, int]:
-            return (s, c if isinstance(c, int) else await c)
-        return await asyncio.gather(
-            f("feeds", len(foxfeed.algos.feeds.algo_details)),
-            f("users", db.actor.count()),
-            f(
-                "> in-fox-feed",
-                db.actor.count(where=foxfeed.database.user_is_in_fox_feed),
-            ),
-            f(
-                "> in-vix-feed",
-                db.actor.count(where=foxfeed.database.user_is_in_vix_feed),
-            ),
-            f(
-                "> storing-data-for",
-                db.actor.count(
-                    where=foxfeed.database.care_about_storing_user_data_preemptively
-                ),
-            ),
-            f("posts", db.post.count()),
-            f(
-                "> posts-recent",
-                db.post.count(
-                    where={"indexed_at": {"gt": now - timedelta(hours=96)}}
-                ),
-            ),
-            f("likes", db.like.count()),
-            f(
-                "> likes-recent",
-                db.like.count(
-                    where={"created_at": {"gt": now - timedelta(hours=96)}}
-                ),
-            ),
-            f("postscores", db.postscore.count()),
-            f("servedblock", db.servedblock.count()),
-            f("servedpost", db.servedpost.count()),
-            f("unknownthings", db.unknownthing.count()),
-            f("> users", db.unknownthing.count(where={'kind': 'actor'})),
-            f("> posts", db.unknownthing.count(where={'kind': 'post'})),
-            f("> likes", db.unknownthing.count(where={'kind': 'like'})),
-        )
-
     @routes.get("/stats")
     async def stats(request: web.Request) -> web.Response:
         now = datetime.now()
@@ -164,11 +135,23 @@ def create_route_table(
             now,
             timedelta(hours=1),
         )
-        qstats_c = query_stats(now)
+        if request.query.get("exact") == "1" and await is_admin(request):
+            qstats_c = stats_provider.exact(now)
+        else:
+            qstats_c = stats_provider.approximate(now)
         qstats, metrics = await asyncio.gather(qstats_c, metrics_c)
         page = foxfeed.web.interface.stats_page(qstats, metrics)
         return web.Response(text=str(page), content_type="text/html")
 
+    @routes.get("/metrics")
+    async def metrics(request: web.Request) -> web.Response:
+        token = request.headers.get("Authorization", "")
+        has_token = bool(config.METRICS_TOKEN) and secrets.compare_digest(token, f"Bearer {config.METRICS_TOKEN}")
+        if not has_token and not await is_admin(request):
+            raise web.HTTPForbidden(text="metrics need an admin login or the metrics token")
+        # Prometheus text exposition format
+        return web.Response(text=REGISTRY.render(), content_type="text/plain")
+
     @routes.get("/user/{handle}")
     async def user_deets(request: web.Request) -> web.Response:
         handle = request.match_info["handle"]
@@ -177,11 +160,29 @@ def create_route_table(
         user = await db.actor.find_first(where={"handle": handle})
         if user is None:
             return web.HTTPNotFound(text="user not found")
+        where: prisma.types.PostWhereInput = {"authorId": user.did, "reply_root": None}
+        cursor = request.rel_url.query.get("cursor", None)
+        if cursor:
+            try:
+                indexed_at_str, uri = cursor.split("::", 1)
+                indexed_at = datetime.fromtimestamp(int(indexed_at_str) / 1000, tz=timezone.utc)
+            except ValueError:
+                return web.HTTPBadRequest(text="Malformed Cursor")
+            where["OR"] = [
+                {"indexed_at": {"lt": indexed_at}},
+                {"indexed_at": indexed_at, "uri": {"lt": uri}},
+            ]
         posts = await db.post.find_many(
-            where={"authorId": user.did, "reply_root": None},
-            order={"indexed_at": "desc"},
+            take=USER_PAGE_SIZE + 1,
+            where=where,
+            order=[{"indexed_at": "desc"}, {"uri": "desc"}],
+        )
+        next_cursor = (
+            f"{int(posts[USER_PAGE_SIZE - 1].indexed_at.timestamp() * 1000)}::{posts[USER_PAGE_SIZE - 1].uri}"
+            if len(posts) > USER_PAGE_SIZE
+            else None
         )
-        page = foxfeed.web.interface.user_page(await is_admin(request), user, posts)
+        page = foxfeed.web.interface.user_page(await is_admin(request), user, posts[:USER_PAGE_SIZE], next_cursor)
         return web.Response(text=str(page), content_type="text/html")
 
     @routes.get("/.well-known/did.json")
@@ -189,7 +190,7 @@ def create_route_table(
         if not config.SERVICE_DID.endswith(config.HOSTNAME):
             return web.HTTPNotFound()
 
-        return web.json_response(
+        return json_response(
             {
                 "@context": ["https://www.w3.org/ns/did/v1"],
                 "id": config.SERVICE_DID,
@@ -210,7 +211,7 @@ def create_route_table(
             "encoding": "application/json",
             "body": {"did": config.SERVICE_DID, "feeds": feeds},
         }
-        return web.json_response(response)
+        return json_response(response)
 
     @routes.get("/xrpc/app.bsky.feed.getFeedSkeleton")
     async def get_feed_skeleton(request: web.Request) -> web.Response:
@@ -220,6 +221,8 @@ def create_route_table(
         if not algo:
             return web.HTTPBadRequest(text="Unsupported algorithm")
 
+        request[FEED_NAME_KEY] = feed_record_name
+
         cprint(f"Getting feed {feed_record_name}", "magenta", force_color=True)
 
         s = datetime.now()
@@ -227,13 +230,18 @@ def create_route_table(
         try:
             cursor = request.query.get("cursor", default=None)
             limit = int(request.query.get("limit", default=20))
-            body = await algo(db, cursor, limit)
+            cached = skeleton_cache.get((feed, cursor, limit))
+            if cached is not None:
+                body, encoded = cached
+            else:
+                body = await algo(db, cursor, limit)
+                encoded = skeleton_cache.put((feed, cursor, limit), body)
         except ValueError:
             return web.HTTPBadRequest(text="Malformed Cursor")
 
         d = datetime.now() - s
 
-        cprint(f"Done in {int(d.total_seconds())}", "magenta", force_color=True)
+        cprint(f"Done in {d.total_seconds() * 1000:.1f}ms", "magenta", force_color=True)
 
         await aiojobs.aiohttp.spawn(
             request,
@@ -247,7 +255,7 @@ def create_route_table(
             ),
         )
 
-        return web.json_response(body)
+        return json_bytes_response(encoded)
 
     async def store_served_posts(
         auth: Optional[str],
@@ -298,17 +306,7 @@ def create_route_table(
             return web.HTTPNotFound(text="Feed not found")
 
         result = await algo(db, cursor, 50)
-        posts = result["feed"]
-        full_posts = [
-            await db.post.find_first(where={"uri": i["post"]}, include={"author": True})
-            for i in posts
-        ]
-
-        with_quotes: List[Tuple[Optional[Post], Optional[Post]]] = [
-            (i, None if i.embed_uri is None else await db.post.find_first(where={"uri": i.embed_uri}, include={"author": True}))
-            for i in full_posts
-            if i is not None
-        ]
+        with_quotes = await PostHydrator(db).posts_with_quotes([i["post"] for i in result["feed"]])
 
         page = foxfeed.web.interface.feed_page(
             await is_admin(request), feed_name, with_quotes, result["cursor"]
@@ -330,6 +328,7 @@ def create_route_table(
         now = datetime.now()
 
         cols: List[List[Optional[foxfeed.database.Post]]] = []
+        hydrator = PostHydrator(db)
         
         for hours_ago in [72, 60, 48, 36, 24, 12, 0]:
             dt = now - timedelta(hours=hours_ago)
@@ -340,13 +339,7 @@ def create_route_table(
                     run_version=0,
                 )
                 posts = (await algo['generator'](db, rd))[:20]
-                full_posts = [
-                    await db.post.find_first(
-                        where={"uri": i}, include={"author": True}
-                    )
-                    for i in posts
-                ]
-                cols.append(full_posts)
+                cols.append(await hydrator.posts_in_order(posts))
 
         page = foxfeed.web.interface.feed_timetravel_page(
             cols
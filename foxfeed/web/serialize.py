@@ -0,0 +1,87 @@
+import json
+import time
+from collections import OrderedDict
+from aiohttp import web
+
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSON_CONTENT_TYPE = "application/json"
+
+
+def _dumps_stdlib(obj: Any) -> bytes:
+    # Compact separators, same as what orjson spits out
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _dumps_orjson(obj: Any) -> bytes:
+    assert orjson is not None
+    return orjson.dumps(obj)
+
+
+Serializer = Callable[[Any], bytes]
+
+
+def default_serializer() -> Serializer:
+    return _dumps_stdlib if orjson is None else _dumps_orjson
+
+
+_serializer: Serializer = default_serializer()
+
+
+def set_serializer(serializer: Serializer) -> None:
+    global _serializer
+    _serializer = serializer
+
+
+def dumps(obj: Any) -> bytes:
+    return _serializer(obj)
+
+
+def json_bytes_response(body: bytes, *, status: int = 200) -> web.Response:
+    return web.Response(body=body, status=status, content_type=JSON_CONTENT_TYPE, charset="utf-8")
+
+
+def json_response(obj: Any, *, status: int = 200) -> web.Response:
+    return json_bytes_response(dumps(obj), status=status)
+
+
+class PrebuiltCache:
+    """Keeps the already-encoded bytes of recently served responses around for a little while"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache: 'OrderedDict[Hashable, Tuple[float, Any, bytes]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, bytes]]:
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value, body = entry
+        if time.monotonic() > expires_at:
+            del self.cache[key]
+            self.misses += 1
+            return None
+        self.cache.move_to_end(key)
+        self.hits += 1
+        return (value, body)
+
+    def put(self, key: Hashable, value: Any) -> bytes:
+        body = dumps(value)
+        self.cache[key] = (time.monotonic() + self.ttl, value, body)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return body
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self.cache), "hits": self.hits, "misses": self.misses}
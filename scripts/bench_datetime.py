@@ -0,0 +1,60 @@
+# Compares foxfeed.util.parse_datetime against plain dateutil on the datetimes that show up on the firehose
+# Run with `python -m scripts.bench_datetime`
+# Also checks they give the same answers, so it doubles as a test for the fast path
+
+import timeit
+import dateutil.parser
+from datetime import datetime, timezone
+from foxfeed.util import parse_datetime
+
+from typing import Callable, List
+
+
+# What records' createdAt actually look like, most clients send milliseconds and Z
+FIREHOSE_FORMATS = [
+    "2024-11-21T09:41:12.345Z",
+    "2024-11-21T09:41:12.345678Z",
+    "2024-11-21T09:41:12Z",
+    "2024-11-21T09:41:12.345+00:00",
+    "2024-11-21T09:41:12.345678+00:00",
+    "2024-11-21T19:41:12.345+10:00",
+    "2024-11-21T04:41:12.345-05:00",
+    "2024-11-21T09:41:12.345678901Z",
+]
+
+# Not the atproto profile, these should go through dateutil and still come out the same
+ODD_FORMATS = [
+    "2024-11-21 09:41:12.345Z",
+    "2024-11-21T09:41:12.345z",
+    "2024-11-21T09:41:12.345+0000",
+    "2024-11-21T09:41Z",
+    "20241121T094112Z",
+]
+
+
+def dateutil_parse(s: str) -> datetime:
+    return dateutil.parser.parse(s).astimezone(timezone.utc)
+
+
+def bench(name: str, f: Callable[[str], datetime], inputs: List[str], number: int) -> None:
+    seconds = min(timeit.repeat(lambda: [f(i) for i in inputs], number=number, repeat=5))
+    print(f"{name:>24} : {1_000_000 * seconds / number / len(inputs):8.2f} us/call")
+
+
+def main() -> None:
+    mismatches = [i for i in FIREHOSE_FORMATS + ODD_FORMATS if parse_datetime(i) != dateutil_parse(i)]
+    print(f"{len(mismatches)} formats got a different answer")
+    for i in mismatches:
+        print(f"  {i!r}: {parse_datetime(i)} vs {dateutil_parse(i)}")
+
+    number = 2_000
+    print("firehose formats")
+    bench("dateutil", dateutil_parse, FIREHOSE_FORMATS, number)
+    bench("util.parse_datetime", parse_datetime, FIREHOSE_FORMATS, number)
+    print("odd formats")
+    bench("dateutil", dateutil_parse, ODD_FORMATS, number)
+    bench("util.parse_datetime", parse_datetime, ODD_FORMATS, number)
+
+
+if __name__ == "__main__":
+    main()
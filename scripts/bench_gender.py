@@ -0,0 +1,99 @@
+# Compares the old per-vibe regexes against the combined matcher on a pile of made up bios
+# Run with `python -m scripts.bench_gender`
+# Also checks that both give the same answer for every bio, so it doubles as a test for the matcher
+
+import random
+import re
+import time
+import unicodedata
+from foxfeed import gender
+from foxfeed.gender import Vibes, VibeCheck
+
+from typing import Any, Callable, List, Union
+
+
+BIOS = 100_000
+
+# Most of a bio is just words, the interesting bits are sprinkled in
+WORDS = [
+    "furry", "artist", "fursuiter", "commissions", "open", "18+", "mdni", "icon", "by", "@someone", "fox", "wolf",
+    "dragon", "gay", "trans", "dog", "puppy", "a", "the", "and", "of", "i", "draw", "stuff", "sometimes", "love",
+    "games", "music", "Australia", "🦊", "💜", "🐾", "🏳️‍⚧️", "\n", "丨", "|", "-", "f-list", "heretic", "shelf",
+]
+VIBES = [
+    "she/her", "he/him", "they/them", "it/its", "any pronouns", "25f", "30m", "22nb", "♀", "♂️", "girl", "boy",
+    "enby", "non-binary", "her's", "he’s", "Herself", "HIMBO", "catgirl",
+]
+
+
+def make_bio(r: random.Random) -> str:
+    words = r.choices(WORDS, k=r.randint(0, 40))
+    for _ in range(r.choice([0, 0, 0, 1, 1, 2])):
+        words.insert(r.randint(0, len(words)), r.choice(VIBES))
+    return " ".join(words)
+
+
+def make_bios(n: int) -> List[str]:
+    r = random.Random(0)
+    bios = [make_bio(r) for _ in range(n)]
+    # Lots of real bios are empty
+    for i in range(0, n, 5):
+        bios[i] = ""
+    return bios
+
+
+# This is what gender.vibecheck used to do, kept here to compare against
+
+
+def legacy_test_vibes(vibes: Vibes, t: str) -> Union["re.Match[str]", str, None]:
+    for i in vibes.emoji:
+        if i in t:
+            return i
+    regex = r"\b(" + "|".join(vibes.words) + r")\b"
+    if m := re.search(regex, t):
+        return m
+    for i in vibes.regexes:
+        if m := re.search(i, t):
+            return m
+    return None
+
+
+def legacy_vibecheck(text: str) -> VibeCheck:
+    t = (
+        unicodedata.normalize("NFKC", text)
+        .replace("\n", " ")
+        .replace("'", "")
+        .replace("’", "")
+        .replace("丨", " ")
+        .replace("/", " ")
+        .lower()
+        .replace("f-list", " ")
+    )
+    return VibeCheck(
+        fem=legacy_test_vibes(gender.girl_vibes, t) is not None,
+        enby=legacy_test_vibes(gender.enby_vibes, t) is not None,
+        masc=legacy_test_vibes(gender.boy_vibes, t) is not None,
+    )
+
+
+def bench(name: str, f: Callable[[], Any]) -> Any:
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>24} : {BIOS} bios in {1000 * elapsed:8.1f} ms, {BIOS / elapsed:10.0f} bios/s")
+    return result
+
+
+def main() -> None:
+    bios = make_bios(BIOS)
+    old = bench("legacy vibecheck", lambda: [legacy_vibecheck(i) for i in bios])
+    new = bench("gender.vibecheck", lambda: [gender.vibecheck(i) for i in bios])
+    many = bench("gender.vibecheck_many", lambda: gender.vibecheck_many(bios))
+    mismatches = [bio for bio, a, b, c in zip(bios, old, new, many) if not a == b == c]
+    print(f"{len(mismatches)} bios got a different answer")
+    for bio in mismatches[:10]:
+        print(f"  {bio!r}")
+
+
+if __name__ == "__main__":
+    main()
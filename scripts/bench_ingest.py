@@ -0,0 +1,58 @@
+# Compares the ways we can write batches of rows to the database
+# Run with `python -m scripts.bench_ingest`, needs DATABASE_URL pointing at a database you don't mind writing to
+# Rows go into UnknownThing with their own kind and get deleted again afterwards
+
+import asyncio
+import time
+from foxfeed.database import Database, make_database_connection
+from foxfeed.gen.db import InsertUnknownThingsRow, insert_unknown_things
+from foxfeed.bulk import ingest_unknown_things
+
+from typing import Any, Awaitable, Callable, List
+
+
+BENCH_KIND = 'bench-ingest'
+BATCH_SIZES = [10, 100, 1_000, 10_000]
+
+
+def make_rows(n: int, run: int) -> List[InsertUnknownThingsRow]:
+    return [{'kind': BENCH_KIND, 'identifier': f'at://bench/{run}/{i}'} for i in range(n)]
+
+
+async def prisma_create_many(db: Database, rows: List[InsertUnknownThingsRow]) -> Any:
+    return await db.unknownthing.create_many(data=list(rows), skip_duplicates=True)
+
+
+async def bench(
+    db: Database,
+    name: str,
+    f: Callable[[Database, List[InsertUnknownThingsRow]], Awaitable[Any]],
+    n: int,
+    run: int,
+) -> None:
+    rows = make_rows(n, run)
+    start = time.perf_counter()
+    await f(db, rows)
+    elapsed = time.perf_counter() - start
+    await db.unknownthing.delete_many(where={'kind': BENCH_KIND})
+    print(f'{name:>20} : {n:>6} rows in {1000 * elapsed:8.1f} ms, {n / elapsed:10.0f} rows/s')
+
+
+async def main() -> None:
+    db = await make_database_connection()
+    await db.unknownthing.delete_many(where={'kind': BENCH_KIND})
+    run = 0
+    for n in BATCH_SIZES:
+        for name, f in [
+            ('prisma create_many', prisma_create_many),
+            ('executemany', insert_unknown_things),
+            ('copy + merge', ingest_unknown_things),
+        ]:
+            run += 1
+            await bench(db, name, f, n, run)
+        print()
+    await db.pg.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+# Compares the ways we can encode a feed skeleton
+# Run with `python -m scripts.bench_json`
+
+import json
+import timeit
+from foxfeed.web import serialize
+from foxfeed.web.serialize import PrebuiltCache
+
+from typing import Any, Callable, Dict
+
+
+def make_skeleton(n: int) -> Dict[str, Any]:
+    return {
+        "cursor": "1700000000::100",
+        "feed": [
+            {"post": f"at://did:plc:j7jc2j2htz5gxuxi2ilhbqka/app.bsky.feed.post/3k{i:011d}"}
+            for i in range(n)
+        ],
+    }
+
+
+def bench(name: str, f: Callable[[], Any], number: int) -> None:
+    seconds = min(timeit.repeat(f, number=number, repeat=5))
+    print(f"{name:>24} : {1_000_000 * seconds / number:8.2f} us/call")
+
+
+def main() -> None:
+    skeleton = make_skeleton(100)
+    number = 20_000
+
+    print("orjson available:", serialize.orjson is not None)
+
+    bench("stdlib json.dumps", lambda: json.dumps(skeleton).encode("utf-8"), number)
+    bench("serialize.dumps", lambda: serialize.dumps(skeleton), number)
+
+    cache = PrebuiltCache(ttl=60, max_entries=16)
+    cache.put(("fox-feed", None, 100), skeleton)
+    bench("prebuilt bytes", lambda: cache.get(("fox-feed", None, 100)), number)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ async def main():
         where={'status': 'scheduled'},
         data={'status': 'cancelled'},
     )
+    await db.pg.close()
 
 
 if __name__ == '__main__':
@@ -10,5 +10,6 @@ async def main():
     print(len(girls), 'seed accounts')
     with gzip.open('./seed.json.gzip', 'wb') as f:
         f.write(json.dumps(blob).encode('utf-8'))
+    await db.pg.close()
 
 asyncio.run(main())
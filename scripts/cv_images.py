@@ -95,6 +95,7 @@ async def main():
                     'cv_model_name': 'error',
                 }
             )
+    await db.pg.close()
 
 
 asyncio.run(main())
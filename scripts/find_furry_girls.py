@@ -28,6 +28,7 @@ async def main() -> None:
                         if await db.actor.find_unique(where={'did': like.actor.did}) is None:
                             print(like.actor.handle, '-', like.actor.description, '\n')
                             await store_user(db, like.actor)
+    await db.pg.close()
 
 
 async def from_likes_of_post(db: Database, client: AsyncClient, post_uri: str) -> Tuple[int, int]:
@@ -39,7 +40,7 @@ async def from_likes_of_post(db: Database, client: AsyncClient, post_uri: str) -
             # Can assume that this is a create
             await store_user(db, like.actor, flag_for_manual_review=True, is_furrylist_verified=False, is_muted=False)
             added_users += 1
-        if await store_like(db, post_uri, like) is not None:
+        if await store_like(db, post_uri, like):
             added_likes += 1
     return (added_users, added_likes)
 
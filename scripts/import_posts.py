@@ -46,6 +46,7 @@ async def main(filename: str):
             }
         )
         print(r)
+    await db.pg.close()
 
 
 if __name__ == '__main__':
@@ -15,6 +15,7 @@ async def main():
             await store_user(tx, i, is_muted=False, is_furrylist_verified=False, is_external_to_network=True, flag_for_manual_review=False)
         async for i in get_specific_profiles(client, [user.did], None):
             await store_user(tx, i, is_muted=False, is_furrylist_verified=False, is_external_to_network=True, flag_for_manual_review=False)
+    await db.pg.close()
 
 
 if __name__ == '__main__':
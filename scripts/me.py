@@ -13,6 +13,7 @@ async def main():
             print('client.me is None')
         else:
             print(client.me.model_dump_json(indent=4))
+    await db.pg.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,21 @@
+# One-off migration that turns ServedBlock and ServedPost into tables partitioned by day
+# Run with `python -m scripts.partition_tables`, after that db_cleanup keeps the partitions up to date
+
+import asyncio
+from datetime import datetime
+from foxfeed import config
+from foxfeed.database import make_database_connection
+from foxfeed.partitions import PARTITIONED_TABLES, convert_to_partitioned
+
+
+async def main() -> None:
+    db = await make_database_connection(config.DB_URL, timeout=300)
+    for t in PARTITIONED_TABLES:
+        print(f'Partitioning {t.table} on {t.column}')
+        await convert_to_partitioned(db, t, datetime.utcnow())
+    await db.pg.close()
+    print('Done')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
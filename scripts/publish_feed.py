@@ -65,6 +65,7 @@ async def main():
     for i in algo_details:
         print(await register(client_public, i['record_name'], i['display_name'], i['description'], public_blob, i['show_on_main_account']))
         print(await register(client_personal, i['record_name'], i['display_name'], i['description'], personal_blob, i['show_on_personal_account']))
+    await db.pg.close()
 
 
 if __name__ == '__main__':
@@ -1,20 +1,23 @@
+# Relabels everyone whose gender labels came from older word lists, same as the relabel service but in one go
+# Run with `python -m scripts.regender_db`, add `--all` to relabel everyone regardless
+
 import asyncio
+import sys
+import time
 from foxfeed.database import make_database_connection
-from foxfeed.gender import guess_gender_reductive
-from collections import defaultdict
-from typing import Dict
+from foxfeed.db_cleanup import Throttle
+from foxfeed.relabel import relabel_actors
+
 
-async def main():
+async def main(*, everyone: bool) -> None:
     db = await make_database_connection()
-    users = await db.actor.find_many()
-    c: Dict[str, int] = defaultdict(lambda: 0)
-    for i in users:
-        gender = guess_gender_reductive(i.description or '')
-        c[gender] += 1
-        await db.actor.update(
-            where={'did': i.did},
-            data={'gender_label_auto': gender}
-        )
-    print(c)
+    if everyone:
+        await db.pg.execute('UPDATE "Actor" SET autolabel_ruleset = NULL')
+    start = time.perf_counter()
+    relabelled = await relabel_actors(db, Throttle(db, asyncio.Event(), 'relabel'))
+    print(f'Relabelled {relabelled} actors in {time.perf_counter() - start:.1f}s')
+    await db.pg.close()
+
 
-asyncio.run(main())
+if __name__ == '__main__':
+    asyncio.run(main(everyone='--all' in sys.argv))
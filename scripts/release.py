@@ -0,0 +1,71 @@
+# Brings the database schema in line with prisma/schema.prisma, runs as the release step in the Procfile
+# Run with `python -m scripts.release`, `--dry-run` just prints what it would do
+# This is `prisma db push --accept-data-loss` except that it leaves the partitioned tables alone. Prisma doesn't
+# know about partitions, so it would try to drop every daily partition as a table that isn't in the schema.
+# Until scripts/partition_tables.py has been run they're plain tables, and prisma creates and migrates them as usual.
+# After that, changes to ServedBlock or ServedPost have to be made by hand (ALTER the parent table, the partitions
+# follow).
+
+import asyncio
+import re
+import subprocess
+import sys
+from foxfeed import config
+from foxfeed.database import make_database_connection
+from foxfeed.partitions import PARTITIONED_TABLES, PartitionedTable, is_partitioned
+
+from typing import List, Tuple
+
+
+def schema_diff() -> List[str]:
+    script = subprocess.run(
+        [
+            'prisma', 'migrate', 'diff',
+            '--from-url', config.DB_URL or '',
+            '--to-schema-datamodel', 'prisma/schema.prisma',
+            '--script',
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    statements: List[str] = []
+    for statement in re.split(r';\s*\n', script):
+        statement = '\n'.join(i for i in statement.splitlines() if not i.startswith('--')).strip().rstrip(';')
+        if statement:
+            statements.append(statement)
+    return statements
+
+
+def split_partitioned(statements: List[str], partitioned: List[PartitionedTable]) -> Tuple[List[str], List[str]]:
+    # Partitions are named after their table, so this catches the parent, the partitions and their indexes
+    names = [f'"{t.table}' for t in partitioned]
+    keep = [i for i in statements if not any(name in i for name in names)]
+    skip = [i for i in statements if any(name in i for name in names)]
+    return keep, skip
+
+
+async def main(*, dry_run: bool) -> None:
+    db = await make_database_connection(config.DB_URL)
+    try:
+        partitioned = [t for t in PARTITIONED_TABLES if await is_partitioned(db, t)]
+        keep, skip = split_partitioned(schema_diff(), partitioned)
+        for statement in skip:
+            print(f'Skipping, partitioned tables are migrated by hand:\n{statement}\n')
+        for statement in keep:
+            print(f'{statement}\n')
+        if dry_run or not keep:
+            print(f'{len(keep)} statements to apply')
+            return
+        async with db.pg.connection() as conn:
+            async with conn.transaction():
+                for statement in keep:
+                    # Generated by prisma rather than written here, so it goes in as bytes instead of a literal string
+                    await conn.execute(statement.encode())
+        print(f'Applied {len(keep)} statements')
+    finally:
+        await db.pg.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(dry_run='--dry-run' in sys.argv))
@@ -7,6 +7,7 @@ async def main():
     client = await make_bsky_client(db)
     async for i in get_followers(client, client.me.did):
         print(i.handle, i.display_name)
+    await db.pg.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
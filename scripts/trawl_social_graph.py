@@ -1,6 +1,6 @@
 import asyncio
 from asyncio import Queue
-from atproto import AsyncClient
+from foxfeed.bsky import AsyncClient
 from foxfeed.load_known_furries import (
     get_followers,
     get_follows,
@@ -61,6 +61,7 @@ async def main():
     await q.join()
     worker.cancel()
     await asyncio.gather(worker, return_exceptions=True)
+    await db.pg.close()
 
 
 asyncio.run(main())
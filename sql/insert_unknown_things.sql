@@ -0,0 +1,3 @@
+INSERT INTO "UnknownThing" (kind, identifier)
+VALUES (:kind, :identifier)
+ON CONFLICT DO NOTHING
@@ -30,7 +30,7 @@ WITH "LikeCount" AS (
         post.labels AS labels,
         (
             EXTRACT(EPOCH FROM (:current_time - post.indexed_at)) /
-            EXTRACT(EPOCH FROM interval :beta)
+            EXTRACT(EPOCH FROM CAST(:beta AS interval))
         ) AS x,
         (
             (CASE WHEN post.media_count > 0 AND post.media_with_alt_text_count = 0 THEN 0.7 ELSE 1.0 END)
@@ -61,7 +61,7 @@ WITH "LikeCount" AS (
         AND NOT post.is_pinned
         AND NOT author.is_muted
         AND author.manual_include_in_fox_feed IS NOT FALSE
-        AND author.is_external_to_network IS :external_posts
+        AND author.is_external_to_network IS NOT DISTINCT FROM :external_posts
 ), table2 AS (
     SELECT
         uri,
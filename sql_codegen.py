@@ -1,49 +1,54 @@
 import re
-from typing import Iterator
+from typing import Dict, Iterator
 import shutil
 
 OUT_DIR = './foxfeed/gen/'
 OUT_FILE = 'db.py'
 
+# Queries that return rows, and the model each row gets turned into
 INPUT = [
     ('score_posts', 'ScorePostsOutputModel'),
     ('score_by_interactions', 'ScoreByInteractionOutputModel'),
     ('find_unlinks', 'FindUnlinksOutputModel'),
 ]
 
+# Statements that get run once per row of a batch (i.e. inserts), and the type of each parameter
+BATCHES: Dict[str, Dict[str, str]] = {
+    'insert_unknown_things': {
+        'kind': 'str',
+        'identifier': 'str',
+    },
+}
+
 HEADDER = '''
-# This is kinda weird and really bad sorry
+# Generated by sql_codegen.py from the files in sql/, don't edit this by hand
 
 from datetime import datetime
 import foxfeed.database
-from typing import List, Union
+from psycopg.rows import class_row
+from typing import List, Optional, Sequence, TypedDict, Union
 
 Arg = Union[str, int, float, bool, datetime]
-
-def escape(a: Arg) -> str:
-    if isinstance(a, bool):
-        return 'TRUE' if a else 'FALSE'
-    if isinstance(a, str):
-        assert "'" not in a
-        return "'" + a + "'"
-    if isinstance(a, int):
-        return str(a)
-    if isinstance(a, float):
-        return str(a)
-    if isinstance(a, datetime):
-        return "'" + a.isoformat().split('.')[0] + "'::timestamp"
 '''
 
-from datetime import datetime
+# Matches :name but not the second half of a ::type cast
+PARAMETER = re.compile(r'(?<!:):(\w+)')
+
+
+def to_psycopg(sql: str) -> str:
+    # Values get bound by the server rather than formatted into the query text
+    return PARAMETER.sub(lambda m: f'%({m[1]})s', sql.replace('%', '%%'))
+
+
+def camel_case(name: str) -> str:
+    return ''.join(i.capitalize() for i in name.split('_'))
 
-d = datetime.now()
-d.isoformat
 
 def codegen_for_query(function_name: str, output_model: str, sql: str) -> Iterator[str]:
-    arguments = [i[1:] for i in re.findall(r'(?::)\w+', sql)]
+    arguments = sorted(set(PARAMETER.findall(sql)))
     # Put the sql in a big global variable
     yield f'{function_name}_sql_query = """'
-    yield re.sub(r':\w+', lambda m: f'{{{m[0][1:]}}}', sql)
+    yield to_psycopg(sql)
     yield '"""'
     yield ''
     # Function signature
@@ -51,16 +56,44 @@ def codegen_for_query(function_name: str, output_model: str, sql: str) -> Iterat
     yield '    db: foxfeed.database.Database,'
     if arguments:
         yield '    *,'
-    for i in sorted(set(arguments)):
+    for i in arguments:
         yield f'    {i}: Arg,'
     yield f') -> List[foxfeed.database.{output_model}]:'
     # Function body
-    yield f'    query = {function_name}_sql_query.format('
-    for i in sorted(set(arguments)):
-        yield f'        {i} = escape({i}),'
+    yield '    return await db.pg.fetchrows('
+    yield f'        class_row(foxfeed.database.{output_model}),'
+    yield f'        {function_name}_sql_query,'
+    if arguments:
+        yield '        {'
+        for i in arguments:
+            yield f'            {i!r}: {i},'
+        yield '        },'
+    else:
+        yield '        {},'
+    yield '        prepare=True,'
     yield '    )'
-    yield f'    result = await db.query_raw(query, model=foxfeed.database.{output_model}) # type: ignore'
-    yield '    return result'
+    yield ''
+
+
+def codegen_for_batch(function_name: str, types: Dict[str, str], sql: str) -> Iterator[str]:
+    arguments = set(PARAMETER.findall(sql))
+    assert arguments == set(types), f'{function_name}: parameters {arguments} do not match types {set(types)}'
+    row_type = camel_case(function_name) + 'Row'
+    yield f'class {row_type}(TypedDict):'
+    for name, t in types.items():
+        yield f'    {name}: {t}'
+    yield ''
+    yield f'{function_name}_sql_query = """'
+    yield to_psycopg(sql)
+    yield '"""'
+    yield ''
+    yield f'async def {function_name}('
+    yield '    db: foxfeed.database.Database,'
+    yield f'    rows: Sequence[{row_type}],'
+    yield ') -> int:'
+    yield '    if not rows:'
+    yield '        return 0'
+    yield f'    return await db.pg.executemany({function_name}_sql_query, rows)'
     yield ''
 
 
@@ -69,6 +102,9 @@ def codegen() -> Iterator[str]:
     for name, output_model in INPUT:
         with open('./sql/' + name + '.sql') as f:
             yield from codegen_for_query(name, output_model, f.read())
+    for name, types in BATCHES.items():
+        with open('./sql/' + name + '.sql') as f:
+            yield from codegen_for_batch(name, types, f.read())
 
 
 if __name__ == '__main__':
@@ -79,4 +115,3 @@ if __name__ == '__main__':
     code = '\n'.join(codegen())
     with open(OUT_DIR + OUT_FILE, 'w') as f:
         f.write(code)
-